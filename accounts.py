@@ -0,0 +1,155 @@
+"""Account deletion, done in the background a chunk at a time.
+
+Deleting a prolific user in one transaction would hold locks on their
+messages, likes and follows for as long as it takes to delete them all.
+`delete_user()` only marks the account deleted, which hides it and its
+messages at once, and queues a `purge_user` job. The job deletes at most
+PURGE_CHUNK_SIZE rows per run, keeping the counters of everyone affected
+in step as it goes, and removes the `users` row last.
+"""
+
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import delete, func, select, update
+
+from models import db, FollowChange, Follows, Likes, Message, TimelineEntry, User
+import jobs
+
+PURGE_CHUNK_SIZE = 1000
+
+
+def delete_user(user_id):
+    """Mark `user_id` deleted and queue its purge, in the caller's transaction.
+
+    The username and email are replaced with a tombstone, so both are free
+    to sign up with again at once rather than once the purge is done.
+    """
+
+    tombstone = f"deleted-{user_id}"
+    db.session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(deleted_at=datetime.utcnow(), username=tombstone, email=tombstone)
+        .execution_options(synchronize_session=False)
+    )
+    return jobs.enqueue("purge_user", user_id=user_id)
+
+
+@jobs.handler("purge_user", max_attempts=10, concurrency=2)
+def purge_user(user_id, chunk_size=PURGE_CHUNK_SIZE):
+    """Delete the next chunk of `user_id`'s rows.
+
+    Returns True while there is more to delete, so the job runs again.
+    """
+
+    for purge in [
+        purge_messages,
+        purge_likes,
+        purge_following,
+        purge_followers,
+        purge_timeline,
+    ]:
+        if purge(user_id, chunk_size):
+            return True
+
+    db.session.execute(delete(User).where(User.id == user_id))
+    return False
+
+
+def purge_messages(user_id, chunk_size):
+    """Delete a chunk of the user's messages, with their likes and timeline rows."""
+
+    ids = db.session.scalars(
+        select(Message.id).where(Message.user_id == user_id).limit(chunk_size)
+    ).all()
+    if not ids:
+        return 0
+
+    # Likes of a deleted account's messages are refused, and likes in flight
+    # when it was deleted committed first (see social.liked_author_id()), so
+    # none can come in between counting these and the cascade deleting them.
+    likes = db.session.execute(
+        select(Likes.user_id, func.count())
+        .where(Likes.message_id.in_(ids))
+        .group_by(Likes.user_id)
+    ).all()
+
+    # Likes and timeline rows go with the messages (ON DELETE CASCADE)
+    db.session.execute(
+        delete(Message)
+        .where(Message.id.in_(ids))
+        .execution_options(synchronize_session=False)
+    )
+
+    likers_by_count = defaultdict(list)
+    for liker_id, count in likes:
+        likers_by_count[count].append(liker_id)
+    for count, liker_ids in likers_by_count.items():
+        User.bump_counters_in(liker_ids, likes_count=-count)
+
+    return len(ids)
+
+
+def purge_likes(user_id, chunk_size):
+    chunk = select(Likes.id).where(Likes.user_id == user_id).limit(chunk_size)
+    message_ids = db.session.scalars(
+        delete(Likes).where(Likes.id.in_(chunk)).returning(Likes.message_id)
+    ).all()
+
+    if message_ids:
+        Message.bump_counters_in(message_ids, likes_count=-1)
+    return len(message_ids)
+
+
+def purge_following(user_id, chunk_size):
+    chunk = (
+        select(Follows.user_being_followed_id)
+        .where(Follows.user_following_id == user_id)
+        .limit(chunk_size)
+    )
+    followed_ids = db.session.scalars(
+        delete(Follows)
+        .where(Follows.user_following_id == user_id)
+        .where(Follows.user_being_followed_id.in_(chunk))
+        .returning(Follows.user_being_followed_id)
+    ).all()
+
+    if followed_ids:
+        User.bump_counters_in(followed_ids, followers_count=-1)
+        FollowChange.record(user_id, followed_ids, following=False)
+    return len(followed_ids)
+
+
+def purge_followers(user_id, chunk_size):
+    chunk = (
+        select(Follows.user_following_id)
+        .where(Follows.user_being_followed_id == user_id)
+        .limit(chunk_size)
+    )
+    follower_ids = db.session.scalars(
+        delete(Follows)
+        .where(Follows.user_being_followed_id == user_id)
+        .where(Follows.user_following_id.in_(chunk))
+        .returning(Follows.user_following_id)
+    ).all()
+
+    if follower_ids:
+        User.bump_counters_in(follower_ids, following_count=-1)
+        FollowChange.record_pairs(
+            [(follower_id, user_id) for follower_id in follower_ids], following=False
+        )
+    return len(follower_ids)
+
+
+def purge_timeline(user_id, chunk_size):
+    chunk = (
+        select(TimelineEntry.message_id)
+        .where(TimelineEntry.user_id == user_id)
+        .limit(chunk_size)
+    )
+    return db.session.execute(
+        delete(TimelineEntry)
+        .where(TimelineEntry.user_id == user_id)
+        .where(TimelineEntry.message_id.in_(chunk))
+    ).rowcount
@@ -0,0 +1,321 @@
+"""Versioned JSON API.
+
+    GET    /api/v1/timeline              the logged-in user's home timeline
+    GET    /api/v1/users/<id>            a profile and its stats
+    GET    /api/v1/users/<id>/messages   a user's messages, newest first
+    PUT    /api/v1/users/<id>/follow     follow a user
+    DELETE /api/v1/users/<id>/follow     stop following them
+    PUT    /api/v1/following             follow many users at once
+    DELETE /api/v1/following             stop following many users at once
+    PUT    /api/v1/messages/<id>/like    like a message
+    DELETE /api/v1/messages/<id>/like    take the like back
+
+Clients authenticate with the HTML site's session cookie. Writes are
+idempotent PUTs and DELETEs, which browsers won't send cross-site without a
+CORS preflight.
+
+Lists are paginated like the HTML feeds: pass the `next_cursor` of a page as
+`?before=` to get the next one, and `?limit=` (up to 100) to size it.
+`?fields=id,text` picks the fields of each item, and only the columns behind
+them are loaded. Responses are compact JSON, encoded with orjson when it is
+installed.
+"""
+
+import json
+
+from flask import Blueprint, abort, current_app, g, request
+from sqlalchemy import select
+from sqlalchemy.orm import contains_eager, lazyload, load_only
+from werkzeug.exceptions import HTTPException
+
+from http_cache import cache_policy
+from models import db, Message, User
+from pagination import decode_cursor, paginate
+import social
+import timeline
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+MAX_LIMIT = 100
+MAX_BATCH = 1000
+
+MESSAGE_FIELDS = ("id", "text", "timestamp", "likes_count", "user_id", "user", "liked")
+MESSAGE_COLUMNS = ("id", "text", "timestamp", "likes_count", "user_id")
+AUTHOR_COLUMNS = (User.id, User.username, User.image_url)
+
+USER_FIELDS = (
+    "id",
+    "username",
+    "image_url",
+    "header_image_url",
+    "bio",
+    "location",
+    "messages_count",
+    "following_count",
+    "followers_count",
+    "likes_count",
+)
+
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":"), default=lambda obj: obj.isoformat())
+
+
+def json_response(data, status=200):
+    return current_app.response_class(dumps(data), status, mimetype="application/json")
+
+
+@api.errorhandler(HTTPException)
+def http_error(error):
+    return json_response({"error": error.description}, error.code)
+
+
+def user_exists(user_id):
+    return (
+        db.session.scalar(
+            select(User.id).where(User.id == user_id, User.deleted_at.is_(None))
+        )
+        is not None
+    )
+
+
+def require_login():
+    if not g.user:
+        abort(401, description="Log in first.")
+
+
+##############################################################################
+# Query arguments
+
+
+def requested_fields(allowed):
+    """The `?fields=` asked for, in order; all of `allowed` by default."""
+
+    raw = request.args.get("fields", "")
+    fields = tuple(dict.fromkeys(f.strip() for f in raw.split(",") if f.strip()))
+    if not fields:
+        return allowed
+
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        abort(400, description=f"Unknown fields: {', '.join(unknown)}")
+
+    return fields
+
+
+def page_args():
+    """The `(before, limit)` of a list request; 400 if malformed."""
+
+    before = request.args.get("before")
+    try:
+        before = decode_cursor(before) if before else None
+    except ValueError:
+        abort(400, description="Invalid cursor.")
+
+    limit = request.args.get("limit", MAX_LIMIT, type=int)
+    return before, max(1, min(limit, MAX_LIMIT))
+
+
+##############################################################################
+# Messages
+
+
+def message_query(fields):
+    """Messages loading only the columns `fields` need (and the cursor's).
+
+    Messages by deleted accounts awaiting their purge are left out.
+    """
+
+    columns = {"id", "timestamp"} | {f for f in fields if f in MESSAGE_COLUMNS}
+    query = (
+        Message.query.join(Message.user)
+        .filter(User.deleted_at.is_(None))
+        .options(load_only(*(getattr(Message, column) for column in columns)))
+    )
+
+    if "user" in fields:
+        query = query.options(contains_eager(Message.user).load_only(*AUTHOR_COLUMNS))
+    else:
+        query = query.options(lazyload(Message.user))
+
+    return query
+
+
+def messages_json(page, fields):
+    if "liked" in fields and g.user:
+        g.user.memberships.load_likes(msg.id for msg in page.items)
+
+    def item(msg):
+        data = {}
+        for field in fields:
+            if field == "user":
+                data["user"] = {
+                    "id": msg.user.id,
+                    "username": msg.user.username,
+                    "image_url": msg.user.image_url,
+                }
+            elif field == "liked":
+                data["liked"] = bool(g.user) and g.user.has_liked(msg)
+            else:
+                data[field] = getattr(msg, field)
+        return data
+
+    return {
+        "items": [item(msg) for msg in page.items],
+        "next_cursor": page.next_cursor,
+    }
+
+
+@api.route("/timeline")
+def home_timeline():
+    """The logged-in user's home timeline."""
+
+    require_login()
+    fields = requested_fields(MESSAGE_FIELDS)
+    before, limit = page_args()
+
+    page = timeline.home_timeline(
+        g.user.id, before=before, limit=limit, query=message_query(fields)
+    )
+    return json_response(messages_json(page, fields))
+
+
+@api.route("/users/<int:user_id>/messages")
+@cache_policy("public", max_age=60)
+def user_messages(user_id):
+    """A user's messages, newest first."""
+
+    fields = requested_fields(MESSAGE_FIELDS)
+    before, limit = page_args()
+
+    page = paginate(
+        message_query(fields).filter(Message.user_id == user_id),
+        Message.timestamp,
+        Message.id,
+        before=before,
+        limit=limit,
+    )
+
+    if not page.items and not user_exists(user_id):
+        abort(404, description="No such user.")
+
+    return json_response(messages_json(page, fields))
+
+
+@api.route("/messages/<int:message_id>/like", methods=["PUT", "DELETE"])
+def like(message_id):
+    """Like (PUT) or unlike (DELETE) a message."""
+
+    require_login()
+
+    author_id = social.liked_author_id(message_id)
+    if author_id is None:
+        abort(404, description="No such message.")
+    if author_id == g.user.id:
+        abort(403, description="You can't like your own messages.")
+
+    liked = request.method == "PUT"
+    if liked:
+        likes_count = social.like(g.user.id, message_id)
+    else:
+        likes_count = social.unlike(g.user.id, message_id)
+    db.session.commit()
+
+    return json_response(
+        {"message_id": message_id, "liked": liked, "likes_count": likes_count}
+    )
+
+
+##############################################################################
+# Users
+
+
+@api.route("/users/<int:user_id>")
+@cache_policy("public", max_age=60)
+def user(user_id):
+    """A user's profile and stats."""
+
+    fields = requested_fields(USER_FIELDS)
+
+    row = db.session.execute(
+        select(*(getattr(User, field) for field in fields)).where(
+            User.id == user_id, User.deleted_at.is_(None)
+        )
+    ).first()
+    if row is None:
+        abort(404, description="No such user.")
+
+    return json_response(row._asdict())
+
+
+@api.route("/users/<int:user_id>/follow", methods=["PUT", "DELETE"])
+def follow(user_id):
+    """Follow (PUT) or stop following (DELETE) a user."""
+
+    require_login()
+
+    if user_id == g.user.id:
+        abort(400, description="You can't follow yourself.")
+    if not user_exists(user_id):
+        abort(404, description="No such user.")
+
+    following = request.method == "PUT"
+    if following:
+        social.follow(g.user.id, user_id)
+    else:
+        social.unfollow(g.user.id, user_id)
+
+    followers_count = db.session.scalar(
+        select(User.followers_count).where(User.id == user_id)
+    )
+    db.session.commit()
+
+    return json_response(
+        {"user_id": user_id, "following": following, "followers_count": followers_count}
+    )
+
+
+@api.route("/following", methods=["PUT", "DELETE"])
+def follow_many():
+    """Follow (PUT) or stop following (DELETE) many users at once.
+
+    Takes `{"user_ids": [...]}` (up to MAX_BATCH ids) and responds with the
+    ids whose follow changed. Unknown ids are ignored.
+    """
+
+    require_login()
+
+    body = request.get_json(silent=True)
+    user_ids = body.get("user_ids") if isinstance(body, dict) else None
+    if not isinstance(user_ids, list) or not all(
+        type(user_id) is int for user_id in user_ids
+    ):
+        abort(400, description='Send {"user_ids": [...]}.')
+    if len(user_ids) > MAX_BATCH:
+        abort(400, description=f"At most {MAX_BATCH} users at a time.")
+
+    following = request.method == "PUT"
+    if following:
+        changed = social.follow_many(g.user.id, user_ids)
+    else:
+        changed = social.unfollow_many(g.user.id, user_ids)
+
+    following_count = db.session.scalar(
+        select(User.following_count).where(User.id == g.user.id)
+    )
+    db.session.commit()
+
+    return json_response(
+        {
+            "following": following,
+            "changed": sorted(changed),
+            "following_count": following_count,
+        }
+    )
@@ -1,14 +1,36 @@
 import os
 
+import click
 from flask import Flask, render_template, request, flash, redirect, session, g, abort
+from flask import Response, jsonify, url_for
 from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy import delete, select
 from sqlalchemy.exc import IntegrityError
 
+from api import api
 from forms import UserAddForm, LoginForm, MessageForm, EditForm
-from models import db, connect_db, User, Message
+from hashing import hasher, HasherBusy
+from http_cache import cache_policy
+from models import db, connect_db, feed_query, followers_query, following_query
+from models import User, Message, Follows, Likes
+from pagination import decode_cursor, decode_rank_cursor, paginate
+import accounts
+import current_user
+import follow_graph
+import fragments
+import http_cache
+import instrumentation
+import jobs
+import recommendations
+import search
+import social
+import timeline
 
 CURR_USER_KEY = "curr_user"
 
+# Users per page of the following/followers lists.
+FOLLOW_PAGE_SIZE = 60
+
 app = Flask(__name__)
 
 # Get DB_URI from environ variable (useful for production/testing) or,
@@ -21,9 +43,59 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["SQLALCHEMY_ECHO"] = False
 app.config["DEBUG_TB_INTERCEPT_REDIRECTS"] = False
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "it's a secret")
+
+# Accounts with more followers than this are merged into home timelines when
+# they are read rather than fanned out to every follower when they post.
+app.config["TIMELINE_CELEBRITY_THRESHOLD"] = int(
+    os.environ.get("TIMELINE_CELEBRITY_THRESHOLD", 10000)
+)
+app.config["TIMELINE_BACKFILL_LIMIT"] = 100
+
+# Messages by accounts with more followers than this are fanned out by a
+# background job (`flask worker`) rather than in the posting request.
+app.config["TIMELINE_INLINE_FAN_OUT"] = int(
+    os.environ.get("TIMELINE_INLINE_FAN_OUT", 1000)
+)
+
+# Statements slower than this are logged with their normalized SQL.
+app.config["SLOW_QUERY_THRESHOLD_MS"] = int(
+    os.environ.get("SLOW_QUERY_THRESHOLD_MS", 100)
+)
+
+# Who may read /_metrics: logged-in users with these usernames, or any
+# client (such as a Prometheus scraper) sending "Authorization: Bearer
+# <METRICS_TOKEN>".
+app.config["ADMIN_USERNAMES"] = set(
+    filter(None, os.environ.get("ADMIN_USERNAMES", "").split(","))
+)
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+
+# Password hashing runs in a pool of PASSWORD_HASH_WORKERS processes (one
+# per CPU by default; 0 hashes inline). See hashing.py.
+app.config["BCRYPT_LOG_ROUNDS"] = int(os.environ.get("BCRYPT_LOG_ROUNDS", 12))
+if "PASSWORD_HASH_WORKERS" in os.environ:
+    app.config["PASSWORD_HASH_WORKERS"] = int(os.environ["PASSWORD_HASH_WORKERS"])
+hasher.init_app(app)
+
+# A follow graph snapshot (see follow_graph.py) to answer follow checks from
+# memory, and how often (seconds) to poll the change log to keep it current.
+app.config["FOLLOW_GRAPH_PATH"] = os.environ.get("FOLLOW_GRAPH_PATH")
+app.config["FOLLOW_GRAPH_REFRESH_INTERVAL"] = float(
+    os.environ.get("FOLLOW_GRAPH_REFRESH_INTERVAL", follow_graph.REFRESH_INTERVAL)
+)
+
+# How long (seconds) the logged-in user's profile may be served from cache.
+app.config["USER_CACHE_TTL"] = int(os.environ.get("USER_CACHE_TTL", 60))
+current_user.cache.ttl = app.config["USER_CACHE_TTL"]
+app.jinja_env.globals["message_card"] = fragments.message_card
+
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+instrumentation.init_app(app)
+http_cache.init_app(app)
+follow_graph.init_app(app)
+app.register_blueprint(api)
 
 
 ##############################################################################
@@ -32,15 +104,85 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    The user's profile comes from a short-lived cache; the full User row is
+    only loaded if the request needs more than the profile. Requests that
+    change something read it from the database, so an account deleted (or
+    changed) in another process can't act on a stale cached profile.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = current_user.load(
+            session[CURR_USER_KEY], fresh=request.method not in ("GET", "HEAD")
+        )
 
     else:
         g.user = None
 
 
+def get_cursor():
+    """Decode the `?before=` pagination cursor, if any; 400 if malformed."""
+
+    before = request.args.get("before")
+
+    if not before:
+        return None
+
+    try:
+        return decode_cursor(before)
+    except ValueError:
+        abort(400)
+
+
+def get_user_or_404(user_id):
+    """The user `user_id`; 404 if there is none or the account was deleted."""
+
+    user = db.session.get(User, user_id)
+    if user is None or user.deleted_at is not None:
+        abort(404)
+    return user
+
+
+def profile_page_version(user_id, before):
+    """What an anonymous view of a profile page is built from.
+
+    The user's profile version and counters, and the id and like count of
+    each message on the page; 404 if there is no such user.
+    """
+
+    user = db.session.execute(
+        select(
+            User.id,
+            User.profile_version,
+            User.messages_count,
+            User.following_count,
+            User.followers_count,
+            User.likes_count,
+        ).where(User.id == user_id, User.deleted_at.is_(None))
+    ).first()
+
+    if user is None:
+        abort(404)
+
+    page = paginate(
+        db.session.query(Message.id, Message.timestamp, Message.likes_count).filter(
+            Message.user_id == user_id
+        ),
+        Message.timestamp,
+        Message.id,
+        before=before,
+    )
+    return tuple(user), [(msg.id, msg.likes_count) for msg in page.items]
+
+
+def load_viewer_likes(messages):
+    """Look up in one query which of `messages` the logged-in user liked."""
+
+    if g.user:
+        g.user.memberships.load_likes(msg.id for msg in messages)
+
+
 def do_login(user):
     """Log in user."""
 
@@ -55,6 +197,7 @@ def do_logout():
 
 
 @app.route("/signup", methods=["GET", "POST"])
+@cache_policy("no-store")
 def signup():
     """Handle user signup.
 
@@ -91,6 +234,7 @@ def signup():
 
 
 @app.route("/login", methods=["GET", "POST"])
+@cache_policy("no-store")
 def login():
     """Handle user login."""
 
@@ -100,6 +244,8 @@ def login():
         user = User.authenticate(form.username.data, form.password.data)
 
         if user:
+            # Persist any rehash done by authenticate()
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -127,58 +273,106 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by username, bio or
+    location, with a 'page' param for later pages of results. Without 'q',
+    users are listed by id, a page at a time, using an 'after' param.
     """
 
-    search = request.args.get("q")
+    q = request.args.get("q", "").strip()
 
-    if not search:
-        users = User.query.all()
+    if q:
+        page = request.args.get("page", 1, type=int)
+        users, has_more = search.search_users(q, page)
+        next_url = url_for("list_users", q=q, page=page + 1) if has_more else None
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        after = request.args.get("after", type=int)
+        users, next_after = search.list_users(after)
+        next_url = url_for("list_users", after=next_after) if next_after else None
 
-    return render_template("users/index.html", users=users)
+    return render_template("users/index.html", users=users, next_url=next_url)
 
 
 @app.route("/users/<int:user_id>")
+@cache_policy("public", max_age=60)
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    if not g.user:
+        response = http_cache.not_modified(
+            "users_show", *profile_page_version(user_id, get_cursor())
+        )
+        if response:
+            return response
+
+    user = get_user_or_404(user_id)
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (
-        Message.query.filter(Message.user_id == user_id)
-        .order_by(Message.timestamp.desc())
-        .limit(100)
-        .all()
+    page = paginate(
+        feed_query().filter(Message.user_id == user_id),
+        Message.timestamp,
+        Message.id,
+        before=get_cursor(),
+    )
+    load_viewer_likes(page.items)
+    return render_template(
+        "users/show.html",
+        user=user,
+        messages=page.items,
+        next_cursor=page.next_cursor,
     )
-    return render_template("users/show.html", user=user, messages=messages)
 
 
 @app.route("/users/<int:user_id>/following")
 def show_following(user_id):
-    """Show list of people this user is following."""
+    """Show list of people this user is following.
+
+    Newest follows first, FOLLOW_PAGE_SIZE at a time, with a `?before=`
+    cursor for older pages.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template("users/following.html", user=user)
+    user = get_user_or_404(user_id)
+    page = paginate(
+        following_query(user_id),
+        Follows.created_at,
+        Follows.user_being_followed_id,
+        before=get_cursor(),
+        limit=FOLLOW_PAGE_SIZE,
+    )
+    return render_template(
+        "users/following.html",
+        user=user,
+        users=page.items,
+        next_cursor=page.next_cursor,
+    )
 
 
 @app.route("/users/<int:user_id>/followers")
 def users_followers(user_id):
-    """Show list of followers of this user."""
+    """Show list of followers of this user, paginated like the following list."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template("users/followers.html", user=user)
+    user = get_user_or_404(user_id)
+    page = paginate(
+        followers_query(user_id),
+        Follows.created_at,
+        Follows.user_following_id,
+        before=get_cursor(),
+        limit=FOLLOW_PAGE_SIZE,
+    )
+    return render_template(
+        "users/followers.html",
+        user=user,
+        users=page.items,
+        next_cursor=page.next_cursor,
+    )
 
 
 @app.route("/users/follow/<int:follow_id>", methods=["POST"])
@@ -189,8 +383,8 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    followed_user = get_user_or_404(follow_id)
+    social.follow(g.user.id, followed_user.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -204,13 +398,29 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    social.unfollow(g.user.id, follow_id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
+@app.route("/users/suggestions")
+def show_suggestions():
+    """Show who the logged-in user might want to follow.
+
+    Suggestions are precomputed by `flask compute-suggestions`, so this is
+    one indexed read however big the follow graph is.
+    """
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    return render_template(
+        "users/suggestions.html",
+        users=recommendations.suggestions_for(g.user.id),
+    )
+
+
 @app.route("/users/likes/<int:user_id>", methods=["GET"])
 def show_likes(user_id):
     """Show list of liked warbles on user's page."""
@@ -218,35 +428,63 @@ def show_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template("users/likes.html", user=user, likes=user.likes)
+    user = get_user_or_404(user_id)
+
+    page = paginate(
+        feed_query().join(Likes, Likes.message_id == Message.id).filter(
+            Likes.user_id == user_id
+        ),
+        Message.timestamp,
+        Message.id,
+        before=get_cursor(),
+    )
+    load_viewer_likes(page.items)
+    return render_template(
+        "users/likes.html",
+        user=user,
+        likes=page.items,
+        next_cursor=page.next_cursor,
+    )
+
+
+def wants_json():
+    """Did the client ask for JSON rather than HTML (e.g. an AJAX call)?"""
+
+    best = request.accept_mimetypes.best_match(["text/html", "application/json"])
+    return best == "application/json"
 
 
 @app.route("/users/add_like/<int:message_id>", methods=["POST"])
 def add_like(message_id):
-    """Toggle liked message for the logged-in user."""
+    """Toggle liked message for the logged-in user.
+
+    Responds with JSON (`{"message_id": ..., "liked": ...}`) to clients
+    that accept it, and otherwise redirects to the homepage.
+    """
 
     if not g.user:
+        if wants_json():
+            return jsonify(error="Access unauthorized."), 401
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    liked_message = Message.query.get_or_404(message_id)
-    if liked_message.user_id == g.user.id:
-        return abort(403)
-
-    user_likes = g.user.likes
-
-    if liked_message in user_likes:
-        g.user.likes = [like for like in user_likes if like != liked_message]
-    else:
-        g.user.likes.append(liked_message)
+    author_id = social.liked_author_id(message_id)
+    if author_id is None:
+        abort(404)
+    if author_id == g.user.id:
+        abort(403)
 
+    liked, likes_count = social.toggle_like(g.user.id, message_id)
     db.session.commit()
 
+    if wants_json():
+        return jsonify(message_id=message_id, liked=liked, likes_count=likes_count)
+
     return redirect("/")
 
 
 @app.route("/users/profile", methods=["GET", "POST"])
+@cache_policy("no-store")
 def profile():
     """Update profile for current user."""
 
@@ -254,7 +492,7 @@ def profile():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = g.user
+    user = g.user.instance
     form = EditForm()
 
     if form.is_submitted() and form.validate():
@@ -266,8 +504,10 @@ def profile():
                 form.header_image_url.data or "/static/images/warbler-hero.jpg"
             )
             user.bio = form.bio.data
+            user.profile_version = User.profile_version + 1
 
             db.session.commit()
+            current_user.invalidate(user.id)
             return redirect(f"/users/{user.id}")
 
         flash("Incorrect password, please try again.", "danger")
@@ -277,7 +517,7 @@ def profile():
 
 @app.route("/users/delete", methods=["POST"])
 def delete_user():
-    """Delete user."""
+    """Delete user, in the background (see accounts.py)."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
@@ -285,8 +525,10 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # Their messages, likes and follows are deleted by a background job
+    accounts.delete_user(g.user.id)
     db.session.commit()
+    current_user.invalidate(g.user.id)
 
     return redirect("/signup")
 
@@ -296,6 +538,7 @@ def delete_user():
 
 
 @app.route("/messages/new", methods=["GET", "POST"])
+@cache_policy("no-store")
 def messages_add():
     """Add a message:
 
@@ -311,6 +554,9 @@ def messages_add():
     if form.is_submitted() and form.validate():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        User.bump_counters(g.user.id, messages_count=1)
+        db.session.flush()
+        timeline.fan_out(msg)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -318,11 +564,51 @@ def messages_add():
     return render_template("messages/new.html", form=form)
 
 
+@app.route("/messages/search")
+def messages_search():
+    """Search warbles by text.
+
+    Takes a 'q' param; later pages of results use an 'after' cursor.
+    """
+
+    q = request.args.get("q", "").strip()
+    after = request.args.get("after")
+
+    try:
+        after = decode_rank_cursor(after) if after else None
+    except ValueError:
+        abort(400)
+
+    page = search.search_messages(q, after=after)
+
+    return render_template(
+        "messages/search.html",
+        q=q,
+        messages=page.items,
+        next_cursor=page.next_cursor,
+    )
+
+
 @app.route("/messages/<int:message_id>", methods=["GET"])
+@cache_policy("public", max_age=300)
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    if not g.user:
+        # Messages never change; only their author's profile can.
+        author_version = db.session.scalar(
+            select(User.profile_version)
+            .join(Message, Message.user_id == User.id)
+            .where(Message.id == message_id, User.deleted_at.is_(None))
+        )
+        if author_version is None:
+            abort(404)
+
+        response = http_cache.not_modified("messages_show", message_id, author_version)
+        if response:
+            return response
+
+    msg = feed_query().filter(Message.id == message_id).first_or_404()
     return render_template("messages/show.html", message=msg)
 
 
@@ -334,7 +620,22 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
+    msg = db.get_or_404(Message, message_id)
+
+    if msg.user_id != g.user.id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    # Deleted here rather than by the cascade, to know whose counts to fix
+    liker_ids = db.session.scalars(
+        delete(Likes).where(Likes.message_id == msg.id).returning(Likes.user_id)
+    ).all()
+    if liker_ids:
+        User.bump_counters_in(liker_ids, likes_count=-1)
+
+    timeline.remove_message(msg.id)
+    fragments.invalidate(msg)
+    User.bump_counters(msg.user_id, messages_count=-1)
     db.session.delete(msg)
     db.session.commit()
 
@@ -346,45 +647,134 @@ def messages_destroy(message_id):
 
 
 @app.route("/")
+@cache_policy("public", max_age=300)
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, with a
+      `?before=` cursor for older pages
     """
 
     if g.user:
-        following_ids = [f.id for f in g.user.following] + [g.user.id]
+        page = timeline.home_timeline(g.user.id, before=get_cursor(), limit=100)
+        load_viewer_likes(page.items)
 
-        messages = (
-            Message.query.filter(Message.user_id.in_(following_ids))
-            .order_by(Message.timestamp.desc())
-            .limit(100)
-            .all()
+        return render_template(
+            "home.html",
+            messages=page.items,
+            next_cursor=page.next_cursor,
         )
 
-        liked_msg_ids = [msg.id for msg in g.user.likes]
-
-        return render_template("home.html", messages=messages, likes=liked_msg_ids)
-
     else:
+        response = http_cache.not_modified("home-anon")
+        if response:
+            return response
+
         return render_template("home-anon.html")
 
 
+@app.errorhandler(HasherBusy)
+def hasher_busy(error):
+    """Shed load when too many password hashes are already queued."""
+
+    return (
+        "Warbler is busy right now. Please try again in a moment.",
+        503,
+        {"Retry-After": str(error.retry_after)},
+    )
+
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers["Cache-Control"] = "public, max-age=0"
-    return req
+# Admin and maintenance
+
+
+def is_admin():
+    """May the current request use admin-only endpoints?"""
+
+    token = app.config["METRICS_TOKEN"]
+    if token and request.headers.get("Authorization") == f"Bearer {token}":
+        return True
+
+    return bool(g.user) and g.user.username in app.config["ADMIN_USERNAMES"]
+
+
+@app.route("/_metrics")
+@cache_policy("no-store")
+def metrics():
+    """Request metrics in the Prometheus text format (admins only)."""
+
+    if not is_admin():
+        abort(403)
+
+    return Response(
+        instrumentation.render_metrics(),
+        mimetype="text/plain; version=0.0.4",
+    )
+
+
+##############################################################################
+# Maintenance commands
+
+
+@app.cli.command("backfill-timelines")
+@click.option("--batch-size", default=1000, help="Timeline owners per transaction.")
+def backfill_timelines(batch_size):
+    """Rebuild every home timeline from existing follows and messages."""
+
+    written = timeline.rebuild(batch_size=batch_size)
+    click.echo(f"Wrote {written} timeline entries.")
+
+
+@app.cli.command("compute-suggestions")
+@click.option("--stale", is_flag=True, help="Only users whose follows changed.")
+@click.option("--batch-size", default=1000, help="Users per transaction.")
+def compute_suggestions(stale, batch_size):
+    """Recompute who-to-follow suggestions."""
+
+    if stale:
+        done = recommendations.refresh_stale()
+    else:
+        done = recommendations.rebuild(batch_size=batch_size)
+    click.echo(f"Computed suggestions for {done} users.")
+
+
+@app.cli.command("snapshot-follow-graph")
+@click.argument("path", required=False)
+def snapshot_follow_graph(path):
+    """Write a follow graph snapshot and prune the follow change log."""
+
+    path = path or app.config["FOLLOW_GRAPH_PATH"]
+    if not path:
+        raise click.UsageError("Give a PATH or set FOLLOW_GRAPH_PATH.")
+
+    written = follow_graph.write_snapshot(path)
+    pruned = follow_graph.prune_changes()
+    db.session.commit()
+    click.echo(f"Wrote {written} follows to {path}; pruned {pruned} changes.")
+
+
+@app.cli.command("worker")
+@click.option("--poll-interval", default=1.0, help="Seconds to wait when idle.")
+@click.option("--kind", "kinds", multiple=True, help="Only run jobs of this kind.")
+@click.option("--once", is_flag=True, help="Exit when no jobs are due.")
+def worker(poll_interval, kinds, once):
+    """Run queued background jobs."""
+
+    if once:
+        ran = jobs.run_pending(kinds=kinds)
+        click.echo(f"Ran {ran} jobs.")
+    else:
+        jobs.work(poll_interval=poll_interval, kinds=kinds)
+
+
+@app.cli.command("reconcile-counters")
+@click.option("--batch-size", default=10000, help="Users checked per UPDATE.")
+def reconcile_counters(batch_size):
+    """Recompute user stats and message like counters that have drifted."""
+
+    fixed = User.reconcile_counters(batch_size=batch_size)
+    fixed += Message.reconcile_counters(batch_size=batch_size)
+    db.session.commit()
+    click.echo(f"Fixed {fixed} counters.")
+
@@ -0,0 +1,10 @@
+"""Performance benchmarks for Warbler.
+
+Run them as modules from the project root, e.g.:
+
+    python -m benchmarks.bench_pagination
+
+Each benchmark rebuilds the tables of the database named by the
+BENCH_DATABASE_URL environment variable (default `postgresql:///warbler-bench`),
+so never point it at a database you care about.
+"""
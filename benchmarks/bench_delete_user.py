@@ -0,0 +1,174 @@
+"""Time deleting a prolific account, in the background and in one transaction.
+
+    python -m benchmarks.bench_delete_user --messages 1000000 --followers 5000
+
+Seeds user 1 with --messages messages, --followers followers, --likes likes
+of their messages by other users, and a timeline page of their messages
+for each follower. Then reports how long the delete request takes, how
+long the queued purge takes in all and its longest single run (the
+longest any one transaction holds row locks), and, on a fresh copy of the
+same data, how long a single cascading DELETE of the user takes.
+"""
+
+import argparse
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import delete, func, select
+
+from benchmarks.common import app, print_table, reset_db, seed_users
+from app import CURR_USER_KEY
+from models import db, Follows, Likes, Message, TimelineEntry, User
+import bulk_import
+import jobs
+
+BATCH_SIZE = 100000
+
+
+def seed(args):
+    """Seed the account to delete, user 1; return the number of rows it owns."""
+
+    reset_db()
+    seed_users(args.followers + 1)
+
+    start = datetime(2020, 1, 1)
+
+    conn = db.session.connection()
+    for low in range(0, args.messages, BATCH_SIZE):
+        high = min(low + BATCH_SIZE, args.messages)
+        bulk_import.insert_rows(
+            conn,
+            Message.__table__,
+            ["text", "timestamp", "user_id"],
+            [
+                (f"Benchmark warble {i}", start + timedelta(minutes=i), 1)
+                for i in range(low, high)
+            ],
+        )
+    db.session.commit()
+
+    message_ids = np.array(
+        db.session.scalars(select(Message.id).order_by(Message.id)).all()
+    )
+    followers = range(2, args.followers + 2)
+    conn = db.session.connection()
+
+    bulk_import.insert_rows(
+        conn,
+        Follows.__table__,
+        ["user_following_id", "user_being_followed_id"],
+        [(follower, 1) for follower in followers],
+    )
+
+    # Distinct (user, message) pairs, as the unique constraint requires
+    rng = np.random.default_rng(0)
+    pairs = rng.choice(args.followers * len(message_ids), args.likes, replace=False)
+    bulk_import.insert_rows(
+        conn,
+        Likes.__table__,
+        ["user_id", "message_id"],
+        zip(
+            (pairs // len(message_ids) + 2).tolist(),
+            message_ids[pairs % len(message_ids)].tolist(),
+        ),
+    )
+
+    latest = db.session.execute(
+        select(Message.id, Message.timestamp)
+        .order_by(Message.timestamp.desc())
+        .limit(100)
+    ).all()
+    bulk_import.insert_rows(
+        conn,
+        TimelineEntry.__table__,
+        ["user_id", "message_id", "author_id", "timestamp"],
+        [
+            (follower, message_id, 1, timestamp)
+            for follower in followers
+            for message_id, timestamp in latest
+        ],
+    )
+    db.session.commit()
+
+    return (
+        len(message_ids) + args.followers + args.likes + args.followers * len(latest)
+    )
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def purge():
+    """Run the queued purge; return each run's time in seconds."""
+
+    runs = []
+    run = jobs.run
+
+    def timed_run(job):
+        runs.append(timed(lambda: run(job)))
+
+    jobs.run = timed_run
+    try:
+        jobs.run_pending()
+    finally:
+        jobs.run = run
+
+    return runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--followers", type=int, default=5000)
+    parser.add_argument("--likes", type=int, default=200000)
+    args = parser.parse_args()
+
+    rows = seed(args)
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = 1
+
+    request_s = timed(lambda: client.post("/users/delete"))
+    runs = purge()
+    assert db.session.scalar(select(func.count()).select_from(Message)) == 0
+
+    seed(args)
+
+    def delete_at_once():
+        db.session.execute(delete(User).where(User.id == 1))
+        db.session.commit()
+
+    cascade_s = timed(delete_at_once)
+
+    print(
+        f"user 1 owns {rows} rows: {args.messages} messages, "
+        f"{args.followers} followers, {args.likes} likes of their messages"
+    )
+    print_table(
+        ("delete", "request ms", "total s", "runs", "longest run ms"),
+        [
+            (
+                "soft delete + purge job",
+                f"{request_s * 1000:.1f}",
+                f"{sum(runs):.1f}",
+                len(runs),
+                f"{max(runs) * 1000:.0f}",
+            ),
+            (
+                "one cascading DELETE",
+                f"{cascade_s * 1000:.0f}",
+                f"{cascade_s:.1f}",
+                1,
+                f"{cascade_s * 1000:.0f}",
+            ),
+        ],
+    )
+
+
+if __name__ == "__main__":
+    main()
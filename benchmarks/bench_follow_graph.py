@@ -0,0 +1,82 @@
+"""Compare follow checks from the database with a follow graph snapshot.
+
+    python -m benchmarks.bench_follow_graph --users 50000 --follows 20
+
+Seeds a skewed follow graph (as bench_recommendations does), writes a
+snapshot, then reports the median time to get a popular user's following
+and follower ids and to answer one "does A follow B?" check, from
+`Memberships` (one query each) and from a `FollowIndex`.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks.bench_recommendations import seed_follows
+from benchmarks.common import print_table, reset_db, seed_users, time_call
+from follow_graph import FollowIndex
+from models import db, Memberships
+import follow_graph
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--follows", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    reset_db()
+    seed_users(args.users)
+    edges = seed_follows(args.users, args.follows)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "follows.graph")
+
+        start = time.perf_counter()
+        follow_graph.write_snapshot(path)
+        snapshot_ms = (time.perf_counter() - start) * 1000
+        size_mib = os.path.getsize(path) / 2**20
+
+        start = time.perf_counter()
+        index = FollowIndex(path)
+        open_ms = (time.perf_counter() - start) * 1000
+
+        # User 1 is the most followed; user 2 follows about --follows users.
+        def from_db(check):
+            def run():
+                check(Memberships(1), Memberships(2))
+                db.session.remove()
+
+            return time_call(run, args.repeat)
+
+        def from_index(check):
+            Memberships.graph = index
+            try:
+                return time_call(
+                    lambda: check(Memberships(1), Memberships(2)), args.repeat
+                )
+            finally:
+                Memberships.graph = None
+
+        checks = [
+            ("follower ids of user 1", lambda one, two: one.follower_ids),
+            ("following ids of user 2", lambda one, two: two.following_ids),
+            ("does 2 follow 1?", lambda one, two: two.follows(1)),
+        ]
+        rows = [
+            (name, f"{from_db(check):.3f}", f"{from_index(check):.3f}")
+            for name, check in checks
+        ]
+
+    print(f"{args.users} users, {edges} follows")
+    print(
+        f"snapshot: written in {snapshot_ms:.0f} ms, {size_mib:.1f} MiB, "
+        f"opened in {open_ms:.2f} ms"
+    )
+    print_table(("check", "database ms", "index ms"), rows)
+
+
+if __name__ == "__main__":
+    main()
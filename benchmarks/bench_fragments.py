@@ -0,0 +1,66 @@
+"""Compare feed render time with and without the message card cache.
+
+    python -m benchmarks.bench_fragments --messages 100
+
+Renders a profile page of --messages messages (its first page holds up to
+100 cards) as another logged-in user, first with the fragment cache
+disabled, then with a warm cache.
+"""
+
+import argparse
+
+from benchmarks.common import app, print_table, reset_db, time_call
+from benchmarks.common import seed_messages, seed_users
+from app import CURR_USER_KEY
+from cache import LRUCache
+import fragments
+import instrumentation
+
+
+def render_ms(client, url, repeat):
+    """Median request time and mean template render time, in ms."""
+
+    histogram = instrumentation.request_render_time
+    before = dict(histogram._series.get(("users_show",), {"sum": 0, "count": 0}))
+
+    request_ms = time_call(lambda: client.get(url), repeat)
+
+    after = histogram._series[("users_show",)]
+    render = (after["sum"] - before["sum"]) / (after["count"] - before["count"])
+    return request_ms, render * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    reset_db()
+    seed_users(2)
+    seed_messages(1, args.messages)
+
+    cache = fragments.cache
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session[CURR_USER_KEY] = 2
+
+    rows = []
+    for name, backend in [
+        ("uncached", LRUCache("fragments", ttl=0)),
+        ("cached", cache),
+    ]:
+        fragments.cache = backend
+        client.get("/users/1")  # warm up
+        request, render = render_ms(client, "/users/1", args.repeat)
+        rows.append((name, f"{request:.2f}", f"{render:.2f}"))
+
+    fragments.cache = cache
+
+    print(f"/users/1 with {min(args.messages, 100)} cards (ms)")
+    print_table(("cards", "request", "render"), rows)
+    print(f"card cache hit rate: {cache.hit_rate():.1%}")
+
+
+if __name__ == "__main__":
+    main()
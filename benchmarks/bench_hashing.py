@@ -0,0 +1,87 @@
+"""Login throughput with password hashing inline vs in the hashing pool.
+
+    python -m benchmarks.bench_hashing --clients 16 --logins 200
+
+Each client is a thread posting to /login with its own test client, like
+concurrent requests to a threaded server. "inline" checks passwords on the
+request thread (as the app used to); "pool" hands them to hashing.py's
+process pool. Refused logins (503) are counted separately.
+"""
+
+import argparse
+import os
+import threading
+import time
+
+from benchmarks.common import print_table, reset_db, seed_users
+from app import app
+from hashing import hasher
+
+
+def run_logins(clients, logins):
+    """Post `logins` logins from `clients` threads; return (seconds, counts)."""
+
+    counts = {}
+    lock = threading.Lock()
+    per_client = logins // clients
+
+    def client(n):
+        with app.test_client() as c:
+            for i in range(per_client):
+                resp = c.post(
+                    "/login",
+                    data={"username": f"user{n + 1}", "password": "password"},
+                )
+                with lock:
+                    counts[resp.status_code] = counts.get(resp.status_code, 0) + 1
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return time.perf_counter() - start, counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    reset_db()
+    seed_users(args.clients)
+
+    cores = os.cpu_count()
+    modes = [
+        ("inline", dict(workers=0, max_pending=args.clients)),
+        ("pool", dict(workers=args.workers)),
+    ]
+
+    rows = []
+    for name, options in modes:
+        hasher.configure(rounds=12, **options)
+        hasher.check(hasher.hash("warm-up"), "warm-up")
+
+        seconds, counts = run_logins(args.clients, args.logins)
+        ok = counts.get(302, 0)
+        rows.append(
+            (
+                name,
+                ok,
+                counts.get(503, 0),
+                f"{ok / seconds:.1f}",
+                f"{ok / seconds / cores:.1f}",
+            )
+        )
+
+    print(f"{args.clients} clients, {cores} cores, bcrypt cost 12")
+    print_table(("mode", "logins", "refused", "per sec", "per sec/core"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,366 @@
+"""Load-test the main Warbler routes with concurrent simulated users.
+
+    python -m benchmarks.bench_load --users 10000 --clients 16 --output run.json
+    python -m benchmarks.bench_load --no-seed --baseline run.json
+
+The database is seeded with generator/create_csvs.py at the requested scale
+(unless --no-seed). Each simulated user logs in as a random seeded user and
+makes --requests requests, picking routes with the weights in ACTIONS. With
+--transport client they go through the Flask test client; with --transport
+server, over HTTP to a threaded WSGI server running the app.
+
+The report is JSON: per endpoint and overall, the number of requests and
+errors, latency percentiles (ms), throughput and SQL queries per request
+(from the `warbler.requests` log, see instrumentation.py). With --baseline,
+the run is compared with an earlier report and the exit status is 1 if any
+endpoint got slower than --tolerance allows or runs more queries.
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import nullcontext
+from urllib.parse import urlencode
+
+import numpy as np
+from sqlalchemy import func, select
+
+from benchmarks.common import app
+from app import CURR_USER_KEY
+from models import db, Message, User
+import instrumentation
+import seed
+
+GENERATOR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "generator",
+    "create_csvs.py",
+)
+
+# (endpoint, weight): how often a simulated user takes each action.
+ACTIONS = [
+    ("homepage", 30),
+    ("users_show", 20),
+    ("list_users", 10),
+    ("show_following", 15),
+    ("add_like", 15),
+    ("messages_add", 10),
+]
+
+
+##############################################################################
+# Transports
+
+
+class ClientTransport:
+    """Requests through a Flask test client, logged in as `user_id`."""
+
+    def __init__(self, user_id):
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = user_id
+
+    def request(self, method, path, data=None):
+        return self.client.open(path, method=method, data=data).status_code
+
+    def close(self):
+        pass
+
+
+class HTTPTransport:
+    """Requests over HTTP to `server`, logged in as `user_id`."""
+
+    def __init__(self, server, user_id):
+        self.host, self.port = server.host, server.port
+        serializer = app.session_interface.get_signing_serializer(app)
+        cookie = serializer.dumps({CURR_USER_KEY: user_id})
+        self.headers = {"Cookie": f"{app.config['SESSION_COOKIE_NAME']}={cookie}"}
+
+    def request(self, method, path, data=None):
+        headers = dict(self.headers)
+        body = None
+
+        if data is not None:
+            body = urlencode(data)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+        conn = http.client.HTTPConnection(self.host, self.port)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            return response.status
+        finally:
+            conn.close()
+
+    def close(self):
+        pass
+
+
+class Server:
+    """The app served by a threaded WSGI server in a background thread."""
+
+    def __init__(self):
+        from werkzeug.serving import make_server
+
+        # The per-request access log would swamp the report.
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+        self.server = make_server("127.0.0.1", 0, app, threaded=True)
+        self.host, self.port = "127.0.0.1", self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.thread.join()
+
+
+##############################################################################
+# Running
+
+
+class RequestLog(logging.Handler):
+    """Collects the per-request records written by instrumentation.py."""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(json.loads(record.getMessage()))
+
+
+def simulated_user(transport, rng, requests, counts, samples):
+    endpoints, weights = zip(*ACTIONS)
+
+    for endpoint in rng.choices(endpoints, weights, k=requests):
+        user_id = rng.randint(1, counts["users"])
+
+        if endpoint == "homepage":
+            request = ("GET", "/", None)
+        elif endpoint == "users_show":
+            request = ("GET", f"/users/{user_id}", None)
+        elif endpoint == "list_users":
+            request = ("GET", "/users", None)
+        elif endpoint == "show_following":
+            request = ("GET", f"/users/{user_id}/following", None)
+        elif endpoint == "add_like":
+            message_id = rng.randint(1, counts["messages"])
+            request = ("POST", f"/users/add_like/{message_id}", None)
+        else:
+            request = ("POST", "/messages/new", {"text": "Load test warble"})
+
+        start = time.perf_counter()
+        status = transport.request(*request)
+        samples.append((endpoint, time.perf_counter() - start, status < 400))
+
+    transport.close()
+
+
+def run(options):
+    """Drive the app; return a list of (endpoint, seconds, ok) and the time."""
+
+    counts = {
+        "users": db.session.scalar(select(func.max(User.id))) or 1,
+        "messages": db.session.scalar(select(func.max(Message.id))) or 1,
+    }
+    db.session.remove()
+
+    samples = []
+    server = Server() if options.transport == "server" else None
+
+    def transport_for(user_id):
+        if server is None:
+            return ClientTransport(user_id)
+        return HTTPTransport(server, user_id)
+
+    def client(n):
+        rng = random.Random(options.seed * 100003 + n)
+        with app.app_context():
+            transport = transport_for(rng.randint(1, counts["users"]))
+        simulated_user(transport, rng, options.requests, counts, samples)
+
+    threads = [
+        threading.Thread(target=client, args=(n,)) for n in range(options.clients)
+    ]
+
+    with server or nullcontext():
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+    return samples, elapsed
+
+
+def percentiles(seconds):
+    p50, p95, p99 = np.percentile(np.array(seconds) * 1000, [50, 95, 99])
+    return {
+        "p50_ms": round(float(p50), 2),
+        "p95_ms": round(float(p95), 2),
+        "p99_ms": round(float(p99), 2),
+    }
+
+
+def summarize(samples, elapsed, records):
+    """Build the JSON report."""
+
+    queries = {}
+    for record in records:
+        queries.setdefault(record["endpoint"], []).append(record["queries"])
+
+    def stats(endpoint_samples, endpoint_queries):
+        return {
+            "requests": len(endpoint_samples),
+            "errors": sum(1 for _, _, ok in endpoint_samples if not ok),
+            **percentiles([seconds for _, seconds, _ in endpoint_samples]),
+            "queries_per_request": (
+                round(sum(endpoint_queries) / len(endpoint_queries), 2)
+                if endpoint_queries
+                else None
+            ),
+        }
+
+    endpoints = {}
+    for endpoint, _ in ACTIONS:
+        endpoint_samples = [s for s in samples if s[0] == endpoint]
+        if endpoint_samples:
+            endpoints[endpoint] = stats(endpoint_samples, queries.get(endpoint, []))
+            endpoints[endpoint]["throughput_rps"] = round(
+                len(endpoint_samples) / elapsed, 1
+            )
+
+    total = stats(samples, [q for qs in queries.values() for q in qs])
+    total["seconds"] = round(elapsed, 2)
+    total["throughput_rps"] = round(len(samples) / elapsed, 1)
+
+    return {"endpoints": endpoints, "total": total}
+
+
+def compare(report, baseline, tolerance):
+    """Return a list of regressions of `report` against `baseline`."""
+
+    regressions = []
+
+    for endpoint, current in report["endpoints"].items():
+        before = baseline["endpoints"].get(endpoint)
+        if before is None:
+            continue
+
+        if current["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{endpoint}: p95 {before['p95_ms']}ms -> {current['p95_ms']}ms"
+            )
+
+        if (
+            current["queries_per_request"] is not None
+            and before["queries_per_request"] is not None
+            and current["queries_per_request"] > before["queries_per_request"] + 0.5
+        ):
+            regressions.append(
+                f"{endpoint}: queries/request {before['queries_per_request']}"
+                f" -> {current['queries_per_request']}"
+            )
+
+    throughput = report["total"]["throughput_rps"]
+    before = baseline["total"]["throughput_rps"]
+    if throughput < before * (1 - tolerance):
+        regressions.append(f"throughput {before} -> {throughput} requests/s")
+
+    return regressions
+
+
+def seed_database(options):
+    with tempfile.TemporaryDirectory() as data_dir:
+        subprocess.run(
+            [
+                sys.executable, GENERATOR,
+                "--users", str(options.users),
+                "--messages", str(options.messages),
+                "--follows", str(options.follows),
+                "--likes", str(options.likes),
+                "--seed", str(options.seed),
+                "--out", data_dir,
+            ],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        seed.seed(data_dir, verbose=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--follows", type=int, default=50000)
+    parser.add_argument("--likes", type=int, default=20000)
+    parser.add_argument("--no-seed", action="store_true",
+                        help="reuse the data already in the database")
+    parser.add_argument("--clients", type=int, default=8,
+                        help="concurrent simulated users")
+    parser.add_argument("--requests", type=int, default=100,
+                        help="requests per simulated user")
+    parser.add_argument("--transport", choices=["client", "server"], default="client")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--baseline", help="compare with this earlier report")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown against the baseline (0.2 = 20%%)")
+    options = parser.parse_args()
+
+    with app.app_context():
+        if not options.no_seed:
+            seed_database(options)
+
+        # Collect request records instead of printing them.
+        logger = instrumentation.request_logger
+        log = RequestLog()
+        saved_handlers, logger.handlers = logger.handlers, [log]
+        try:
+            samples, elapsed = run(options)
+        finally:
+            logger.handlers = saved_handlers
+
+    report = summarize(samples, elapsed, log.records)
+    report["config"] = {
+        key: getattr(options, key)
+        for key in ("users", "messages", "follows", "likes", "clients",
+                    "requests", "transport", "seed")
+    }
+
+    text = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+
+    if options.baseline:
+        with open(options.baseline) as file:
+            regressions = compare(report, json.load(file), options.tolerance)
+
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Compare keyset and OFFSET pagination of a profile feed at increasing depth.
+
+    python -m benchmarks.bench_pagination --messages 1000000
+"""
+
+import argparse
+
+from benchmarks.common import print_table, reset_db, seed_messages, seed_users
+from benchmarks.common import time_call
+from models import Message
+from pagination import paginate
+
+PAGE_SIZE = 100
+
+
+def offset_page(user_id, depth):
+    """Fetch page `depth` of a profile feed with LIMIT/OFFSET."""
+
+    return (
+        Message.query.filter(Message.user_id == user_id)
+        .order_by(Message.timestamp.desc(), Message.id.desc())
+        .offset(depth * PAGE_SIZE)
+        .limit(PAGE_SIZE)
+        .all()
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    reset_db()
+    seed_users(1)
+    seed_messages(1, args.messages)
+
+    query = Message.query.filter(Message.user_id == 1)
+    max_depth = args.messages // PAGE_SIZE - 1
+    depths = sorted({0, 10, 100, 1000, 10000, max_depth})
+    depths = [depth for depth in depths if depth <= max_depth]
+
+    # Walk the cursor chain once to find the cursor that starts each page.
+    cursors = {}
+    page, before = None, None
+    for depth in range(max(depths) + 1):
+        if depth in depths:
+            cursors[depth] = before
+        page = paginate(query, Message.timestamp, Message.id, before=before)
+        before = page.items[-1].timestamp, page.items[-1].id
+
+    rows = []
+    for depth in depths:
+        keyset_ms = time_call(
+            lambda: paginate(
+                query, Message.timestamp, Message.id, before=cursors[depth]
+            ),
+            args.repeat,
+        )
+        offset_ms = time_call(lambda: offset_page(1, depth), args.repeat)
+        rows.append((depth, f"{keyset_ms:.2f}", f"{offset_ms:.2f}"))
+
+    print(f"{args.messages} messages, {PAGE_SIZE} per page (median ms)")
+    print_table(("page", "keyset", "offset"), rows)
+
+
+if __name__ == "__main__":
+    main()
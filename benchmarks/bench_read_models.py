@@ -0,0 +1,87 @@
+"""Compare ORM entities with UserCard read models on a 10k-user listing.
+
+    python -m benchmarks.bench_read_models --users 10000
+
+User 1 follows every other user. For that list of users, reports the median
+time to load it and the peak memory allocated while loading it, first as
+full `User` entities (what /users/<id>/following used to load), then as
+`UserCard`s; then the median time of the whole /users/1/following page.
+"""
+
+import argparse
+import tracemalloc
+
+from sqlalchemy import insert
+
+from benchmarks.common import app, print_table, reset_db, seed_users, time_call
+from app import CURR_USER_KEY
+from models import db, user_card_query, Follows, User
+
+
+def load_entities():
+    users = db.session.get(User, 1).following
+    db.session.remove()
+    return users
+
+
+def load_cards():
+    users = (
+        user_card_query()
+        .join(Follows, Follows.user_being_followed_id == User.id)
+        .filter(Follows.user_following_id == 1)
+        .order_by(User.id)
+        .all()
+    )
+    db.session.remove()
+    return users
+
+
+def peak_kib(fn):
+    """Peak memory allocated while running `fn`, in KiB."""
+
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    reset_db()
+    seed_users(args.users)
+    db.session.execute(
+        insert(Follows),
+        [
+            dict(user_being_followed_id=i, user_following_id=1)
+            for i in range(2, args.users + 1)
+        ],
+    )
+    db.session.commit()
+
+    rows = []
+    for name, load in [("entities", load_entities), ("cards", load_cards)]:
+        load()  # warm up
+        rows.append(
+            (name, f"{time_call(load, args.repeat):.2f}", f"{peak_kib(load):.0f}")
+        )
+
+    print(f"Following list of {args.users - 1} users")
+    print_table(("rows", "ms", "peak KiB"), rows)
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session[CURR_USER_KEY] = 1
+
+    client.get("/users/1/following")
+    page_ms = time_call(lambda: client.get("/users/1/following"), args.repeat)
+    print(f"/users/1/following page: {page_ms:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
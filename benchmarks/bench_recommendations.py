@@ -0,0 +1,105 @@
+"""Time who-to-follow suggestions on a generated follow graph.
+
+    python -m benchmarks.bench_recommendations --users 50000 --follows 20
+
+Seeds `--users` users who each follow about `--follows` others, picked
+with a Zipf-like skew so a few accounts are very popular (close to 1M
+edges by default).
+Reports the time to load the graph into CSR form, to score one user, to
+rebuild every user's suggestions, to serve /users/suggestions, and to
+refresh `--stale` users after they follow someone new.
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.common import app, print_table, reset_db, seed_users, time_call
+from app import CURR_USER_KEY
+from models import db, Follows
+import bulk_import
+import recommendations
+import social
+
+
+def seed_follows(users, follows, batch_size=100000, seed=0):
+    """Make every user follow about `follows` others, favouring low ids."""
+
+    rng = np.random.default_rng(seed)
+    weights = 1 / np.arange(1, users + 1) ** 0.8
+
+    followers = np.repeat(np.arange(1, users + 1), follows)
+    followed = rng.choice(users, size=len(followers), p=weights / weights.sum()) + 1
+
+    # Drop self-follows and repeats, which leaves slightly fewer edges.
+    edges = np.unique(np.stack([followers, followed], axis=1), axis=0)
+    edges = edges[edges[:, 0] != edges[:, 1]].tolist()
+
+    conn = db.session.connection()
+    for low in range(0, len(edges), batch_size):
+        bulk_import.insert_rows(
+            conn,
+            Follows.__table__,
+            ["user_following_id", "user_being_followed_id"],
+            edges[low : low + batch_size],
+        )
+    db.session.commit()
+
+    return len(edges)
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--follows", type=int, default=20)
+    parser.add_argument("--stale", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    reset_db()
+    seed_users(args.users)
+    edges = seed_follows(args.users, args.follows)
+
+    graph, load_ms = timed(recommendations.FollowGraph.load)
+    activity = recommendations.recent_activity(graph.size)
+    score_ms = time_call(
+        lambda: recommendations.suggest(graph, activity, 1), args.repeat
+    )
+    db.session.remove()
+
+    _, rebuild_ms = timed(recommendations.rebuild)
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session[CURR_USER_KEY] = 1
+
+    client.get("/users/suggestions")
+    page_ms = time_call(lambda: client.get("/users/suggestions"), args.repeat)
+
+    for user_id in range(1, args.stale + 1):
+        social.follow(user_id, args.users - user_id)
+    db.session.commit()
+    _, refresh_ms = timed(recommendations.refresh_stale)
+
+    print(f"{args.users} users, {edges} follows")
+    print_table(
+        ("step", "ms"),
+        [
+            ("load graph", f"{load_ms:.0f}"),
+            ("score one user", f"{score_ms:.2f}"),
+            ("rebuild all users", f"{rebuild_ms:.0f}"),
+            ("/users/suggestions", f"{page_ms:.2f}"),
+            (f"refresh {args.stale} stale users", f"{refresh_ms:.0f}"),
+        ],
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""Compare the old LIKE user search with the indexed search in search.py.
+
+    python -m benchmarks.bench_user_search --users 1000000
+"""
+
+import argparse
+
+from benchmarks.common import print_table, reset_db, seed_users, time_call
+from models import db, User
+import search
+
+QUERIES = ["user1234", "user99999", "bio of user 4242", "benchville", "nobody"]
+
+
+def like_search(q):
+    """The search `list_users()` used to run: LIKE over every username."""
+
+    return User.query.filter(User.username.like(f"%{q}%")).all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    reset_db()
+    seed_users(args.users)
+    db.session.execute(db.text("ANALYZE users"))
+    db.session.commit()
+
+    rows = []
+    for q in QUERIES:
+        like_ms = time_call(lambda: like_search(q), args.repeat)
+        indexed_ms = time_call(lambda: search.search_users(q), args.repeat)
+        rows.append((q, f"{like_ms:.2f}", f"{indexed_ms:.2f}"))
+
+    print(f"{args.users} users (median ms)")
+    print_table(("query", "like", "indexed"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Shared setup and reporting helpers for the benchmarks."""
+
+import os
+import statistics
+import time
+from datetime import datetime, timedelta
+
+# As in the tests, the database URL must be set before `app` is imported.
+os.environ["DATABASE_URL"] = os.environ.get(
+    "BENCH_DATABASE_URL", "postgresql:///warbler-bench"
+)
+
+from sqlalchemy import insert
+
+from app import app
+from models import db, Message, User
+
+app.config["WTF_CSRF_ENABLED"] = False
+
+# Every seeded user shares this bcrypt hash of "password".
+PASSWORD_HASH = "$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe"
+
+
+def reset_db():
+    """Drop and recreate every table."""
+
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+
+def seed_users(count, batch_size=10000):
+    """Insert `count` users with ids 1..count."""
+
+    for low in range(1, count + 1, batch_size):
+        high = min(low + batch_size, count + 1)
+        db.session.execute(
+            insert(User),
+            [
+                dict(
+                    id=i,
+                    username=f"user{i}",
+                    email=f"user{i}@example.com",
+                    password=PASSWORD_HASH,
+                    bio=f"Bio of user {i}",
+                    location="Benchville",
+                )
+                for i in range(low, high)
+            ],
+        )
+        db.session.commit()
+
+
+def seed_messages(user_id, count, batch_size=10000):
+    """Insert `count` messages by `user_id`, one minute apart."""
+
+    start = datetime(2020, 1, 1)
+
+    for low in range(0, count, batch_size):
+        high = min(low + batch_size, count)
+        db.session.execute(
+            insert(Message),
+            [
+                dict(
+                    text=f"Benchmark warble {i}",
+                    timestamp=start + timedelta(minutes=i),
+                    user_id=user_id,
+                )
+                for i in range(low, high)
+            ],
+        )
+        db.session.commit()
+
+
+def time_call(fn, repeat=20):
+    """Call `fn` `repeat` times; return the median wall time in milliseconds."""
+
+    samples = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+
+    return statistics.median(samples)
+
+
+def print_table(headers, rows):
+    """Print rows as a fixed-width text table."""
+
+    widths = [
+        max(len(str(cell)) for cell in column) for column in zip(headers, *rows)
+    ]
+    for row in [headers, *rows]:
+        print("  ".join(str(cell).rjust(width) for cell, width in zip(row, widths)))
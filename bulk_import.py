@@ -0,0 +1,284 @@
+"""Stream large CSV files into the database.
+
+`load_csv()` reads one or more CSV files (with a header row naming the
+columns) and inserts them a batch at a time, committing after each batch,
+so memory use depends on the batch size and not on the size of the files.
+On Postgres each batch goes through `COPY ... FROM STDIN`; other databases
+fall back to an executemany INSERT.
+
+Secondary indexes and foreign keys make every inserted row more expensive,
+so `deferred_indexes()` drops them for the duration of a load and rebuilds
+them once at the end, which is much faster. Primary keys stay in place.
+
+    with deferred_indexes(db.engine, [User.__table__]):
+        load_csv(db.engine, User.__table__, ["users.csv"])
+    reset_sequences(db.engine, [User.__table__])
+"""
+
+import csv
+import io
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from itertools import islice
+
+from sqlalchemy import bindparam, text
+
+DEFAULT_BATCH_SIZE = 50000
+
+
+class LoadStats(namedtuple("LoadStats", ["table", "rows", "seconds"])):
+    """How many rows were loaded into `table`, and how long it took."""
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return (
+            f"{self.table}: {self.rows:,} rows in {self.seconds:.1f}s "
+            f"({self.rows_per_second:,.0f} rows/s)"
+        )
+
+
+def read_batches(paths, batch_size=DEFAULT_BATCH_SIZE):
+    """Yield (columns, rows) batches of at most `batch_size` rows.
+
+    Every file must start with the same header row.
+    """
+
+    columns = None
+
+    for path in paths:
+        with open(path, newline="") as file:
+            reader = csv.reader(file)
+            header = next(reader, None)
+
+            if header is None:
+                continue
+            if columns is None:
+                columns = header
+            elif header != columns:
+                raise ValueError(
+                    f"{path}: columns {header} differ from earlier files' {columns}"
+                )
+
+            while True:
+                rows = list(islice(reader, batch_size))
+                if not rows:
+                    break
+                yield columns, rows
+
+
+def load_csv(
+    engine, table, paths, batch_size=DEFAULT_BATCH_SIZE, use_copy=None, progress=None
+):
+    """Load the CSV files at `paths` into `table`; return LoadStats.
+
+    `use_copy` forces COPY on or off (default: on for Postgres). `progress`,
+    if given, is called with the running LoadStats after each batch.
+    """
+
+    if use_copy is None:
+        use_copy = engine.dialect.name == "postgresql"
+
+    insert_batch = _copy_batch if use_copy else _insert_batch
+    rows = 0
+    start = time.perf_counter()
+
+    with engine.connect() as conn:
+        for columns, batch in read_batches(paths, batch_size):
+            with conn.begin():
+                insert_batch(conn, table, columns, batch)
+            rows += len(batch)
+
+            if progress is not None:
+                progress(LoadStats(table.name, rows, time.perf_counter() - start))
+
+    return LoadStats(table.name, rows, time.perf_counter() - start)
+
+
+def insert_rows(conn, table, columns, rows, use_copy=None):
+    """Insert `rows` (sequences of values for `columns`) into `table`.
+
+    Runs in `conn`'s current transaction, with COPY on Postgres unless
+    `use_copy` says otherwise.
+    """
+
+    if use_copy is None:
+        use_copy = conn.dialect.name == "postgresql"
+
+    if use_copy:
+        _copy_batch(conn, table, columns, rows)
+    else:
+        _insert_batch(conn, table, columns, rows)
+
+
+def _column_list(conn, columns):
+    quote = conn.dialect.identifier_preparer.quote
+    return ", ".join(quote(column) for column in columns)
+
+
+def _copy_batch(conn, table, columns, rows):
+    # Empty, unquoted CSV fields are NULL to COPY.
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    sql = (
+        f"COPY {conn.dialect.identifier_preparer.format_table(table)} "
+        f"({_column_list(conn, columns)}) FROM STDIN WITH (FORMAT csv)"
+    )
+
+    # COPY needs the DBAPI (psycopg2) cursor; it runs inside the
+    # transaction begun on `conn`.
+    with conn.connection.cursor() as cursor:
+        cursor.copy_expert(sql, buffer)
+
+
+def _insert_batch(conn, table, columns, rows):
+    params = [f"p{i}" for i in range(len(columns))]
+    sql = text(
+        f"INSERT INTO {conn.dialect.identifier_preparer.format_table(table)} "
+        f"({_column_list(conn, columns)}) "
+        f"VALUES ({', '.join(':' + param for param in params)})"
+    )
+
+    # Match COPY: empty fields are NULL.
+    conn.execute(
+        sql,
+        [
+            {param: value if value != "" else None for param, value in zip(params, row)}
+            for row in rows
+        ],
+    )
+
+
+@contextmanager
+def deferred_indexes(engine, tables):
+    """Drop secondary indexes and foreign keys of `tables`; rebuild on exit.
+
+    Indexes are recreated from the database's own definitions, so indexes
+    made outside SQLAlchemy (e.g. the search indexes) are kept too. SQLite
+    cannot drop foreign keys, but doesn't enforce them by default either.
+    """
+
+    names = [table.name for table in tables]
+
+    with engine.connect() as conn:
+        if engine.dialect.name == "postgresql":
+            restore = _drop_postgres(conn, names)
+        elif engine.dialect.name == "sqlite":
+            restore = _drop_sqlite(conn, names)
+        else:
+            restore = []
+        conn.commit()
+
+    try:
+        yield
+    finally:
+        with engine.connect() as conn:
+            for statement in restore:
+                conn.exec_driver_sql(statement)
+            conn.commit()
+
+
+def _drop_postgres(conn, names):
+    foreign_keys = conn.execute(
+        text(
+            """
+            SELECT conrelid::regclass::text AS tbl, conname,
+                   pg_get_constraintdef(oid) AS definition
+            FROM pg_constraint
+            WHERE contype = 'f' AND conrelid::regclass::text = ANY(:names)
+            """
+        ),
+        {"names": names},
+    ).all()
+
+    indexes = conn.execute(
+        text(
+            """
+            SELECT i.indexname, i.indexdef
+            FROM pg_indexes i
+            WHERE i.schemaname = current_schema()
+              AND i.tablename = ANY(:names)
+              AND NOT EXISTS (
+                  SELECT 1 FROM pg_constraint c
+                  WHERE c.conname = i.indexname
+                    AND c.connamespace = current_schema()::regnamespace
+              )
+            """
+        ),
+        {"names": names},
+    ).all()
+
+    quote = conn.dialect.identifier_preparer.quote
+
+    for fk in foreign_keys:
+        conn.exec_driver_sql(
+            f"ALTER TABLE {fk.tbl} DROP CONSTRAINT {quote(fk.conname)}"
+        )
+    for index in indexes:
+        conn.exec_driver_sql(f"DROP INDEX {quote(index.indexname)}")
+
+    return [index.indexdef for index in indexes] + [
+        f"ALTER TABLE {fk.tbl} ADD CONSTRAINT {quote(fk.conname)} {fk.definition}"
+        for fk in foreign_keys
+    ]
+
+
+def _drop_sqlite(conn, names):
+    indexes = conn.execute(
+        text(
+            "SELECT name, sql FROM sqlite_master "
+            "WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN :names"
+        ).bindparams(bindparam("names", expanding=True)),
+        {"names": names},
+    ).all()
+
+    quote = conn.dialect.identifier_preparer.quote
+
+    for index in indexes:
+        conn.exec_driver_sql(f"DROP INDEX {quote(index.name)}")
+
+    return [index.sql for index in indexes]
+
+
+def reset_sequences(engine, tables):
+    """Point each table's id sequence past its largest id (Postgres only).
+
+    Needed after loading rows with explicit ids, so the next INSERT
+    doesn't reuse one. SQLite works this out by itself.
+    """
+
+    if engine.dialect.name != "postgresql":
+        return
+
+    with engine.connect() as conn:
+        for table in tables:
+            for column in table.primary_key.columns:
+                sequence = conn.scalar(
+                    text("SELECT pg_get_serial_sequence(:table, :column)"),
+                    {"table": table.name, "column": column.name},
+                )
+
+                if sequence is not None:
+                    conn.execute(
+                        text(
+                            "SELECT setval(:sequence, "
+                            f"(SELECT coalesce(max({column.name}), 0) + 1 "
+                            f"FROM {table.name}), false)"
+                        ),
+                        {"sequence": sequence},
+                    )
+        conn.commit()
+
+
+def analyze(engine, tables):
+    """Refresh planner statistics for `tables` after a load."""
+
+    with engine.connect() as conn:
+        for table in tables:
+            conn.exec_driver_sql(f"ANALYZE {table.name}")
+        conn.commit()
@@ -0,0 +1,178 @@
+"""Key-value caches for Warbler.
+
+Every cache has the same small interface (`get`, `set`, `delete`, `clear`)
+so callers can swap the in-process `LRUCache` for a `SharedCache` that
+several processes can see. Each cache counts its hits and misses, locally,
+in the `warbler_cache_requests_total` metric and in the request log.
+"""
+
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from instrumentation import current_stats, registry
+
+cache_requests = registry.counter(
+    "warbler_cache_requests_total",
+    "Cache lookups, by cache and result (hit or miss).",
+    labels=("cache", "result"),
+)
+
+
+class Cache:
+    """Interface shared by every cache backend."""
+
+    def __init__(self, name):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the value stored under `key`, or None."""
+
+        value = self._get(key)
+        stats = current_stats()
+
+        if value is None:
+            self.misses += 1
+            cache_requests.inc(self.name, "miss")
+            if stats is not None:
+                stats.cache_misses += 1
+        else:
+            self.hits += 1
+            cache_requests.inc(self.name, "hit")
+            if stats is not None:
+                stats.cache_hits += 1
+
+        return value
+
+    def hit_rate(self):
+        """Fraction of lookups that were hits (0.0 before any lookups)."""
+
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        """Store `value` under `key`, expiring after `ttl` seconds if given."""
+
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Remove `key`, if present."""
+
+        raise NotImplementedError
+
+    def clear(self):
+        """Remove every key."""
+
+        raise NotImplementedError
+
+
+class LRUCache(Cache):
+    """In-process cache holding at most `max_size` entries.
+
+    The least recently used entry is evicted first. A `ttl` (seconds) given
+    here is the default for `set()`; None means entries never expire.
+    """
+
+    def __init__(self, name, max_size=10000, ttl=None):
+        super().__init__(name)
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return None
+
+            value, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Store `value` under `key`, evicting the oldest entry if full."""
+
+        ttl = self.ttl if ttl is None else ttl
+
+        if ttl is not None and ttl <= 0:
+            return
+
+        expires = time.monotonic() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Remove `key`, if present."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove every key."""
+
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SharedCache(Cache):
+    """Cache stored in a shared server such as Redis.
+
+    `client` is any object with Redis-style `get(key)`, `set(key, value,
+    ex=seconds)` and `delete(key)` methods, e.g. `redis.Redis(...)`. Values
+    are pickled, so only point this at a server you trust. Keys are prefixed
+    with the cache name so caches can share one server.
+    """
+
+    def __init__(self, name, client, ttl=None):
+        super().__init__(name)
+        self.client = client
+        self.ttl = ttl
+
+    def _key(self, key):
+        return f"warbler:{self.name}:{key}"
+
+    def _get(self, key):
+        raw = self.client.get(self._key(key))
+        return None if raw is None else pickle.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        """Store `value` under `key`."""
+
+        ttl = self.ttl if ttl is None else ttl
+
+        if ttl is not None and ttl <= 0:
+            return
+
+        self.client.set(self._key(key), pickle.dumps(value), ex=ttl)
+
+    def delete(self, key):
+        """Remove `key`, if present."""
+
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        """Remove every key of this cache."""
+
+        keys = list(self.client.scan_iter(self._key("*")))
+        if keys:
+            self.client.delete(*keys)
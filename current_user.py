@@ -0,0 +1,107 @@
+"""The logged-in user, served from a short-lived profile cache.
+
+`add_user_to_g()` runs on every request, but most pages only need the
+navbar: the user's id, username and avatar. `load()` returns a
+`CurrentUser` whose profile fields come from a cache; the full `User` row
+is only fetched if the page touches anything else.
+
+`cache` defaults to an in-process LRU. To share it between processes,
+replace it with a `cache.SharedCache` at startup.
+"""
+
+from sqlalchemy import select
+
+from cache import LRUCache
+from models import db, Memberships, User
+
+DEFAULT_TTL = 60
+
+PROFILE_FIELDS = ("id", "username", "image_url", "header_image_url", "bio", "location")
+
+cache = LRUCache("current_user", max_size=10000, ttl=DEFAULT_TTL)
+
+
+class CurrentUser:
+    """Stand-in for the logged-in `User`.
+
+    Fields in PROFILE_FIELDS and follow/like checks never load the `User`
+    row; any other attribute loads it on first use. Use `instance` where
+    the real ORM object is needed, e.g. to change or delete it.
+    """
+
+    def __init__(self, profile):
+        self._profile = profile
+        self._instance = None
+        self.memberships = Memberships(profile["id"])
+
+    def __getattr__(self, name):
+        if name in PROFILE_FIELDS:
+            return self._profile[name]
+        return getattr(self.instance, name)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+    @property
+    def instance(self):
+        """The full `User` row, loaded on first use."""
+
+        if self._instance is None:
+            self._instance = db.session.get(User, self.id)
+            self._instance.memberships = self.memberships
+        return self._instance
+
+    def is_following(self, other_user):
+        """Is this user following `other_user`?"""
+
+        return self.memberships.follows(other_user.id)
+
+    def is_followed_by(self, other_user):
+        """Is this user followed by `other_user`?"""
+
+        return self.memberships.followed_by(other_user.id)
+
+    def has_liked(self, message):
+        """Has this user liked `message`?"""
+
+        return self.memberships.likes(message.id)
+
+
+def cache_key(user_id):
+    return f"user:{user_id}"
+
+
+def load(user_id, fresh=False):
+    """Return a CurrentUser for `user_id`, or None if there is no such user.
+
+    Deleted accounts count as gone, which logs out their other sessions.
+    `invalidate()` only reaches other processes when `cache` is shared, so
+    elsewhere a cached profile can outlive a deletion by up to the cache's
+    TTL; pass `fresh=True` to read it from the database regardless.
+    """
+
+    profile = None if fresh else cache.get(cache_key(user_id))
+
+    if profile is None:
+        columns = [getattr(User, field) for field in PROFILE_FIELDS]
+        row = db.session.execute(
+            select(*columns).where(User.id == user_id, User.deleted_at.is_(None))
+        ).first()
+
+        if row is None:
+            return None
+
+        profile = row._asdict()
+        cache.set(cache_key(user_id), profile)
+
+    return CurrentUser(profile)
+
+
+def invalidate(user_id):
+    """Forget the cached profile of `user_id` after it changes.
+
+    With the default in-process cache, other processes keep theirs until it
+    expires.
+    """
+
+    cache.delete(cache_key(user_id))
@@ -0,0 +1,407 @@
+"""The follow graph as compact sorted arrays, shared between processes.
+
+`FollowGraph` holds one direction of the graph in CSR form: for each user,
+the sorted int32 ids they follow (or are followed by). The suggestions job
+builds one straight from the database; `write_snapshot()` saves both
+directions to a file that every worker memory-maps with `FollowIndex`, so
+gunicorn workers on a host share one copy of the pages and start with no
+database work.
+
+A snapshot goes stale as people follow and unfollow. Those writes (see
+social.py) also append to the `follow_changes` log, and `FollowIndex`
+replays new log entries over its snapshot on `refresh()`, before each
+request when enabled with `init_app()`:
+
+    FOLLOW_GRAPH_PATH              snapshot to load; unset disables the index
+    FOLLOW_GRAPH_REFRESH_INTERVAL  seconds between log polls (default 5;
+                                   0: every request)
+
+`flask snapshot-follow-graph` writes a new snapshot (workers pick it up on
+their next refresh) and prunes old log entries. Follows written any other
+way, such as by deleting a user or a bulk import, reach the index with the
+next snapshot.
+"""
+
+import logging
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from itertools import chain
+
+import numpy as np
+from sqlalchemy import delete, func, or_, select
+
+from models import db, Follows, FollowChange, Memberships, User
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"WBFGRAPH"
+FORMAT_VERSION = 1
+
+# Snapshot header after MAGIC: version, rows, edges, last change log id.
+HEADER_FIELDS = 4
+HEADER_SIZE = len(MAGIC) + 8 * HEADER_FIELDS
+
+# Change log ids are handed out before commit, so an entry can become
+# visible after one with a higher id. A refresh keeps re-reading the ids it
+# skipped until they show up or are this old (their transaction rolled
+# back, or ran longer than any request should).
+UNCOMMITTED_TIMEOUT = timedelta(minutes=1)
+
+# Default seconds between a FollowIndex's polls of the change log.
+REFRESH_INTERVAL = 5
+
+# Changes replayed over a snapshot before the index warns that it needs a
+# new one.
+MAX_CHANGES = 100000
+
+# How long to keep change log entries after a snapshot.
+CHANGE_LOG_RETENTION = timedelta(days=1)
+
+
+class FollowGraph:
+    """The follow graph in CSR form: row `u` lists the users `u` follows.
+
+    `indices[indptr[u]:indptr[u + 1]]` are the ids followed by user `u`,
+    sorted. User ids index rows directly, so there are max(id) + 1 rows.
+    """
+
+    def __init__(self, indptr, indices):
+        self.indptr = indptr
+        self.indices = indices
+
+    @property
+    def size(self):
+        return len(self.indptr) - 1
+
+    @classmethod
+    def from_edges(cls, followers, followed, size=None):
+        """Build the graph from parallel arrays of follower and followed ids."""
+
+        followers = np.asarray(followers, dtype=np.int64)
+        followed = np.asarray(followed, dtype=np.int64)
+
+        if size is None:
+            size = int(max(followers.max(initial=0), followed.max(initial=0))) + 1
+
+        order = np.lexsort((followed, followers))
+        indptr = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(followers, minlength=size), out=indptr[1:])
+
+        return cls(indptr, followed[order].astype(np.int32))
+
+    @classmethod
+    def load(cls):
+        """Read every follow from the database."""
+
+        followers, followed, size = load_edges()
+        return cls.from_edges(followers, followed, size)
+
+    def transpose(self):
+        """The same graph with every edge reversed (row `u`: `u`'s followers)."""
+
+        followers = np.repeat(np.arange(self.size), np.diff(self.indptr))
+        return FollowGraph.from_edges(self.indices, followers, self.size)
+
+    def following(self, user_id):
+        """Ids followed by `user_id`, sorted."""
+
+        if not 0 <= user_id < self.size:
+            return self.indices[:0]
+
+        return self.indices[self.indptr[user_id] : self.indptr[user_id + 1]]
+
+    def following_of_all(self, user_ids):
+        """The concatenated rows of `user_ids` (duplicates kept)."""
+
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        user_ids = user_ids[user_ids < self.size]
+
+        starts = self.indptr[user_ids]
+        lengths = self.indptr[user_ids + 1] - starts
+        total = int(lengths.sum())
+
+        # Position i of the output reads indices[starts[row] + offset], where
+        # row is the slice it falls in and offset its place within it.
+        offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return self.indices[np.repeat(starts, lengths) + offsets]
+
+    def has_edge(self, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`? A binary search of one row."""
+
+        row = self.following(follower_id)
+        i = np.searchsorted(row, followed_id)
+        return bool(i < len(row) and row[i] == followed_id)
+
+
+def load_edges():
+    """Return `(followers, followed, size)`: every follow, as int64 arrays.
+
+    `size` is one more than the highest user id.
+    """
+
+    # A Core execute skips the ORM's row processing, and np.array() on
+    # Rows probes each for the array protocol; both are slow at this size.
+    follows = Follows.__table__.c
+    rows = db.session.connection().execute(
+        select(follows.user_following_id, follows.user_being_followed_id)
+    ).all()
+    edges = np.fromiter(
+        chain.from_iterable(rows), dtype=np.int64, count=2 * len(rows)
+    ).reshape(-1, 2)
+    size = (db.session.scalar(select(func.max(User.id))) or 0) + 1
+
+    return edges[:, 0], edges[:, 1], size
+
+
+##############################################################################
+# Snapshots
+
+
+def write_snapshot(path):
+    """Save the current follow graph to `path`, replacing it atomically.
+
+    Returns the number of follows written.
+    """
+
+    # Read the log position first: anything logged after it is replayed
+    # over the snapshot, even if the snapshot already has it. Entries logged
+    # within UNCOMMITTED_TIMEOUT are replayed too, as some with lower ids
+    # may not have committed yet.
+    settled = datetime.utcnow() - UNCOMMITTED_TIMEOUT
+    log_id = (
+        db.session.scalar(
+            select(func.max(FollowChange.id)).where(FollowChange.changed_at < settled)
+        )
+        or 0
+    )
+    following = FollowGraph.load()
+    followers = following.transpose()
+
+    header = np.array(
+        [FORMAT_VERSION, following.size, len(following.indices), log_id],
+        dtype=np.int64,
+    )
+
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+        f.write(MAGIC)
+        f.write(header.tobytes())
+        for array in [
+            following.indptr,
+            followers.indptr,
+            following.indices,
+            followers.indices,
+        ]:
+            f.write(array.tobytes())
+
+    os.replace(f.name, path)
+    return len(following.indices)
+
+
+def read_snapshot(path):
+    """Memory-map the snapshot at `path`.
+
+    Returns `(following, followers, log_id)`: two `FollowGraph`s whose
+    arrays are read-only views of the file.
+    """
+
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+
+    if bytes(data[: len(MAGIC)]) != MAGIC:
+        raise ValueError(f"{path} is not a follow graph snapshot")
+
+    version, size, edges, log_id = (
+        int(n) for n in np.frombuffer(data, np.int64, HEADER_FIELDS, len(MAGIC))
+    )
+    if version != FORMAT_VERSION:
+        raise ValueError(f"{path} has unsupported snapshot version {version}")
+
+    arrays = []
+    offset = HEADER_SIZE
+    for dtype, count in [
+        (np.int64, size + 1),
+        (np.int64, size + 1),
+        (np.int32, edges),
+        (np.int32, edges),
+    ]:
+        arrays.append(np.frombuffer(data, dtype, count, offset))
+        offset += np.dtype(dtype).itemsize * count
+
+    following_indptr, followers_indptr, following, followers = arrays
+    return (
+        FollowGraph(following_indptr, following),
+        FollowGraph(followers_indptr, followers),
+        log_id,
+    )
+
+
+def prune_changes(retention=CHANGE_LOG_RETENTION):
+    """Delete change log entries older than `retention`; return how many."""
+
+    result = db.session.execute(
+        delete(FollowChange).where(
+            FollowChange.changed_at < datetime.utcnow() - retention
+        )
+    )
+    return result.rowcount
+
+
+##############################################################################
+# Serving
+
+
+class FollowIndex:
+    """A memory-mapped snapshot plus the follow changes logged since.
+
+    Changes are kept per edge as `(follower, followed) -> following`, with
+    the edges touched per user on each side, so untouched users are
+    answered straight from the snapshot. An edge changed back to what the
+    snapshot says is dropped, so the changes hold only the net difference.
+    """
+
+    def __init__(self, path, refresh_interval=REFRESH_INTERVAL):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self._open()
+
+    def _open(self):
+        self._mtime_ns = os.stat(self.path).st_mtime_ns
+        self.following, self.followers, self.log_id = read_snapshot(self.path)
+        self._changes = {}
+        self._changed_following = {}
+        self._changed_followers = {}
+        self._gaps = {}
+        self._warned = False
+        self._refreshed_at = time.monotonic()
+
+    def refresh(self, force=False):
+        """Reload a newer snapshot, then replay new change log entries.
+
+        Polls at most once per `refresh_interval` seconds unless `force`.
+        """
+
+        now = time.monotonic()
+        if not force and now - self._refreshed_at < self.refresh_interval:
+            return
+        self._refreshed_at = now
+
+        if os.stat(self.path).st_mtime_ns != self._mtime_ns:
+            self._open()
+
+        changes = db.session.execute(
+            select(
+                FollowChange.id,
+                FollowChange.follower_id,
+                FollowChange.followed_id,
+                FollowChange.following,
+            )
+            .where(
+                or_(FollowChange.id > self.log_id, FollowChange.id.in_(self._gaps))
+            )
+            .order_by(FollowChange.id)
+        ).all()
+
+        seen = set()
+        for id, follower_id, followed_id, following in changes:
+            self.apply(follower_id, followed_id, following)
+            seen.add(id)
+
+        newest = max(seen, default=self.log_id)
+        for id in range(self.log_id + 1, newest):
+            if id not in seen:
+                self._gaps[id] = now
+        self.log_id = max(self.log_id, newest)
+
+        timeout = UNCOMMITTED_TIMEOUT.total_seconds()
+        self._gaps = {
+            id: skipped_at
+            for id, skipped_at in self._gaps.items()
+            if id not in seen and now - skipped_at < timeout
+        }
+
+        if len(self._changes) > MAX_CHANGES and not self._warned:
+            logger.warning(
+                "%d follow changes since the snapshot at %s; write a new one",
+                len(self._changes),
+                self.path,
+            )
+            self._warned = True
+
+    def apply(self, follower_id, followed_id, following):
+        """Record that `follower_id` now does (or doesn't) follow `followed_id`."""
+
+        if following != self.following.has_edge(follower_id, followed_id):
+            self._changes[follower_id, followed_id] = following
+            self._changed_following.setdefault(follower_id, set()).add(followed_id)
+            self._changed_followers.setdefault(followed_id, set()).add(follower_id)
+
+        elif self._changes.pop((follower_id, followed_id), None) is not None:
+            _discard(self._changed_following, follower_id, followed_id)
+            _discard(self._changed_followers, followed_id, follower_id)
+
+    def is_following(self, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`?"""
+
+        following = self._changes.get((follower_id, followed_id))
+        if following is not None:
+            return following
+
+        return self.following.has_edge(follower_id, followed_id)
+
+    def following_ids(self, user_id):
+        """Sorted array of the ids `user_id` follows."""
+
+        return self._merge(
+            self.following.following(user_id),
+            self._changed_following.get(user_id),
+            lambda other_id: self._changes[user_id, other_id],
+        )
+
+    def follower_ids(self, user_id):
+        """Sorted array of the ids following `user_id`."""
+
+        return self._merge(
+            self.followers.following(user_id),
+            self._changed_followers.get(user_id),
+            lambda other_id: self._changes[other_id, user_id],
+        )
+
+    def _merge(self, ids, changed, is_followed):
+        if not changed:
+            return ids
+
+        added = [other_id for other_id in changed if is_followed(other_id)]
+        removed = [other_id for other_id in changed if not is_followed(other_id)]
+        return np.union1d(np.setdiff1d(ids, removed), added).astype(np.int32)
+
+
+def _discard(changed, user_id, other_id):
+    ids = changed[user_id]
+    ids.discard(other_id)
+    if not ids:
+        del changed[user_id]
+
+
+def init_app(app):
+    """Serve follow checks from the snapshot at FOLLOW_GRAPH_PATH, if set."""
+
+    path = app.config.get("FOLLOW_GRAPH_PATH")
+    Memberships.graph = None
+
+    if not path:
+        return
+    if not os.path.exists(path):
+        logger.warning("No follow graph snapshot at %s; not using one", path)
+        return
+
+    index = FollowIndex(
+        path, app.config.get("FOLLOW_GRAPH_REFRESH_INTERVAL", REFRESH_INTERVAL)
+    )
+    Memberships.graph = index
+
+    @app.before_request
+    def refresh_follow_graph():
+        if Memberships.graph is index:
+            index.refresh()
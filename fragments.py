@@ -0,0 +1,50 @@
+"""Cached HTML for message cards.
+
+A posted message never changes, and neither does its card (author avatar,
+username, date and text) until the author edits their profile. Feeds render
+each card through `message_card()`, which keeps the HTML in `cache` under
+the message id and the author's `profile_version`. Editing a profile bumps
+that version, so the author's old cards are simply never asked for again;
+deleting a message drops its card.
+
+The like button differs per viewer and the like count changes, so both
+stay outside the cached fragment.
+
+`cache` defaults to an in-process LRU. To share it between processes,
+replace it with a `cache.SharedCache` at startup.
+"""
+
+from flask import current_app
+from markupsafe import Markup
+
+from cache import LRUCache
+
+CARD_TEMPLATE = "messages/card.html"
+
+cache = LRUCache("fragments", max_size=50000)
+
+
+def cache_key(message_id, profile_version):
+    return f"card:{message_id}:{profile_version}"
+
+
+def message_card(message):
+    """The HTML card for `message` (whose `user` must be loaded)."""
+
+    key = cache_key(message.id, message.user.profile_version)
+    html = cache.get(key)
+
+    if html is None:
+        # Render without Flask's context processors and template signals:
+        # the card only depends on the message.
+        template = current_app.jinja_env.get_template(CARD_TEMPLATE)
+        html = template.render(msg=message)
+        cache.set(key, html)
+
+    return Markup(html)
+
+
+def invalidate(message):
+    """Forget the card of `message`, e.g. when it is deleted."""
+
+    cache.delete(cache_key(message.id, message.user.profile_version))
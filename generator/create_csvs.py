@@ -1,77 +1,413 @@
 """Generate CSVs of random data for Warbler.
 
 Students won't need to run this for the exercise; they will just use the CSV
-files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+files in this directory. Run it to make bigger, production-shaped datasets
+for load and capacity testing:
+
+    python generator/create_csvs.py --users 1000000 --messages 20000000 \\
+        --follows 100000000 --likes 50000000 --shards 32 --out generator/data
+    python seed.py --data-dir generator/data
+
+Output is reproducible: the same --seed and sizes give the same files,
+however many --workers produce them. Nothing is fetched from the network.
+
+Shape of the data:
+
+- Followers follow a power law (--skew): a few users are followed by a
+  large share of everyone, most by almost no one. Follows and likes are
+  distinct pairs; nobody follows themselves or likes their own messages.
+- Active users post most messages, and volume grows over time: the newest
+  months hold far more messages than the oldest (--growth).
+- Likes go mostly to a small set of popular messages.
+
+Each table is split into --shards files (users-000.csv, ...), each written
+by one worker process a chunk at a time, so memory stays bounded however
+large the dataset. --format parquet writes .parquet files instead (needs
+pyarrow).
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import os
+from multiprocessing import Pool
+
+import numpy as np
 
+PASSWORD_HASH = "$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe"
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
-MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
-FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+TABLE_HEADERS = {
+    "users": [
+        "id", "email", "username", "image_url", "password", "bio",
+        "header_image_url", "location",
+    ],
+    "messages": ["id", "text", "timestamp", "user_id"],
+    "follows": ["user_being_followed_id", "user_following_id"],
+    "likes": ["user_id", "message_id"],
+}
+
+# Random streams are derived from (seed, table, shard), never shared.
+TABLE_STREAMS = {name: n for n, name in enumerate(TABLE_HEADERS)}
+
+# Stream mixed into the seed when hashing message ids to their authors.
+AUTHOR_STREAM = len(TABLE_STREAMS)
+
+WORDS = np.array(
+    """
+    about above across after again air all almost along also always among
+    animal answer any area around back bird birds bright build call came
+    can city close cold could country course cut dark day deep did does
+    early earth east eat end enough even ever every eye face family far
+    feet field find fire first fish five food form found four friend from
+    full garden give good great green ground group grow hand hard have
+    head hear heard high hold home horse hour house idea important keep
+    kind king land large last late learn leave left life light line list
+    little live long look made make many map mark might mile mind money
+    moon more morning most mountain move much music must name near need
+    never new next night north note nothing notice number ocean often old
+    once only open order other over page paper part past people picture
+    place plain plant play point port power press pull question quick
+    quiet rain reach read ready real record red remember rest river road
+    rock room round run said same saw sea second seen sentence serve
+    several ship short show side simple since sing small snow song soon
+    sound south space special spring stand star start state stay step
+    still stone stood story street strong study such summer sun sure
+    table tail take talk tell than thing think third those thought three
+    through time today together told took top toward town travel tree
+    true try turn under until upon usual very voice walk warm watch water
+    wave way weather week well went west while white whole wind window
+    winter with wonder wood word work world write year young
+    """.split()
+)
+
+CITIES = np.array(
+    """
+    Ashford Bayview Brookside Cedarville Clearwater Eastport Fairview
+    Glenwood Greenfield Harborview Highland Kingston Lakeside Maplewood
+    Millbrook Northgate Oakridge Pinehurst Riverside Rosedale Springfield
+    Stonebridge Sunnyvale Westfield Willowdale Woodland
+    """.split()
+)
+
+IMAGE_URLS = np.array(
+    [
+        f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+        for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+        for i in range(count)
+    ]
+)
+
+# Multiplier used to scatter popularity ranks over ids (see `scatter`).
+SCATTER_PRIME = 2654435761
+
+
+##############################################################################
+# Sampling
+
+
+def power_law_ranks(rng, n, size, skew):
+    """Draw `size` ranks in [0, n), rank r with probability ~ 1 / (r + 1)**skew.
+
+    Inverse-CDF sampling of a bounded continuous power law, so no table of
+    n weights is needed.
+    """
+
+    return power_law(rng.random(size), n, skew)
+
+
+def power_law(u, n, skew):
+    """Map uniforms `u` in [0, 1) onto power-law ranks in [0, n)."""
+
+    if skew == 1:
+        x = (n + 1.0) ** u
+    else:
+        exponent = 1.0 - skew
+        x = (1.0 + u * ((n + 1.0) ** exponent - 1.0)) ** (1.0 / exponent)
+
+    return np.minimum(x.astype(np.int64) - 1, n - 1)
+
+
+def scatter(ranks, n):
+    """Map ranks in [0, n) one-to-one onto ids 1..n.
+
+    Keeps the most popular users (or messages) from all having the lowest
+    ids, without holding a permutation of all n ids in memory.
+    """
+
+    prime = SCATTER_PRIME if np.gcd(SCATTER_PRIME, n) == 1 else 1
+    return (ranks * prime) % n + 1
+
+
+def id_uniforms(seed, stream, ids):
+    """A uniform in [0, 1) for each id, fixed by (seed, stream, id).
+
+    A splitmix64 hash rather than a random stream, so any shard can
+    recompute the value for any id without replaying who drew it.
+    """
+
+    with np.errstate(over="ignore"):
+        z = ids.astype(np.uint64) + np.uint64(seed * 1000 + stream) * np.uint64(
+            0x9E3779B97F4A7C15
+        )
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z ^= z >> np.uint64(31)
+
+    return (z >> np.uint64(11)).astype(np.float64) / 2.0**53
+
+
+def message_authors(options, ids):
+    """The author of each message id; the same wherever it is asked for."""
+
+    u = id_uniforms(options.seed, AUTHOR_STREAM, ids)
+    return scatter(power_law(u, options.users, options.skew), options.users)
+
+
+def sentences(rng, count, min_words, max_words):
+    """Return `count` random sentences of `min_words` to `max_words` words."""
+
+    lengths = rng.integers(min_words, max_words + 1, count)
+    words = WORDS[rng.integers(0, len(WORDS), lengths.sum())]
+    ends = np.cumsum(lengths)
+
+    return [
+        " ".join(words[end - length:end]).capitalize() + "."
+        for end, length in zip(ends, lengths)
+    ]
+
+
+def share(total, low, high, span_low, span_high):
+    """The part of `total` falling to ids [low, high) of [span_low, span_high).
+
+    Shares of adjacent ranges add up to exactly `total`.
+    """
+
+    span = span_high - span_low
+    return total * (high - span_low) // span - total * (low - span_low) // span
+
+
+def distinct_pairs(rng, low, high, count, sample_other, chunk_size, keep):
+    """Yield chunks of distinct (owner, other) pairs with owners in [low, high).
+
+    `sample_other(rng, owners)` picks an `other` for each owner and
+    `keep(pairs)` masks out pairs that aren't allowed. Owners are
+    handled in id ranges of `chunk_size`, each getting its share of `count`;
+    because the ranges don't overlap, pairs are distinct across chunks (and
+    across shards, which cover disjoint owner ranges).
+    """
+
+    for start in range(low, high, chunk_size):
+        stop = min(start + chunk_size, high)
+        target = share(count, start, stop, low, high)
+
+        pairs = np.empty((0, 2), dtype=np.int64)
+        for _ in range(10):
+            missing = target - len(pairs)
+            if missing <= 0:
+                break
+
+            # Oversample a little; duplicates (and unkept pairs) are dropped.
+            size = int(missing * 1.1) + 16
+            owners = rng.integers(start, stop, size)
+            fresh = np.column_stack([owners, sample_other(rng, owners)])
+            fresh = fresh[keep(fresh)]
+            pairs = np.unique(np.concatenate([pairs, fresh]), axis=0)
+
+        if len(pairs) > target:
+            pairs = pairs[np.sort(rng.choice(len(pairs), target, replace=False))]
+
+        yield pairs
+
+
+##############################################################################
+# Tables
+
+
+def users_chunks(rng, options, low, high):
+    for start in range(low, high, options.chunk_size):
+        ids = np.arange(start, min(start + options.chunk_size, high))
+        count = len(ids)
+        handles = WORDS[rng.integers(0, len(WORDS), count)]
+
+        yield {
+            "id": ids,
+            "email": [f"{handle}{i}@example.com" for handle, i in zip(handles, ids)],
+            "username": [f"{handle}{i}" for handle, i in zip(handles, ids)],
+            "image_url": IMAGE_URLS[rng.integers(0, len(IMAGE_URLS), count)],
+            "password": np.full(count, PASSWORD_HASH),
+            "bio": sentences(rng, count, 3, 10),
+            "header_image_url": np.full(count, "/static/images/warbler-hero.jpg"),
+            "location": CITIES[rng.integers(0, len(CITIES), count)],
+        }
+
+
+def messages_chunks(rng, options, low, high):
+    start_time = np.datetime64(options.start, "s")
+    span = (np.datetime64(options.end, "s") - start_time).astype(np.int64)
+
+    for start in range(low, high, options.chunk_size):
+        ids = np.arange(start, min(start + options.chunk_size, high))
+        count = len(ids)
+
+        # Density grows as t**(growth - 1): recent months are busiest.
+        offsets = (rng.random(count) ** (1.0 / options.growth) * span).astype(np.int64)
+        timestamps = np.datetime_as_string(start_time + offsets, unit="s")
+
+        yield {
+            "id": ids,
+            "text": [
+                text[:MAX_WARBLER_LENGTH] for text in sentences(rng, count, 4, 25)
+            ],
+            "timestamp": np.char.replace(timestamps, "T", " "),
+            "user_id": message_authors(options, ids),
+        }
+
+
+def follows_chunks(rng, options, low, high, count):
+    def followed(rng, followers):
+        ranks = power_law_ranks(rng, options.users, len(followers), options.skew)
+        return scatter(ranks, options.users)
+
+    for pairs in distinct_pairs(
+        rng, low, high, count, followed, options.chunk_size,
+        keep=lambda pairs: pairs[:, 0] != pairs[:, 1],
+    ):
+        yield {
+            "user_being_followed_id": pairs[:, 1],
+            "user_following_id": pairs[:, 0],
+        }
+
+
+def likes_chunks(rng, options, low, high, count):
+    def liked(rng, users):
+        ranks = power_law_ranks(rng, options.messages, len(users), options.skew)
+        return scatter(ranks, options.messages)
+
+    for pairs in distinct_pairs(
+        rng, low, high, count, liked, options.chunk_size,
+        keep=lambda pairs: pairs[:, 0] != message_authors(options, pairs[:, 1]),
+    ):
+        yield {"user_id": pairs[:, 0], "message_id": pairs[:, 1]}
+
+
+##############################################################################
+# Output
+
+
+def shard_bounds(total, shards, shard):
+    """The [low, high) id range (1-based) of `shard` when splitting `total`."""
+
+    return 1 + total * shard // shards, 1 + total * (shard + 1) // shards
+
+
+def write_csv(path, columns, chunks):
+    rows = 0
+
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(columns)
+
+        for chunk in chunks:
+            writer.writerows(zip(*(chunk[column] for column in columns)))
+            rows += len(chunk[columns[0]])
+
+    return rows
+
+
+def write_parquet(path, columns, chunks):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    rows = 0
+    writer = None
+
+    try:
+        for chunk in chunks:
+            table = pa.table({column: chunk[column] for column in columns})
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+            rows += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return rows
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
 
-fake = Faker()
+def generate_shard(task):
+    """Write one shard of one table; return (path, rows)."""
 
-# Generate random profile image URLs to use for users
+    name, shard, options = task
+    rng = np.random.default_rng([options.seed, TABLE_STREAMS[name], shard])
 
-image_urls = [
-    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
-    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
-    for i in range(count)
-]
+    if name in ("users", "messages"):
+        total = options.users if name == "users" else options.messages
+        low, high = shard_bounds(total, options.shards, shard)
+        make = users_chunks if name == "users" else messages_chunks
+        chunks = make(rng, options, low, high)
+    else:
+        # Shards split the *owners* (followers, likers) so pairs stay
+        # distinct without comparing shards.
+        total = options.follows if name == "follows" else options.likes
+        low, high = shard_bounds(options.users, options.shards, shard)
+        count = share(total, low, high, 1, options.users + 1)
+        make = follows_chunks if name == "follows" else likes_chunks
+        chunks = make(rng, options, low, high, count)
 
-# Generate random header image URLs to use for users
+    extension = "parquet" if options.format == "parquet" else "csv"
+    path = os.path.join(options.out, f"{name}-{shard:03d}.{extension}")
+    write = write_parquet if options.format == "parquet" else write_csv
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
+    return path, write(path, TABLE_HEADERS[name], chunks)
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--follows", type=int, default=5000)
+    parser.add_argument("--likes", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skew", type=float, default=1.1,
+                        help="power-law exponent for popularity (default 1.1)")
+    parser.add_argument("--growth", type=float, default=3.0,
+                        help="how strongly message volume grows over time")
+    parser.add_argument("--start", default="2018-01-01")
+    parser.add_argument("--end", default="2024-01-01")
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--out", default="generator/data")
+    options = parser.parse_args()
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
+    if options.users < 2:
+        parser.error("--users must be at least 2")
+    if options.follows > options.users * (options.users - 1):
+        parser.error("--follows is more than every possible pair of users")
+    if options.messages < 1 and options.likes:
+        parser.error("--likes needs at least one message")
+    if options.format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            parser.error("--format parquet needs pyarrow (pip install pyarrow)")
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
+    os.makedirs(options.out, exist_ok=True)
 
-# Generate follows.csv from random pairings of users
+    tasks = [
+        (name, shard, options)
+        for name in TABLE_HEADERS
+        for shard in range(options.shards)
+    ]
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+    with Pool(options.workers) as pool:
+        for path, rows in pool.imap(generate_shard, tasks):
+            print(f"{path}: {rows:,} rows")
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == "__main__":
+    main()
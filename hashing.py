@@ -0,0 +1,139 @@
+"""Password hashing and checking off the request thread.
+
+bcrypt is deliberately slow (~250ms at cost 12), so hashing on the request
+thread ties up a worker for the whole time. `PasswordHasher` runs the work
+in a bounded process pool instead. If more than `max_pending` hashes are
+already queued, new requests fail fast with `HasherBusy` (served as HTTP
+503 with Retry-After) rather than piling up behind them.
+
+Configuration, read by `init_app()`:
+
+- BCRYPT_LOG_ROUNDS: work factor for new hashes (default 12).
+- PASSWORD_HASH_WORKERS: pool size (default: one per CPU). 0 hashes inline
+  on the calling thread, which is handy for tests and scripts.
+- PASSWORD_HASH_MAX_PENDING: most hashes queued or running at once
+  (default: 4 per worker).
+- PASSWORD_HASH_TIMEOUT: seconds to wait for a result (default 10).
+"""
+
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+import bcrypt
+
+DEFAULT_ROUNDS = 12
+DEFAULT_TIMEOUT = 10
+
+
+class HasherBusy(Exception):
+    """Too many password hashes are pending; try again shortly."""
+
+    retry_after = 1
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _check(password, hashed):
+    return bcrypt.checkpw(password, hashed)
+
+
+class PasswordHasher:
+    """Hash and check passwords in a bounded process pool."""
+
+    def __init__(self, rounds=DEFAULT_ROUNDS, workers=None, max_pending=None):
+        self.configure(rounds, workers, max_pending)
+
+    def configure(
+        self, rounds=DEFAULT_ROUNDS, workers=None, max_pending=None, timeout=None
+    ):
+        """(Re)configure the hasher; any existing pool is shut down."""
+
+        if getattr(self, "_pool", None) is not None:
+            self._pool.shutdown(wait=False)
+
+        self.rounds = rounds
+        self.workers = os.cpu_count() if workers is None else workers
+        self.max_pending = max_pending or max(1, self.workers) * 4
+        self.timeout = timeout or DEFAULT_TIMEOUT
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Configure from `app.config` (see the module docstring)."""
+
+        workers = app.config.get("PASSWORD_HASH_WORKERS")
+        self.configure(
+            rounds=app.config.get("BCRYPT_LOG_ROUNDS", DEFAULT_ROUNDS),
+            workers=None if workers is None else int(workers),
+            max_pending=app.config.get("PASSWORD_HASH_MAX_PENDING"),
+            timeout=app.config.get("PASSWORD_HASH_TIMEOUT"),
+        )
+
+    def _executor(self):
+        # Pools don't survive fork, so each (e.g. gunicorn) worker process
+        # starts its own the first time it needs one.
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _run(self, fn, *args):
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            raise HasherBusy()
+
+        if self.workers == 0:
+            try:
+                return fn(*args)
+            finally:
+                slots.release()
+
+        try:
+            future = self._executor().submit(fn, *args)
+        except BaseException:
+            slots.release()
+            raise
+
+        # Hold the slot until the work ends, not just our wait for it: a
+        # hash that timed out may still be running in the pool.
+        future.add_done_callback(lambda future: slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise HasherBusy() from None
+
+    def hash(self, password):
+        """Return a bcrypt hash of `password` (str) at the configured cost."""
+
+        hashed = self._run(_hash, password.encode("UTF-8"), self.rounds)
+        return hashed.decode("UTF-8")
+
+    def check(self, hashed, password):
+        """Does `password` (str) match the bcrypt hash `hashed`?"""
+
+        try:
+            return self._run(
+                _check, password.encode("UTF-8"), hashed.encode("UTF-8")
+            )
+        except ValueError:
+            # Malformed hash
+            return False
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made at a different cost than the configured one?"""
+
+        try:
+            return int(hashed.split("$")[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+hasher = PasswordHasher()
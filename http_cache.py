@@ -0,0 +1,172 @@
+"""HTTP caching: conditional GETs, Cache-Control policies and static URLs.
+
+Every GET response gets a Cache-Control header from its view's policy (see
+`cache_policy`):
+
+- "public" pages may be stored by browsers and shared proxies for `max_age`
+  seconds, but only while the session is empty. Anyone logged in (or with
+  a pending flash message) gets the "private" treatment instead, and
+  public responses carry `Vary: Cookie` so proxies keep the two apart.
+- "private" pages (the default) may be stored by the browser but must be
+  revalidated on every use.
+- "no-store" pages (forms carrying a CSRF token, admin pages) are never
+  stored. Neither are errors, redirects or responses to other methods.
+
+Revalidation uses weak ETags. A view that can name the rows a page is built
+from calls `not_modified(*versions)` before querying anything else; if the
+client already has that version it gets a 304 without the page being
+loaded or rendered. Pages without such a tag are tagged with a hash of
+their body, which still saves sending it again.
+
+Files under static/ are linked with `static_url()`, which adds a `?v=`
+fingerprint of their contents, so they can be cached for a year: changing
+a file changes its URL.
+"""
+
+import hashlib
+import os
+from functools import lru_cache
+
+from flask import current_app, g, request, session, url_for
+
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def cache_policy(policy, max_age=0):
+    """Set the Cache-Control policy of a view: "public", "private" or "no-store".
+
+    Apply it below `@app.route`.
+    """
+
+    if policy not in ("public", "private", "no-store"):
+        raise ValueError(f"Unknown cache policy: {policy!r}")
+
+    def decorator(view):
+        view.cache_policy = (policy, max_age)
+        return view
+
+    return decorator
+
+
+def etag(*parts):
+    """A tag for the page built from `parts` (ids, versions, counters...)."""
+
+    templates = os.path.join(current_app.root_path, current_app.template_folder)
+    build = build_version(templates, current_app.static_folder)
+    return hashlib.sha1(repr((build,) + parts).encode("UTF-8")).hexdigest()[:24]
+
+
+def not_modified(*parts):
+    """Tag this response with `etag(*parts)`.
+
+    Returns a 304 response if the client sent that tag in If-None-Match,
+    else None. Pages showing a flash message are never short-circuited.
+    """
+
+    if "_flashes" in session:
+        return None
+
+    tag = g.etag = etag(*parts)
+
+    if not request.if_none_match.contains_weak(tag):
+        return None
+
+    response = current_app.response_class(status=304)
+    response.set_etag(tag, weak=True)
+    return response
+
+
+def static_url(filename):
+    """URL of the static file `filename`, fingerprinted with its contents."""
+
+    path = os.path.join(current_app.static_folder, filename)
+    version = fingerprint(path, os.stat(path).st_mtime_ns)
+    return url_for("static", filename=filename, v=version)
+
+
+@lru_cache(maxsize=1024)
+def fingerprint(path, mtime_ns):
+    """Short hash of the file at `path` (`mtime_ns` keys the memo)."""
+
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()[:12]
+
+
+@lru_cache(maxsize=None)
+def build_version(*folders):
+    """Hash of every template and static file, computed once per process.
+
+    Part of every ETag, so a deploy that changes how pages look also
+    invalidates the copies clients already have. Paths are hashed relative
+    to their folder, so every checkout of the same files agrees.
+    """
+
+    digest = hashlib.sha1()
+
+    for folder in folders:
+        if not os.path.isdir(folder):
+            raise FileNotFoundError(f"No such folder: {folder}")
+
+        for root, dirs, files in os.walk(folder):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                digest.update(os.path.relpath(path, folder).encode("UTF-8"))
+                digest.update(fingerprint(path, os.stat(path).st_mtime_ns).encode())
+
+    return digest.hexdigest()[:12]
+
+
+def apply_policy(response):
+    """Set Cache-Control (and an ETag where useful) on `response`."""
+
+    cache_control = response.cache_control
+    tag = g.pop("etag", None)
+
+    if request.endpoint == "static":
+        if "v" in request.args and response.status_code in (200, 304):
+            cache_control.public = True
+            cache_control.max_age = STATIC_MAX_AGE
+            cache_control.immutable = True
+            cache_control.no_cache = None
+        return response
+
+    if "Cache-Control" in response.headers:
+        return response
+
+    if request.method not in ("GET", "HEAD") or response.status_code not in (200, 304):
+        cache_control.no_store = True
+        return response
+
+    view = current_app.view_functions.get(request.endpoint)
+    policy, max_age = getattr(view, "cache_policy", ("private", 0))
+
+    if policy == "no-store":
+        cache_control.no_store = True
+        return response
+
+    # A session emptied during the request (e.g. a flash message shown and
+    # popped) was not empty when the page was built.
+    if policy == "public" and not session and not session.modified:
+        cache_control.public = True
+        cache_control.max_age = max_age
+        response.vary.add("Cookie")
+    else:
+        cache_control.private = True
+        cache_control.no_cache = True
+
+    if response.status_code == 200:
+        if tag:
+            response.set_etag(tag, weak=True)
+        elif not response.is_streamed:
+            response.add_etag(weak=True)
+        response.make_conditional(request)
+
+    return response
+
+
+def init_app(app):
+    """Apply cache policies to every response; add `static_url` to templates."""
+
+    app.after_request(apply_policy)
+    app.jinja_env.globals["static_url"] = static_url
@@ -0,0 +1,344 @@
+"""Request-level instrumentation for Warbler.
+
+For every request this records how many SQL statements ran, how long they
+took, how long templates took to render, how many cache lookups hit or
+missed (see cache.py) and which endpoint served it. Each request emits one
+structured (JSON) log line on the `warbler.requests` logger, and statements
+slower than SLOW_QUERY_THRESHOLD_MS are logged with their normalized SQL on
+`warbler.slow_queries`.
+
+Totals are also aggregated into in-process counters and histograms that
+`render_metrics()` exposes in the Prometheus text format. Metrics are per
+process: with several gunicorn workers, each worker reports its own.
+"""
+
+import json
+import logging
+import re
+import threading
+import time
+from collections import defaultdict
+
+from flask import current_app, g, has_request_context, request
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+request_logger = logging.getLogger("warbler.requests")
+slow_query_logger = logging.getLogger("warbler.slow_queries")
+
+DEFAULT_SLOW_QUERY_THRESHOLD_MS = 100
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+
+class Counter:
+    """A monotonically increasing count, per label set."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        """Add `amount` to the count for `label_values`."""
+
+        with self._lock:
+            self._values[label_values] += amount
+
+    def value(self, *label_values):
+        """Current count for `label_values`."""
+
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        """Yield (suffix, label dict, value) for every label set."""
+
+        with self._lock:
+            values = dict(self._values)
+
+        for label_values, value in sorted(values.items()):
+            yield "", dict(zip(self.labels, label_values)), value
+
+
+class Histogram:
+    """Bucketed observations, per label set, Prometheus style."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        """Record one observation of `value` for `label_values`."""
+
+        with self._lock:
+            series = self._series.setdefault(
+                label_values, {"buckets": [0] * len(self.buckets), "sum": 0, "count": 0}
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def samples(self):
+        """Yield (suffix, label dict, value) for every label set."""
+
+        with self._lock:
+            series_items = [
+                (labels, dict(series, buckets=list(series["buckets"])))
+                for labels, series in self._series.items()
+            ]
+
+        for label_values, series in sorted(series_items):
+            labels = dict(zip(self.labels, label_values))
+            for bound, count in zip(self.buckets, series["buckets"]):
+                yield "_bucket", dict(labels, le=repr(float(bound))), count
+            yield "_bucket", dict(labels, le="+Inf"), series["count"]
+            yield "_sum", labels, series["sum"]
+            yield "_count", labels, series["count"]
+
+
+class Registry:
+    """The set of metrics rendered by `render_metrics()`."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name, help, labels=()):
+        """Get or create the counter called `name`."""
+
+        return self.metrics.setdefault(name, Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=SECONDS_BUCKETS):
+        """Get or create the histogram called `name`."""
+
+        return self.metrics.setdefault(name, Histogram(name, help, labels, buckets))
+
+
+registry = Registry()
+
+request_duration = registry.histogram(
+    "warbler_request_duration_seconds",
+    "Time spent serving requests.",
+    labels=("endpoint", "method"),
+)
+request_queries = registry.histogram(
+    "warbler_request_queries",
+    "SQL statements run per request.",
+    labels=("endpoint",),
+    buckets=QUERY_COUNT_BUCKETS,
+)
+request_db_time = registry.histogram(
+    "warbler_request_db_seconds",
+    "Time spent in SQL statements per request.",
+    labels=("endpoint",),
+)
+request_render_time = registry.histogram(
+    "warbler_request_render_seconds",
+    "Time spent rendering templates per request.",
+    labels=("endpoint",),
+)
+slow_queries = registry.counter(
+    "warbler_slow_queries_total",
+    "SQL statements slower than SLOW_QUERY_THRESHOLD_MS.",
+    labels=("endpoint",),
+)
+
+
+class RequestStats:
+    """What one request has done so far."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.render_started = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+
+_LITERALS = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"%\(\w+\)s|%s|\$\d+"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(?)"),
+    (re.compile(r"\s+"), " "),
+]
+
+
+def normalize_sql(statement):
+    """Reduce `statement` to its shape: literals and parameters become `?`.
+
+    Lists such as `IN (?, ?, ?)` collapse to `IN (?)` so that statements
+    differing only in their values read the same in the slow query log.
+    """
+
+    for pattern, replacement in _LITERALS:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+def current_stats():
+    """The RequestStats of the request being served, or None."""
+
+    # Outside a request, `g` may be an app context a finished request left
+    # its stats on.
+    if not has_request_context():
+        return None
+    return g.get("request_stats")
+
+
+def endpoint_name():
+    """Label for the current endpoint, including unmatched URLs."""
+
+    return request.endpoint or "<unmatched>"
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the execution context, which is discarded with the statement,
+    # so one that raises leaves nothing behind on its (pooled) connection.
+    if context is not None:
+        context._query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_query_started", None)
+    stats = current_stats()
+
+    if started is None or stats is None:
+        return
+
+    elapsed = time.perf_counter() - started
+
+    stats.queries += 1
+    stats.db_time += elapsed
+
+    threshold_ms = current_app.config.get(
+        "SLOW_QUERY_THRESHOLD_MS", DEFAULT_SLOW_QUERY_THRESHOLD_MS
+    )
+    if elapsed * 1000 >= threshold_ms:
+        slow_queries.inc(endpoint_name())
+        slow_query_logger.warning(
+            json.dumps(
+                {
+                    "endpoint": endpoint_name(),
+                    "duration_ms": round(elapsed * 1000, 2),
+                    "sql": normalize_sql(statement),
+                }
+            )
+        )
+
+
+def _before_render(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None:
+        stats.render_started = time.perf_counter()
+
+
+def _after_render(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None and stats.render_started is not None:
+        stats.render_time += time.perf_counter() - stats.render_started
+        stats.render_started = None
+
+
+def _start_request():
+    g.request_stats = RequestStats()
+
+
+def _finish_request(response):
+    stats = current_stats()
+
+    if stats is None:
+        return response
+
+    duration = time.perf_counter() - stats.started
+    endpoint = endpoint_name()
+
+    request_duration.observe(duration, endpoint, request.method)
+    request_queries.observe(stats.queries, endpoint)
+    request_db_time.observe(stats.db_time, endpoint)
+    request_render_time.observe(stats.render_time, endpoint)
+
+    request_logger.info(
+        json.dumps(
+            {
+                "endpoint": endpoint,
+                "method": request.method,
+                "path": request.path,
+                "status": response.status_code,
+                "duration_ms": round(duration * 1000, 2),
+                "queries": stats.queries,
+                "db_ms": round(stats.db_time * 1000, 2),
+                "render_ms": round(stats.render_time * 1000, 2),
+                "cache_hits": stats.cache_hits,
+                "cache_misses": stats.cache_misses,
+            }
+        )
+    )
+
+    return response
+
+
+def init_app(app):
+    """Instrument every request served by `app`.
+
+    Call this before registering other request hooks, so the timings cover
+    them too.
+    """
+
+    app.config.setdefault("SLOW_QUERY_THRESHOLD_MS", DEFAULT_SLOW_QUERY_THRESHOLD_MS)
+
+    # Like Flask's own app.logger: log to stderr unless configured otherwise.
+    for logger in (request_logger, slow_query_logger):
+        if not logger.handlers:
+            logger.addHandler(logging.StreamHandler())
+            logger.setLevel(logging.INFO)
+
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    pairs = ",".join(f'{key}="{escape(value)}"' for key, value in labels.items())
+    return "{" + pairs + "}"
+
+
+def render_metrics():
+    """Every registered metric in the Prometheus text exposition format."""
+
+    lines = []
+
+    for metric in registry.metrics.values():
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for suffix, labels, value in metric.samples():
+            lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {value!r}")
+
+    return "\n".join(lines) + "\n"
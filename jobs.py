@@ -0,0 +1,208 @@
+"""A small database-backed queue for work too slow to do in a request.
+
+A request calls `enqueue()`, which adds a `Job` row in the request's own
+transaction, so the job exists exactly when the change that needs it was
+committed. Worker processes (`flask worker`) claim queued jobs with
+`SELECT ... FOR UPDATE SKIP LOCKED`, so any number of workers can poll the
+table without taking each other's jobs. On SQLite, which has no row locks,
+the clause is left out and a single worker is assumed.
+
+Handlers are plain functions registered with `@handler(kind)` and called
+with the job's payload as keyword arguments. Each runs in its own
+transaction, committed when it returns; a worker claims one job at a time,
+so no claimed job waits behind others while its lease runs down:
+
+- A handler that returns True has more to do: the job is queued to run
+  again straight away. Long jobs work in bounded chunks this way, with a
+  commit between chunks and other jobs interleaved.
+- A handler that raises, or whose transaction fails to commit, is rolled
+  back and retried after a backoff that doubles each attempt, until
+  `max_attempts` is reached; the job is then left with status "failed"
+  and its last error.
+- `concurrency` caps how many jobs of a kind run at once across workers.
+  The cap is checked when claiming, so it can briefly be exceeded when
+  workers claim at the same moment.
+
+A worker that dies mid-job leaves it "running"; once its claim is older
+than LEASE another worker takes it over, so handlers must be safe to run
+again.
+"""
+
+import logging
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func, or_, select
+
+from models import db, Job
+
+logger = logging.getLogger(__name__)
+
+LEASE = timedelta(minutes=5)
+RETRY_DELAY = timedelta(seconds=10)
+MAX_RETRY_DELAY = timedelta(hours=1)
+
+Handler = namedtuple("Handler", ["fn", "max_attempts", "concurrency"])
+
+handlers = {}
+
+
+def handler(kind, max_attempts=5, concurrency=None):
+    """Register the decorated function to run jobs of `kind`."""
+
+    def register(fn):
+        handlers[kind] = Handler(fn, max_attempts, concurrency)
+        return fn
+
+    return register
+
+
+def enqueue(kind, delay=None, **payload):
+    """Queue a `kind` job with `payload`, committed with the caller's transaction.
+
+    `delay` (a timedelta) holds the job back. Returns the `Job`.
+    """
+
+    if kind not in handlers:
+        raise ValueError(f"No handler for job kind {kind!r}")
+
+    run_at = datetime.utcnow() + (delay or timedelta())
+    job = Job(kind=kind, payload=payload, run_at=run_at)
+    db.session.add(job)
+    return job
+
+
+def claim(limit=10, kinds=None):
+    """Mark up to `limit` due jobs as running and return them.
+
+    Commits, so the claim is visible to other workers at once.
+    """
+
+    now = datetime.utcnow()
+
+    due = or_(
+        and_(Job.status == "queued", Job.run_at <= now),
+        and_(Job.status == "running", Job.locked_at < now - LEASE),
+    )
+    query = (
+        select(Job)
+        .where(due)
+        .order_by(Job.run_at, Job.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    if kinds:
+        query = query.where(Job.kind.in_(kinds))
+
+    free = free_slots(now)
+    full = [kind for kind, slots in free.items() if slots <= 0]
+    if full:
+        query = query.where(Job.kind.not_in(full))
+
+    claimed = []
+    for job in db.session.scalars(query):
+        if job.kind in free:
+            if free[job.kind] <= 0:
+                continue
+            free[job.kind] -= 1
+
+        job.status = "running"
+        job.locked_at = now
+        job.attempts += 1
+        claimed.append(job)
+
+    db.session.commit()
+    return claimed
+
+
+def free_slots(now):
+    """How many more jobs of each concurrency-limited kind may start."""
+
+    limits = {
+        kind: spec.concurrency
+        for kind, spec in handlers.items()
+        if spec.concurrency is not None
+    }
+    if not limits:
+        return {}
+
+    running = dict(
+        db.session.execute(
+            select(Job.kind, func.count())
+            .where(Job.status == "running")
+            .where(Job.locked_at >= now - LEASE)
+            .where(Job.kind.in_(limits))
+            .group_by(Job.kind)
+        ).all()
+    )
+    return {kind: limit - running.get(kind, 0) for kind, limit in limits.items()}
+
+
+def run(job):
+    """Run a claimed `job` and record the outcome."""
+
+    spec = handlers.get(job.kind)
+
+    try:
+        if spec is None:
+            raise LookupError(f"No handler for job kind {job.kind!r}")
+        more = spec.fn(**job.payload)
+
+        if more:
+            job.status = "queued"
+            job.run_at = datetime.utcnow()
+            job.locked_at = None
+            job.attempts = 0
+        else:
+            db.session.delete(job)
+
+        db.session.commit()
+
+    except Exception as error:
+        # Record the failure in a fresh transaction; the rollback reloads
+        # the job as claimed.
+        db.session.rollback()
+        logger.exception("Job %s (%s) failed", job.id, job.kind)
+        retry_or_fail(job, error, spec.max_attempts if spec else 1)
+        db.session.commit()
+
+
+def retry_or_fail(job, error, max_attempts):
+    job.last_error = f"{type(error).__name__}: {error}"
+    job.locked_at = None
+
+    if job.attempts >= max_attempts:
+        job.status = "failed"
+    else:
+        delay = min(RETRY_DELAY * 2 ** (job.attempts - 1), MAX_RETRY_DELAY)
+        job.status = "queued"
+        job.run_at = datetime.utcnow() + delay
+
+
+def run_pending(kinds=None):
+    """Run due jobs until there are none left; return how many runs there were.
+
+    Claims one job at a time, so each is run straight after its claim.
+    """
+
+    count = 0
+
+    while True:
+        claimed = claim(1, kinds)
+        if not claimed:
+            return count
+
+        run(claimed[0])
+        count += 1
+
+
+def work(poll_interval=1.0, kinds=None):
+    """Run jobs forever, polling every `poll_interval` seconds when idle."""
+
+    logger.info("Worker started for %s", ", ".join(kinds or handlers))
+
+    while True:
+        if not run_pending(kinds):
+            db.session.remove()
+            time.sleep(poll_interval)
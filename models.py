@@ -1,15 +1,27 @@
 """SQLAlchemy models for Warbler."""
 
+from collections import namedtuple
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Text
+from sqlalchemy import DDL, Text, delete, event, exists, func, literal, select
+from sqlalchemy import insert, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Bundle
+
+from hashing import hasher
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 
+def dialect_insert(table):
+    """An INSERT into `table` supporting ON CONFLICT on this database."""
+
+    dialect = db.session.get_bind().dialect.name
+    insert = sqlite.insert if dialect == "sqlite" else postgresql.insert
+    return insert(table)
+
+
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
@@ -27,6 +39,83 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # When the follow happened: following/followers pages list newest first.
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=func.now(),
+    )
+
+    # Keyset pagination for both pages: who a user follows, and who follows
+    # them, each seeked by (created_at, other user's id). They also serve
+    # plain lookups in either direction.
+    __table_args__ = (
+        db.Index(
+            "ix_follows_following_created_at",
+            user_following_id,
+            created_at.desc(),
+            user_being_followed_id.desc(),
+        ),
+        db.Index(
+            "ix_follows_followed_created_at",
+            user_being_followed_id,
+            created_at.desc(),
+            user_following_id.desc(),
+        ),
+    )
+
+    @classmethod
+    def add(cls, user_id, followed_ids):
+        """Have `user_id` follow each user in `followed_ids`.
+
+        A single INSERT ... SELECT ... ON CONFLICT DO NOTHING: follows that
+        already exist, unknown or deleted ids and `user_id` itself are
+        skipped, and concurrent requests are safe. Returns the ids newly
+        followed.
+        """
+
+        if not followed_ids:
+            return []
+
+        followed = (
+            select(User.id, literal(user_id), literal(datetime.utcnow()))
+            .where(User.id.in_(followed_ids))
+            .where(User.id != user_id)
+            .where(User.deleted_at.is_(None))
+        )
+
+        return db.session.scalars(
+            dialect_insert(cls)
+            .from_select(
+                ["user_being_followed_id", "user_following_id", "created_at"],
+                followed,
+            )
+            .on_conflict_do_nothing(
+                index_elements=["user_being_followed_id", "user_following_id"]
+            )
+            .returning(cls.user_being_followed_id)
+        ).all()
+
+    @classmethod
+    def remove(cls, user_id, followed_ids):
+        """Have `user_id` stop following `followed_ids`, in one DELETE.
+
+        Returns the ids that were followed until now.
+        """
+
+        if not followed_ids:
+            return []
+
+        return db.session.scalars(
+            delete(cls)
+            .where(
+                cls.user_following_id == user_id,
+                cls.user_being_followed_id.in_(followed_ids),
+            )
+            .returning(cls.user_being_followed_id)
+        ).all()
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -37,12 +126,240 @@ class Likes(db.Model):
 
     user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="cascade"))
 
+    # Indexed for the cascade when messages are deleted
     message_id = db.Column(
-        db.Integer, db.ForeignKey("messages.id", ondelete="cascade"), unique=True
+        db.Integer, db.ForeignKey("messages.id", ondelete="cascade"), index=True
     )
 
+    __table_args__ = (
+        db.UniqueConstraint(
+            "user_id", "message_id", name="uq_likes_user_id_message_id"
+        ),
+    )
+
+    @classmethod
+    def add(cls, user_id, message_id):
+        """Like `message_id` as `user_id`, unless already liked.
+
+        A single INSERT ... ON CONFLICT DO NOTHING, so concurrent likes of the
+        same message are safe. Returns True if a like was added.
+        """
+
+        inserted = db.session.execute(
+            dialect_insert(cls)
+            .values(user_id=user_id, message_id=message_id)
+            .on_conflict_do_nothing(index_elements=["user_id", "message_id"])
+            .returning(cls.id)
+        ).first()
+
+        return inserted is not None
+
+    @classmethod
+    def remove(cls, user_id, message_id):
+        """Unlike `message_id` as `user_id`. Returns True if a like was removed."""
+
+        deleted = db.session.execute(
+            delete(cls)
+            .where(cls.user_id == user_id, cls.message_id == message_id)
+            .returning(cls.id)
+        ).first()
+
+        return deleted is not None
+
+
+class Memberships:
+    """Cached follow/like membership sets for one user.
+
+    Each set holds ids only and is loaded with a single query the first time
+    it is needed, so a page can ask "does the viewer follow X?" once per card
+    without a query per card. Instances are meant to live for one request.
+
+    When a `follow_graph.FollowIndex` is loaded (set as `graph`), follow
+    checks and id sets come from it instead, without a query.
+    """
+
+    graph = None
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self._following_ids = None
+        self._follower_ids = None
+        self._liked_ids = None
+        self._looked_up_ids = set()
+        self._looked_up_liked_ids = set()
+
+    @property
+    def following_ids(self):
+        """Ids of the users this user follows."""
+
+        if self._following_ids is None and self.graph is not None:
+            self._following_ids = set(self.graph.following_ids(self.user_id).tolist())
+
+        if self._following_ids is None:
+            self._following_ids = set(
+                db.session.scalars(
+                    select(Follows.user_being_followed_id).where(
+                        Follows.user_following_id == self.user_id
+                    )
+                )
+            )
+        return self._following_ids
+
+    @property
+    def follower_ids(self):
+        """Ids of the users following this user."""
+
+        if self._follower_ids is None and self.graph is not None:
+            self._follower_ids = set(self.graph.follower_ids(self.user_id).tolist())
+
+        if self._follower_ids is None:
+            self._follower_ids = set(
+                db.session.scalars(
+                    select(Follows.user_following_id).where(
+                        Follows.user_being_followed_id == self.user_id
+                    )
+                )
+            )
+        return self._follower_ids
+
+    def follows(self, user_id):
+        """Does this user follow `user_id`?"""
+
+        if self._following_ids is None and self.graph is not None:
+            return self.graph.is_following(self.user_id, user_id)
+        return user_id in self.following_ids
+
+    def followed_by(self, user_id):
+        """Is this user followed by `user_id`?"""
+
+        if self._follower_ids is None and self.graph is not None:
+            return self.graph.is_following(user_id, self.user_id)
+        return user_id in self.follower_ids
+
+    @property
+    def liked_ids(self):
+        """Ids of the messages this user has liked."""
+
+        if self._liked_ids is None:
+            self._liked_ids = set(
+                db.session.scalars(
+                    select(Likes.message_id).where(Likes.user_id == self.user_id)
+                )
+            )
+        return self._liked_ids
+
+    def load_likes(self, message_ids):
+        """Find out which of `message_ids` this user liked, in one query.
+
+        Call with the messages of a page before rendering it, so `likes()`
+        can answer for each without loading every like the user has made.
+        """
+
+        unchecked = set(message_ids) - self._looked_up_ids
+
+        if unchecked and self._liked_ids is None:
+            self._looked_up_liked_ids.update(
+                db.session.scalars(
+                    select(Likes.message_id).where(
+                        Likes.user_id == self.user_id,
+                        Likes.message_id.in_(unchecked),
+                    )
+                )
+            )
+            self._looked_up_ids.update(unchecked)
+
+    def likes(self, message_id):
+        """Has this user liked `message_id`?"""
+
+        if self._liked_ids is None and message_id in self._looked_up_ids:
+            return message_id in self._looked_up_liked_ids
+        return message_id in self.liked_ids
+
+
+class Counters:
+    """Denormalized count columns, as on `User` and `Message`.
+
+    Write paths keep the counts in step with `bump_counters()`; subclasses
+    define `counter_sources()` so that `reconcile_counters()` can repair any
+    drift.
+    """
+
+    @classmethod
+    def bump_counters(cls, id, **deltas):
+        """Add `deltas` to counter columns of row `id` in one UPDATE.
+
+        For example: `User.bump_counters(5, followers_count=1)`. Returns the
+        new values of the changed counters (a row), or None if there is no
+        such row.
+        """
+
+        values = {
+            getattr(cls, name): getattr(cls, name) + delta
+            for name, delta in deltas.items()
+        }
+        return db.session.execute(
+            update(cls)
+            .where(cls.id == id)
+            .values(values)
+            .returning(*values)
+        ).first()
+
+    @classmethod
+    def bump_counters_in(cls, ids, **deltas):
+        """Like `bump_counters()`, for every row in `ids` in one UPDATE."""
+
+        db.session.execute(
+            update(cls)
+            .where(cls.id.in_(ids))
+            .values(
+                {
+                    getattr(cls, name): getattr(cls, name) + delta
+                    for name, delta in deltas.items()
+                }
+            )
+        )
+
+    @classmethod
+    def counter_sources(cls):
+        """Map each counter column to a correlated COUNT(*) of its source rows."""
+
+        raise NotImplementedError
+
+    @classmethod
+    def reconcile_counters(cls, ids=None, batch_size=10000):
+        """Recompute counters that have drifted from the rows they count.
+
+        Only rows whose stored count is wrong are written. Pass `ids` to
+        limit the repair to those rows; otherwise every row is checked, in
+        id ranges of `batch_size`. Returns the number of counters fixed.
+        """
+
+        if ids is not None:
+            ranges = [cls.id.in_(ids)]
+        else:
+            max_id = db.session.scalar(select(func.max(cls.id))) or 0
+            ranges = [
+                cls.id.between(low, low + batch_size - 1)
+                for low in range(0, max_id + 1, batch_size)
+            ]
+
+        fixed = 0
 
-class User(db.Model):
+        for in_range in ranges:
+            for column, actual in cls.counter_sources().items():
+                result = db.session.execute(
+                    update(cls)
+                    .where(in_range)
+                    .where(column != actual)
+                    .values({column: actual})
+                    .execution_options(synchronize_session=False)
+                )
+                fixed += result.rowcount
+
+        return fixed
+
+
+class User(Counters, db.Model):
     """User in the system."""
 
     __tablename__ = "users"
@@ -71,6 +388,15 @@ class User(db.Model):
 
     header_image_url = db.Column(db.Text, default="/static/images/warbler-hero.jpg")
 
+    # Bumped whenever the profile is edited; cached message cards showing
+    # this user are keyed on it (see fragments.py).
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
     bio = db.Column(
         db.Text,
     )
@@ -84,13 +410,52 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship("Message")
+    # Denormalized counts for the stats cards, kept in step by the write
+    # paths in app.py and repaired by `reconcile_counters()`.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Set when the account is deleted. It is hidden from then on, and its
+    # rows are purged in the background (see accounts.py).
+    deleted_at = db.Column(db.DateTime)
+
+    # passive_deletes: deleting a User leaves its messages, follows and likes
+    # to the database's ON DELETE CASCADE rather than loading each one first.
+
+    messages = db.relationship("Message", passive_deletes=True)
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
         secondaryjoin=(Follows.user_following_id == id),
+        passive_deletes=True,
     )
 
     following = db.relationship(
@@ -98,24 +463,68 @@ class User(db.Model):
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
         secondaryjoin=(Follows.user_being_followed_id == id),
+        passive_deletes=True,
     )
 
-    likes = db.relationship("Message", secondary="likes")
+    likes = db.relationship("Message", secondary="likes", passive_deletes=True)
 
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    # Set by `cache_memberships()`; checks below fall back to single-row
+    # EXISTS queries when it is None.
+    memberships = None
+
+    def cache_memberships(self):
+        """Answer follow/like checks on this user from cached id sets.
+
+        Use for the logged-in user for the length of one request, so list
+        pages cost a constant number of queries however many cards they show.
+        """
+
+        self.memberships = Memberships(self.id)
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        if self.memberships is not None:
+            return self.memberships.followed_by(other_user.id)
+
+        return db.session.scalar(
+            select(
+                exists()
+                .where(Follows.user_being_followed_id == self.id)
+                .where(Follows.user_following_id == other_user.id)
+            )
+        )
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_user`?"""
+
+        if self.memberships is not None:
+            return self.memberships.follows(other_user.id)
+
+        return db.session.scalar(
+            select(
+                exists()
+                .where(Follows.user_following_id == self.id)
+                .where(Follows.user_being_followed_id == other_user.id)
+            )
+        )
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+    def has_liked(self, message):
+        """Has this user liked `message`?"""
+
+        if self.memberships is not None:
+            return self.memberships.likes(message.id)
+
+        return db.session.scalar(
+            select(
+                exists()
+                .where(Likes.user_id == self.id)
+                .where(Likes.message_id == message.id)
+            )
+        )
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -124,7 +533,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode("UTF-8")
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -144,20 +553,125 @@ class User(db.Model):
         It searches for a user whose password hash matches this password
         and, if it finds such a user, returns that user object.
 
-        If can't find matching user (or if password is wrong), returns False.
+        If can't find matching user (or if password is wrong, or the account
+        has been deleted), returns False.
+
+        If the stored hash was made at a different cost than the configured
+        one, it is replaced with a fresh hash (the caller should commit).
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deleted_at=None).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
 
         return False
 
+    @classmethod
+    def counter_sources(cls):
+        """Map each counter column to a correlated COUNT(*) of its source rows."""
+
+        def count_of(model, column):
+            return (
+                select(func.count())
+                .select_from(model)
+                .where(column == cls.id)
+                .scalar_subquery()
+            )
+
+        return {
+            cls.messages_count: count_of(Message, Message.user_id),
+            cls.following_count: count_of(Follows, Follows.user_following_id),
+            cls.followers_count: count_of(Follows, Follows.user_being_followed_id),
+            cls.likes_count: count_of(Likes, Likes.user_id),
+        }
+
+
+# Search indexes over username, bio and location (see search.py).
+#
+# Postgres: a GIN full-text index, plus pg_trgm trigram indexes that serve
+# case-insensitive substring matches when that extension can be installed.
+# SQLite: an FTS5 trigram table kept in sync by triggers.
 
-class Message(db.Model):
+USER_SEARCH_DOCUMENT = (
+    "coalesce(username, '') || ' ' || coalesce(bio, '') || ' ' "
+    "|| coalesce(location, '')"
+)
+
+event.listen(
+    User.__table__,
+    "after_create",
+    DDL(
+        f"""
+        CREATE INDEX ix_users_search_tsv ON users
+            USING gin (to_tsvector('simple', {USER_SEARCH_DOCUMENT}));
+
+        DO $$
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'
+            ) THEN
+                CREATE EXTENSION IF NOT EXISTS pg_trgm;
+                CREATE INDEX ix_users_username_trgm ON users
+                    USING gin (username gin_trgm_ops);
+                CREATE INDEX ix_users_bio_trgm ON users
+                    USING gin (bio gin_trgm_ops);
+                CREATE INDEX ix_users_location_trgm ON users
+                    USING gin (location gin_trgm_ops);
+            END IF;
+        EXCEPTION WHEN insufficient_privilege THEN
+            RAISE NOTICE 'pg_trgm unavailable; user search uses full text only';
+        END
+        $$;
+        """
+    ).execute_if(dialect="postgresql"),
+)
+
+for statement in [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+        username, bio, location,
+        content='users', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER users_fts_insert AFTER INSERT ON users BEGIN
+        INSERT INTO users_fts (rowid, username, bio, location)
+        VALUES (new.id, new.username, new.bio, new.location);
+    END
+    """,
+    """
+    CREATE TRIGGER users_fts_delete AFTER DELETE ON users BEGIN
+        INSERT INTO users_fts (users_fts, rowid, username, bio, location)
+        VALUES ('delete', old.id, old.username, old.bio, old.location);
+    END
+    """,
+    """
+    CREATE TRIGGER users_fts_update AFTER UPDATE OF username, bio, location
+    ON users BEGIN
+        INSERT INTO users_fts (users_fts, rowid, username, bio, location)
+        VALUES ('delete', old.id, old.username, old.bio, old.location);
+        INSERT INTO users_fts (rowid, username, bio, location)
+        VALUES (new.id, new.username, new.bio, new.location);
+    END
+    """,
+]:
+    event.listen(
+        User.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite")
+    )
+
+event.listen(
+    User.__table__,
+    "before_drop",
+    DDL("DROP TABLE IF EXISTS users_fts").execute_if(dialect="sqlite"),
+)
+
+
+class Message(Counters, db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = "messages"
@@ -175,7 +689,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -184,7 +698,389 @@ class Message(db.Model):
         nullable=False,
     )
 
-    user = db.relationship("User")
+    # Kept in step by `add_like()`; see `Counters`.
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Authors of a batch of messages load together in one extra SELECT;
+    # feed pages go further and join them in with `feed_query()`.
+    user = db.relationship("User", lazy="selectin")
+
+    __table_args__ = (
+        db.Index(
+            "ix_messages_user_id_timestamp_id",
+            user_id,
+            timestamp.desc(),
+            id.desc(),
+        ),
+    )
+
+    @classmethod
+    def counter_sources(cls):
+        """Map each counter column to a correlated COUNT(*) of its source rows."""
+
+        return {
+            cls.likes_count: select(func.count())
+            .select_from(Likes)
+            .where(Likes.message_id == cls.id)
+            .scalar_subquery(),
+        }
+
+
+# Full-text index over message text (see search.py). The index is updated
+# by the database itself as messages are inserted and deleted.
+#
+# Postgres: a GIN index over the English tsvector of the text.
+# SQLite: an FTS5 table kept in sync by triggers.
+
+MESSAGE_SEARCH_DOCUMENT = "to_tsvector('english', text)"
+
+event.listen(
+    Message.__table__,
+    "after_create",
+    DDL(
+        "CREATE INDEX ix_messages_search_tsv ON messages "
+        f"USING gin ({MESSAGE_SEARCH_DOCUMENT})"
+    ).execute_if(dialect="postgresql"),
+)
+
+for statement in [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        text, content='messages', content_rowid='id', tokenize='porter'
+    )
+    """,
+    """
+    CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+    """
+    CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text)
+        VALUES ('delete', old.id, old.text);
+    END
+    """,
+    """
+    CREATE TRIGGER messages_fts_update AFTER UPDATE OF text ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text)
+        VALUES ('delete', old.id, old.text);
+        INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+]:
+    event.listen(
+        Message.__table__,
+        "after_create",
+        DDL(statement).execute_if(dialect="sqlite"),
+    )
+
+event.listen(
+    Message.__table__,
+    "before_drop",
+    DDL("DROP TABLE IF EXISTS messages_fts").execute_if(dialect="sqlite"),
+)
+
+
+class TimelineEntry(db.Model):
+    """A message delivered to a user's materialized home timeline."""
+
+    __tablename__ = "timelines"
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id", ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey("messages.id", ondelete="cascade"),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id", ondelete="cascade"),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index(
+            "ix_timelines_user_id_timestamp",
+            user_id,
+            timestamp.desc(),
+            message_id.desc(),
+        ),
+        db.Index("ix_timelines_user_id_author_id", user_id, author_id),
+        db.Index("ix_timelines_message_id", message_id),
+        db.Index("ix_timelines_author_id", author_id),
+    )
+
+
+class Suggestion(db.Model):
+    """A precomputed who-to-follow suggestion (see recommendations.py)."""
+
+    __tablename__ = "suggestions"
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id", ondelete="cascade"),
+        primary_key=True,
+    )
+
+    # 0 is the best suggestion
+    rank = db.Column(db.Integer, primary_key=True)
+
+    # Indexed so deleting a user does not scan every suggestion
+    suggested_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id", ondelete="cascade"),
+        nullable=False,
+        index=True,
+    )
+
+    # How many of the people `user_id` follows follow `suggested_id`
+    mutuals = db.Column(db.Integer, nullable=False)
+
+    score = db.Column(db.Float, nullable=False)
+
+
+class StaleSuggestions(db.Model):
+    """A user whose follows changed since their suggestions were computed."""
+
+    __tablename__ = "stale_suggestions"
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id", ondelete="cascade"),
+        primary_key=True,
+    )
+
+    marked_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class FollowChange(db.Model):
+    """A follow or unfollow, logged for in-memory follow graphs to replay.
+
+    See follow_graph.py. Ids are not foreign keys, so the log outlives the
+    users it mentions.
+    """
+
+    __tablename__ = "follow_changes"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    follower_id = db.Column(db.Integer, nullable=False)
+
+    followed_id = db.Column(db.Integer, nullable=False)
+
+    # True for a follow, False for an unfollow
+    following = db.Column(db.Boolean, nullable=False)
+
+    changed_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow, index=True
+    )
+
+    @classmethod
+    def record(cls, follower_id, followed_ids, following):
+        """Log that `follower_id` followed (or unfollowed) `followed_ids`."""
+
+        cls.record_pairs(
+            [(follower_id, followed_id) for followed_id in followed_ids], following
+        )
+
+    @classmethod
+    def record_pairs(cls, pairs, following):
+        """Log a follow (or unfollow) for each `(follower_id, followed_id)`."""
+
+        if not pairs:
+            return
+
+        now = datetime.utcnow()
+        db.session.execute(
+            insert(cls).values(
+                [
+                    dict(
+                        follower_id=follower_id,
+                        followed_id=followed_id,
+                        following=following,
+                        changed_at=now,
+                    )
+                    for follower_id, followed_id in pairs
+                ]
+            )
+        )
+
+
+class Job(db.Model):
+    """A unit of background work (see jobs.py)."""
+
+    __tablename__ = "jobs"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # Name of the registered handler to run
+    kind = db.Column(db.Text, nullable=False)
+
+    # Keyword arguments for the handler
+    payload = db.Column(db.JSON, nullable=False, default=dict)
+
+    # "queued", "running" or "failed"; finished jobs are deleted
+    status = db.Column(db.Text, nullable=False, default="queued")
+
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    # When a worker claimed it; a running job whose claim is older than the
+    # lease is presumed abandoned and run again
+    locked_at = db.Column(db.DateTime)
+
+    last_error = db.Column(db.Text)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (db.Index("ix_jobs_status_run_at", "status", "run_at"),)
+
+
+##############################################################################
+# Read models
+#
+# List pages show a few fields of each row. Rather than ORM entities (every
+# column down to the password hash, plus identity-map and change-tracking
+# bookkeeping nothing uses), they select just those columns into named
+# tuples. Being tuples, they are read-only and cheap to build and keep.
+
+
+class ReadModel(Bundle):
+    """Selects `columns` and builds `factory(*values)` from each row.
+
+    Alone in a query, the query returns the built objects themselves.
+    """
+
+    def __init__(self, name, factory, *columns):
+        super().__init__(name, *columns, single_entity=True)
+        self.factory = factory
+
+    def create_row_processor(self, query, procs, labels):
+        factory = self.factory
+
+        def make(row):
+            return factory(*[proc(row) for proc in procs])
+
+        return make
+
+
+UserCard = namedtuple(
+    "UserCard", ["id", "username", "image_url", "header_image_url", "bio"]
+)
+
+Author = namedtuple("Author", ["id", "username", "image_url", "profile_version"])
+
+FeedEntry = namedtuple("FeedEntry", ["id", "text", "timestamp", "likes_count", "user"])
+
+
+# A suggested user, with how many of the viewer's follows follow them.
+SuggestionCard = namedtuple("SuggestionCard", UserCard._fields + ("mutuals",))
+
+# A user on a following/followers page; `timestamp` is when the follow began.
+FollowCard = namedtuple("FollowCard", UserCard._fields + ("timestamp",))
+
+
+def _feed_entry(id, text, timestamp, likes_count, *author):
+    return FeedEntry(id, text, timestamp, likes_count, Author(*author))
+
+
+USER_CARD = ReadModel(
+    "user_card",
+    UserCard,
+    User.id,
+    User.username,
+    User.image_url,
+    User.header_image_url,
+    User.bio,
+)
+
+FOLLOW_CARD = ReadModel(
+    "follow_card",
+    FollowCard,
+    *USER_CARD.exprs,
+    Follows.created_at,
+)
+
+SUGGESTION_CARD = ReadModel(
+    "suggestion_card",
+    SuggestionCard,
+    *USER_CARD.exprs,
+    Suggestion.mutuals,
+)
+
+FEED_ENTRY = ReadModel(
+    "feed_entry",
+    _feed_entry,
+    Message.id,
+    Message.text,
+    Message.timestamp,
+    Message.likes_count,
+    User.id,
+    User.username,
+    User.image_url,
+    User.profile_version,
+)
+
+
+def user_card_query():
+    """Base query for pages listing users: yields `UserCard`s."""
+
+    return db.session.query(USER_CARD).filter(User.deleted_at.is_(None))
+
+
+def following_query(user_id):
+    """`FollowCard`s for the users `user_id` follows (paginate on Follows)."""
+
+    return (
+        db.session.query(FOLLOW_CARD)
+        .select_from(Follows)
+        .join(User, User.id == Follows.user_being_followed_id)
+        .filter(Follows.user_following_id == user_id)
+        .filter(User.deleted_at.is_(None))
+    )
+
+
+def followers_query(user_id):
+    """`FollowCard`s for the users following `user_id` (paginate on Follows)."""
+
+    return (
+        db.session.query(FOLLOW_CARD)
+        .select_from(Follows)
+        .join(User, User.id == Follows.user_following_id)
+        .filter(Follows.user_being_followed_id == user_id)
+        .filter(User.deleted_at.is_(None))
+    )
+
+
+def feed_query():
+    """Base query shared by every feed page: yields `FeedEntry`s.
+
+    Each entry carries its author (`msg.user`), joined into the same round
+    trip. Messages by deleted accounts awaiting their purge are left out.
+    """
+
+    return (
+        db.session.query(FEED_ENTRY)
+        .join(User, User.id == Message.user_id)
+        .filter(User.deleted_at.is_(None))
+    )
 
 
 def connect_db(app):
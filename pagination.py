@@ -0,0 +1,98 @@
+"""Keyset (cursor) pagination for Warbler feeds.
+
+Feeds are ordered newest first by `(timestamp, id)`. Instead of an OFFSET,
+each page ends with a cursor naming its last row, and the next page asks for
+rows strictly older than that cursor. The database seeks straight to the
+cursor through an index, so page 1,000 costs the same as page 1.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+Page = namedtuple("Page", ["items", "next_cursor"])
+
+
+def _encode(*parts):
+    raw = "|".join(str(part) for part in parts).encode("UTF-8")
+    return urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode(cursor, *types):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        parts = urlsafe_b64decode(padded).decode("UTF-8").split("|")
+        if len(parts) != len(types):
+            raise ValueError
+        return tuple(convert(part) for convert, part in zip(types, parts))
+    except (TypeError, UnicodeDecodeError, ValueError) as exc:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from exc
+
+
+def encode_cursor(timestamp, id):
+    """Encode the `(timestamp, id)` position of a row as an opaque string."""
+
+    return _encode(timestamp.isoformat(), id)
+
+
+def decode_cursor(cursor):
+    """Decode a cursor made by `encode_cursor`.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    return _decode(cursor, datetime.fromisoformat, int)
+
+
+def encode_rank_cursor(rank, id, low, high):
+    """Encode the `(rank, id)` position of a ranked search result.
+
+    `low` and `high` bound the ids the search ranked, so later pages rank
+    the same candidates.
+    """
+
+    return _encode(repr(float(rank)), id, low, high)
+
+
+def decode_rank_cursor(cursor):
+    """Decode a cursor made by `encode_rank_cursor`.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    return _decode(cursor, float, int, int, int)
+
+
+def older_than(timestamp_col, id_col, cursor):
+    """SQL criterion selecting rows that sort after `cursor` (newest first)."""
+
+    return tuple_(timestamp_col, id_col) < tuple_(*cursor)
+
+
+def make_page(rows, limit):
+    """Build a Page from up to `limit + 1` rows fetched newest first.
+
+    The extra row only tells us whether another page exists; it is dropped.
+    """
+
+    if len(rows) <= limit:
+        return Page(rows, None)
+
+    items = rows[:limit]
+    last = items[-1]
+    return Page(items, encode_cursor(last.timestamp, last.id))
+
+
+def paginate(query, timestamp_col, id_col, before=None, limit=100):
+    """Return one Page of `query`, ordered newest first.
+
+    `before` is a decoded cursor (or None for the first page).
+    """
+
+    if before is not None:
+        query = query.filter(older_than(timestamp_col, id_col, before))
+
+    rows = query.order_by(timestamp_col.desc(), id_col.desc()).limit(limit + 1).all()
+    return make_page(rows, limit)
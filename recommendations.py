@@ -0,0 +1,242 @@
+"""Who-to-follow suggestions.
+
+Suggestions are friends of friends: users followed by the people you
+follow, scored by how many of them do (their "mutuals") plus a nudge for
+how active the candidate has been in the last RECENT_DAYS days. Users you
+already follow, and you, are never suggested.
+
+The batch job (`flask compute-suggestions`) loads the whole follow graph
+into a `follow_graph.FollowGraph`, a CSR adjacency matrix held in NumPy
+arrays the way `scipy.sparse.csr_matrix` holds one. A user's friends of
+friends are then a gather over a few array slices, and their mutual
+counts one `np.unique`. The best SUGGESTIONS_PER_USER candidates per user
+are stored in `suggestions` by rank, so `/users/suggestions` reads them
+back with a single primary-key range scan, however large the graph.
+
+When a user follows or unfollows someone, `follows_changed()` drops
+suggestions they now follow and marks the user stale; `refresh_stale()`
+(`flask compute-suggestions --stale`) recomputes just those users, one SQL
+query each, between full runs.
+"""
+
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import delete, func, select
+
+from follow_graph import FollowGraph
+from models import db, dialect_insert, Follows, Message, StaleSuggestions
+from models import Suggestion, SUGGESTION_CARD, User
+import bulk_import
+
+SUGGESTIONS_PER_USER = 20
+RECENT_DAYS = 30
+ACTIVITY_WEIGHT = 0.5
+
+COLUMNS = ["user_id", "rank", "suggested_id", "mutuals", "score"]
+
+
+def recent_activity(size):
+    """Messages posted in the last RECENT_DAYS days, indexed by user id."""
+
+    since = datetime.utcnow() - timedelta(days=RECENT_DAYS)
+    activity = np.zeros(size, dtype=np.int64)
+
+    rows = db.session.execute(
+        select(Message.user_id, func.count())
+        .where(Message.timestamp >= since)
+        .group_by(Message.user_id)
+    ).all()
+
+    for user_id, count in rows:
+        if user_id < size:
+            activity[user_id] = count
+
+    return activity
+
+
+def score(mutuals, activity):
+    return mutuals + ACTIVITY_WEIGHT * np.log1p(activity)
+
+
+def top(candidates, mutuals, scores, limit=SUGGESTIONS_PER_USER):
+    """The best `limit` candidates: highest score first, then lowest id."""
+
+    if len(candidates) > limit:
+        best = np.argpartition(-scores, limit - 1)[:limit]
+        candidates, mutuals, scores = candidates[best], mutuals[best], scores[best]
+
+    order = np.lexsort((candidates, -scores))
+    return candidates[order], mutuals[order], scores[order]
+
+
+def suggest(graph, activity, user_id, limit=SUGGESTIONS_PER_USER):
+    """Return `(ids, mutuals, scores)` arrays of suggestions for `user_id`."""
+
+    followed = graph.following(user_id)
+    candidates, mutuals = np.unique(
+        graph.following_of_all(followed), return_counts=True
+    )
+
+    keep = ~np.isin(candidates, followed, assume_unique=True) & (candidates != user_id)
+    candidates, mutuals = candidates[keep], mutuals[keep]
+
+    return top(candidates, mutuals, score(mutuals, activity[candidates]), limit)
+
+
+def rows_for(user_id, ids, mutuals, scores):
+    return [
+        (user_id, rank, int(suggested_id), int(count), float(value))
+        for rank, (suggested_id, count, value) in enumerate(zip(ids, mutuals, scores))
+    ]
+
+
+def save(user_ids, rows):
+    """Replace the suggestions of `user_ids` with `rows`."""
+
+    db.session.execute(delete(Suggestion).where(Suggestion.user_id.in_(user_ids)))
+
+    if rows:
+        bulk_import.insert_rows(
+            db.session.connection(), Suggestion.__table__, COLUMNS, rows
+        )
+
+
+def rebuild(batch_size=1000, progress=None):
+    """Recompute every user's suggestions; return the number of users done.
+
+    Commits after each batch of `batch_size` users. `progress`, if given,
+    is called with the number of users done so far.
+    """
+
+    started = datetime.utcnow()
+    graph = FollowGraph.load()
+    activity = recent_activity(graph.size)
+    user_ids = db.session.scalars(select(User.id).order_by(User.id)).all()
+
+    for low in range(0, len(user_ids), batch_size):
+        batch = user_ids[low : low + batch_size]
+        rows = []
+        for user_id in batch:
+            rows += rows_for(user_id, *suggest(graph, activity, user_id))
+
+        save(batch, rows)
+        db.session.commit()
+
+        if progress is not None:
+            progress(low + len(batch))
+
+    # Users marked while the graph was being read stay stale.
+    db.session.execute(
+        delete(StaleSuggestions).where(StaleSuggestions.marked_at < started)
+    )
+    db.session.commit()
+
+    return len(user_ids)
+
+
+##############################################################################
+# Incremental updates
+
+
+def follows_changed(user_id, followed_ids=(), unfollowed_ids=()):
+    """Keep `user_id`'s suggestions in step with a change to their follows.
+
+    Newly followed users stop being suggested at once; the rest waits for
+    `refresh_stale()`.
+    """
+
+    if followed_ids:
+        db.session.execute(
+            delete(Suggestion)
+            .where(Suggestion.user_id == user_id)
+            .where(Suggestion.suggested_id.in_(followed_ids))
+        )
+
+    if followed_ids or unfollowed_ids:
+        # Move an existing mark forward, so a refresh or rebuild that began
+        # before this change doesn't clear it.
+        mark = dialect_insert(StaleSuggestions).values(
+            user_id=user_id, marked_at=datetime.utcnow()
+        )
+        db.session.execute(
+            mark.on_conflict_do_update(
+                index_elements=["user_id"],
+                set_={"marked_at": mark.excluded.marked_at},
+            )
+        )
+
+
+def suggest_from_sql(user_id, limit=SUGGESTIONS_PER_USER):
+    """Like `suggest()`, but with one query instead of the whole graph."""
+
+    mine = (
+        select(Follows.user_being_followed_id)
+        .where(Follows.user_following_id == user_id)
+        .scalar_subquery()
+    )
+
+    rows = db.session.execute(
+        select(Follows.user_being_followed_id, func.count())
+        .where(Follows.user_following_id.in_(mine))
+        .where(Follows.user_being_followed_id != user_id)
+        .where(Follows.user_being_followed_id.not_in(mine))
+        .group_by(Follows.user_being_followed_id)
+    ).all()
+
+    if not rows:
+        return top(np.array([], dtype=np.int64), np.array([]), np.array([]), limit)
+
+    candidates, mutuals = (np.array(column) for column in zip(*rows))
+
+    since = datetime.utcnow() - timedelta(days=RECENT_DAYS)
+    activity = dict(
+        db.session.execute(
+            select(Message.user_id, func.count())
+            .where(Message.user_id.in_(candidates.tolist()))
+            .where(Message.timestamp >= since)
+            .group_by(Message.user_id)
+        ).all()
+    )
+    recent = np.array([activity.get(int(c), 0) for c in candidates])
+
+    return top(candidates, mutuals, score(mutuals, recent), limit)
+
+
+def refresh_stale(limit=None):
+    """Recompute the suggestions of users marked stale; return how many."""
+
+    query = select(StaleSuggestions.user_id, StaleSuggestions.marked_at)
+    if limit is not None:
+        query = query.limit(limit)
+
+    stale = db.session.execute(query).all()
+
+    for user_id, marked_at in stale:
+        save([user_id], rows_for(user_id, *suggest_from_sql(user_id)))
+        db.session.execute(
+            delete(StaleSuggestions)
+            .where(StaleSuggestions.user_id == user_id)
+            .where(StaleSuggestions.marked_at == marked_at)
+        )
+        db.session.commit()
+
+    return len(stale)
+
+
+##############################################################################
+# Reading
+
+
+def suggestions_for(user_id):
+    """`SuggestionCard`s for `user_id`, best first."""
+
+    return (
+        db.session.query(SUGGESTION_CARD)
+        .select_from(Suggestion)
+        .join(User, User.id == Suggestion.suggested_id)
+        .filter(Suggestion.user_id == user_id)
+        .filter(User.deleted_at.is_(None))
+        .order_by(Suggestion.rank)
+        .all()
+    )
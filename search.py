@@ -0,0 +1,324 @@
+"""User search for `/users?q=` and message search for `/messages/search?q=`.
+
+User search
+-----------
+
+Matches the query against username, bio and location, case-insensitively,
+using whichever index the database offers (see the DDL after `User` in
+models.py):
+
+- Postgres with pg_trgm: substring match through trigram GIN indexes,
+  ranked by trigram similarity.
+- Postgres without pg_trgm: full-text prefix match on each word, ranked
+  with ts_rank.
+- SQLite: an FTS5 trigram table, ranked with bm25.
+
+Results come a page at a time; ranked results are paged by number up to
+MAX_SEARCH_PAGES, since nobody reads past that. On Postgres only the first
+MAX_CANDIDATES matches are ranked, so a very common term costs no more than
+a rare one. The unfiltered listing is paged by id and never loads the whole
+table.
+
+Message search
+--------------
+
+Matches words in message text (English stemming: "birds" finds "bird")
+through the full-text index defined after `Message` in models.py. The
+MAX_MESSAGE_CANDIDATES most recent matches are ranked (ts_rank on
+Postgres, bm25 on SQLite). They are found by walking back from the newest
+message MESSAGE_SCAN_WINDOW ids at a time, at most MAX_MESSAGE_SCAN_WINDOWS
+times, so a query reads a bounded id range however many messages contain
+its words; matches older than that are not found.
+
+Results are keyset-paginated on (rank, id). The first page fixes the id
+range it ranked and the cursor carries it, so later pages rank the same
+candidates even as new messages arrive.
+"""
+
+import re
+
+from sqlalchemy import Double, cast, func, literal_column, or_, select, text, tuple_
+
+from models import db, feed_query, user_card_query, Message, User, USER_CARD
+from models import MESSAGE_SEARCH_DOCUMENT, USER_SEARCH_DOCUMENT
+from pagination import Page, encode_rank_cursor
+
+PAGE_SIZE = 30
+MAX_SEARCH_PAGES = 10
+MAX_CANDIDATES = 1000
+MAX_MESSAGE_CANDIDATES = 5000
+MESSAGE_SCAN_WINDOW = 100000
+MAX_MESSAGE_SCAN_WINDOWS = 10
+USER_LIST_LIMIT = 100
+
+_has_trigrams = {}
+
+
+def has_trigrams():
+    """Is pg_trgm installed in the (Postgres) database? Cached per engine."""
+
+    engine = db.engine
+
+    if engine not in _has_trigrams:
+        _has_trigrams[engine] = db.session.scalar(
+            text(
+                "SELECT EXISTS "
+                "(SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')"
+            )
+        )
+
+    return _has_trigrams[engine]
+
+
+def escape_like(value):
+    """Escape LIKE wildcards so `value` matches literally."""
+
+    return re.sub(r"([\\%_])", r"\\\1", value)
+
+
+def list_users(after=None, limit=None):
+    """Return (users, next_after) for the unfiltered listing, ordered by id.
+
+    Users are `UserCard`s. Pages hold `limit` users (default
+    USER_LIST_LIMIT). `next_after` is the id to pass as `after` for the next
+    page, or None.
+    """
+
+    limit = limit or USER_LIST_LIMIT
+    query = user_card_query().order_by(User.id)
+
+    if after is not None:
+        query = query.filter(User.id > after)
+
+    users = query.limit(limit + 1).all()
+
+    if len(users) > limit:
+        return users[:limit], users[limit - 1].id
+
+    return users, None
+
+
+def search_users(q, page=1):
+    """Return (users, has_more) for page `page` of the results for `q`.
+
+    Users are `UserCard`s.
+    """
+
+    q = q.strip()
+    page = max(1, min(page, MAX_SEARCH_PAGES))
+
+    if not q:
+        return [], False
+
+    dialect = db.engine.dialect.name
+
+    if dialect == "postgresql" and has_trigrams():
+        query = _trigram_query(q)
+    elif dialect == "postgresql":
+        query = _full_text_query(q)
+    elif dialect == "sqlite" and len(q) >= 3:
+        query = _fts5_query(q)
+    else:
+        query = _like_query(q)
+
+    users = list(
+        db.session.scalars(
+            query.offset((page - 1) * PAGE_SIZE).limit(PAGE_SIZE + 1)
+        )
+    )
+
+    has_more = len(users) > PAGE_SIZE and page < MAX_SEARCH_PAGES
+    return users[:PAGE_SIZE], has_more
+
+
+def _like_match(q):
+    pattern = f"%{escape_like(q)}%"
+
+    return or_(
+        User.username.ilike(pattern, escape="\\"),
+        User.bio.ilike(pattern, escape="\\"),
+        User.location.ilike(pattern, escape="\\"),
+    )
+
+
+def _ranked(match, rank):
+    """Rank at most MAX_CANDIDATES users satisfying `match`, best first."""
+
+    candidates = (
+        select(User.id)
+        .where(match)
+        .where(User.deleted_at.is_(None))
+        .limit(MAX_CANDIDATES)
+    )
+
+    return (
+        select(USER_CARD)
+        .where(User.id.in_(candidates))
+        .order_by(rank.desc(), User.id)
+    )
+
+
+def _like_query(q):
+    return (
+        select(USER_CARD)
+        .where(_like_match(q))
+        .where(User.deleted_at.is_(None))
+        .order_by(
+            User.username.ilike(f"{escape_like(q)}%", escape="\\").desc(), User.id
+        )
+    )
+
+
+def _trigram_query(q):
+    similarity = func.greatest(
+        func.similarity(User.username, q),
+        func.coalesce(func.word_similarity(q, User.bio), 0),
+        func.coalesce(func.word_similarity(q, User.location), 0),
+    )
+
+    return _ranked(_like_match(q), similarity)
+
+
+def _full_text_query(q):
+    words = re.findall(r"\w+", q.lower())
+
+    if not words:
+        return _like_query(q)
+
+    # Every word must match as a prefix ("war" finds "warbler"). The
+    # document expression must match the index definition exactly.
+    config = literal_column("'simple'")
+    query = func.to_tsquery(config, " & ".join(f"{word}:*" for word in words))
+    document = func.to_tsvector(config, literal_column(USER_SEARCH_DOCUMENT))
+
+    return _ranked(document.op("@@")(query), func.ts_rank(document, query))
+
+
+def _fts5_query(q):
+    phrase = '"' + q.replace('"', '""') + '"'
+
+    matches = (
+        select(
+            literal_column("rowid").label("id"),
+            literal_column("rank").label("rank"),
+        )
+        .select_from(text("users_fts"))
+        .where(text("users_fts MATCH :phrase").bindparams(phrase=phrase))
+        .subquery()
+    )
+
+    return (
+        select(USER_CARD)
+        .join(matches, matches.c.id == User.id)
+        .where(User.deleted_at.is_(None))
+        .order_by(matches.c.rank, User.id)
+    )
+
+
+def search_messages(q, after=None, limit=PAGE_SIZE):
+    """Return a Page of messages matching `q`, best match first.
+
+    `after` is a decoded rank cursor (see pagination.encode_rank_cursor)
+    naming the last result of the previous page and the id range ranked.
+    """
+
+    words = re.findall(r"\w+", q.lower())
+
+    if not words:
+        return Page([], None)
+
+    if db.engine.dialect.name == "postgresql":
+        matches, rank = _message_matches_postgres(" ".join(words))
+    else:
+        matches, rank = _message_matches_sqlite(words)
+
+    if after is None:
+        low, high = _candidate_window(matches)
+    else:
+        low, high = after[2:]
+
+    candidates = (
+        matches.add_columns(rank.label("score"))
+        .where(matches.selected_columns.id > low)
+        .where(matches.selected_columns.id <= high)
+        .order_by(matches.selected_columns.id.desc())
+        .limit(MAX_MESSAGE_CANDIDATES)
+        .subquery()
+    )
+
+    query = (
+        feed_query()
+        .join(candidates, candidates.c.id == Message.id)
+        .add_columns(candidates.c.score)
+    )
+
+    if after is not None:
+        query = query.filter(
+            tuple_(candidates.c.score, candidates.c.id) < tuple_(*after[:2])
+        )
+
+    rows = (
+        query.order_by(candidates.c.score.desc(), candidates.c.id.desc())
+        .limit(limit + 1)
+        .all()
+    )
+
+    messages = [message for message, score in rows[:limit]]
+
+    if len(rows) <= limit:
+        return Page(messages, None)
+
+    message, score = rows[limit - 1]
+    return Page(messages, encode_rank_cursor(score, message.id, low, high))
+
+
+def _candidate_window(matches):
+    """Return the (low, high] id range holding the messages to rank.
+
+    Walks back from the newest message a window at a time until it has
+    MAX_MESSAGE_CANDIDATES matches or has read MAX_MESSAGE_SCAN_WINDOWS
+    windows. Each count reads one id range, never every match.
+    """
+
+    high = db.session.scalar(select(func.coalesce(func.max(Message.id), 0)))
+    low = high
+    found = 0
+    ids = matches.selected_columns.id
+
+    for _ in range(MAX_MESSAGE_SCAN_WINDOWS):
+        if low <= 0 or found >= MAX_MESSAGE_CANDIDATES:
+            break
+
+        start = max(low - MESSAGE_SCAN_WINDOW, 0)
+        window = (
+            matches.where(ids > start)
+            .where(ids <= low)
+            .limit(MAX_MESSAGE_CANDIDATES - found)
+            .subquery()
+        )
+        found += db.session.scalar(select(func.count()).select_from(window))
+        low = start
+
+    return low, high
+
+
+def _message_matches_postgres(q):
+    query = func.plainto_tsquery(literal_column("'english'"), q)
+    document = literal_column(MESSAGE_SEARCH_DOCUMENT)
+
+    # ts_rank returns a float4; widen it so cursors round-trip exactly.
+    score = cast(func.ts_rank(document, query), Double)
+
+    return select(Message.id.label("id")).where(document.op("@@")(query)), score
+
+
+def _message_matches_sqlite(words):
+    phrase = " ".join('"' + word.replace('"', '""') + '"' for word in words)
+
+    matches = (
+        select(literal_column("rowid").label("id"))
+        .select_from(text("messages_fts"))
+        .where(text("messages_fts MATCH :phrase").bindparams(phrase=phrase))
+    )
+
+    return matches, -literal_column("rank")
@@ -1,20 +1,76 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
+
+    python seed.py [--data-dir generator] [--batch-size 50000]
+
+Loads every users*.csv, messages*.csv, follows*.csv and likes*.csv in the
+data directory (so sharded output like users-000.csv works too), in that
+order. See bulk_import.py.
+"""
+
+import argparse
+import os
+from glob import glob
 
-from csv import DictReader
 from app import db
-from models import User, Message, Follows
+from models import User, Message, Follows, Likes
+import bulk_import
+import timeline
+
+TABLES = [
+    ("users", User.__table__),
+    ("messages", Message.__table__),
+    ("follows", Follows.__table__),
+    ("likes", Likes.__table__),
+]
+
+
+def seed(data_dir, batch_size=bulk_import.DEFAULT_BATCH_SIZE, verbose=True):
+    """Recreate every table and load the CSV files in `data_dir`."""
+
+    db.drop_all()
+    db.create_all()
+
+    tables = [table for name, table in TABLES]
+
+    def report(stats):
+        print(stats, end="\r", flush=True)
+
+    with bulk_import.deferred_indexes(db.engine, tables):
+        for name, table in TABLES:
+            paths = sorted(glob(os.path.join(data_dir, f"{name}*.csv")))
+            stats = bulk_import.load_csv(
+                db.engine,
+                table,
+                paths,
+                batch_size=batch_size,
+                progress=report if verbose else None,
+            )
+            if verbose:
+                print(stats)
+
+        if verbose:
+            print("Rebuilding indexes...")
+
+    bulk_import.reset_sequences(db.engine, tables)
+    bulk_import.analyze(db.engine, tables)
 
+    # Derived data: stats counters and materialized home timelines
+    User.reconcile_counters()
+    Message.reconcile_counters()
+    db.session.commit()
+    timeline.rebuild()
 
-db.drop_all()
-db.create_all()
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data-dir", default="generator")
+    parser.add_argument(
+        "--batch-size", type=int, default=bulk_import.DEFAULT_BATCH_SIZE
+    )
+    args = parser.parse_args()
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    seed(args.data_dir, args.batch_size)
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
-db.session.commit()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Follows and likes: the writes shared by the HTML views and the JSON API.
+
+Each function writes the row, keeps the stats counters, home timelines and
+follow suggestions in step with it, logs follows for follow_graph.py, and
+leaves committing to the caller. Liking or following twice (or undoing
+something never done) changes nothing, so API clients can safely retry.
+"""
+
+from sqlalchemy import select
+
+from models import db, Follows, FollowChange, Likes, Message, User
+import recommendations
+import timeline
+
+
+def follow(user_id, followed_id):
+    """Make `user_id` follow `followed_id`. Returns whether that is new."""
+
+    return bool(follow_many(user_id, [followed_id]))
+
+
+def unfollow(user_id, followed_id):
+    """Make `user_id` stop following `followed_id`. Returns whether they did."""
+
+    return bool(unfollow_many(user_id, [followed_id]))
+
+
+def follow_many(user_id, followed_ids):
+    """Make `user_id` follow every user in `followed_ids`.
+
+    A constant number of statements however many ids there are; unknown
+    ids and `user_id` itself are skipped. Returns the ids newly followed.
+    """
+
+    added = Follows.add(user_id, followed_ids)
+
+    if added:
+        FollowChange.record(user_id, added, following=True)
+        User.bump_counters(user_id, following_count=len(added))
+        User.bump_counters_in(added, followers_count=1)
+        timeline.add_follows(user_id, added)
+        recommendations.follows_changed(user_id, followed_ids=added)
+
+    return added
+
+
+def unfollow_many(user_id, followed_ids):
+    """Make `user_id` stop following `followed_ids`. Returns the ids unfollowed."""
+
+    removed = Follows.remove(user_id, followed_ids)
+
+    if removed:
+        FollowChange.record(user_id, removed, following=False)
+        User.bump_counters(user_id, following_count=-len(removed))
+        User.bump_counters_in(removed, followers_count=-1)
+        timeline.remove_follows(user_id, removed)
+        recommendations.follows_changed(user_id, unfollowed_ids=removed)
+
+    return removed
+
+
+def liked_author_id(message_id):
+    """The author of `message_id`, or None if it or its author is gone.
+
+    Views call this before liking. It locks the author's row FOR SHARE until
+    the caller commits, so an account deletion waits for the like to land
+    before the purge starts, and a like after the deletion sees it.
+    """
+
+    return db.session.scalar(
+        select(Message.user_id)
+        .join(User, User.id == Message.user_id)
+        .where(Message.id == message_id, User.deleted_at.is_(None))
+        .with_for_update(read=True, of=User)
+    )
+
+
+def like(user_id, message_id):
+    """Make `user_id` like `message_id`. Returns the message's like count."""
+
+    added = Likes.add(user_id, message_id)
+    return _count_like(user_id, message_id, 1 if added else 0)
+
+
+def unlike(user_id, message_id):
+    """Take back `user_id`'s like of `message_id`. Returns the like count."""
+
+    removed = Likes.remove(user_id, message_id)
+    return _count_like(user_id, message_id, -1 if removed else 0)
+
+
+def toggle_like(user_id, message_id):
+    """Unlike if liked, else like: one row either way.
+
+    Returns `(liked, likes_count)`.
+    """
+
+    if Likes.remove(user_id, message_id):
+        return False, _count_like(user_id, message_id, -1)
+
+    # Not added if a concurrent request liked it first
+    added = Likes.add(user_id, message_id)
+    return True, _count_like(user_id, message_id, 1 if added else 0)
+
+
+def _count_like(user_id, message_id, delta):
+    """Apply `delta` to the like counters; return the message's like count."""
+
+    if not delta:
+        return db.session.scalar(
+            select(Message.likes_count).where(Message.id == message_id)
+        )
+
+    User.bump_counters(user_id, likes_count=delta)
+    (likes_count,) = Message.bump_counters(message_id, likes_count=delta)
+    return likes_count
@@ -0,0 +1,25 @@
+// Like and unlike messages without reloading the page. Without JavaScript
+// the like forms still work as plain POSTs.
+
+$(document).on("submit", ".like-form", function (evt) {
+  evt.preventDefault();
+
+  const $form = $(this);
+  const $button = $form.find("button");
+
+  $.ajax({
+    url: $form.attr("action"),
+    method: "POST",
+    headers: { Accept: "application/json" },
+  })
+    .done(function (data) {
+      $button
+        .toggleClass("btn-primary", data.liked)
+        .toggleClass("btn-secondary", !data.liked);
+      $button.find(".like-count").text(data.likes_count);
+    })
+    .fail(function () {
+      // Fall back to a normal form submission (e.g. to log in again).
+      $form.get(0).submit();
+    });
+});
@@ -0,0 +1,288 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, Follows, Likes, Message, User
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import current_user
+import fragments
+
+db.create_all()
+
+app.config["WTF_CSRF_ENABLED"] = False
+
+
+class APITestCase(TestCase):
+    """Test the /api/v1 endpoints."""
+
+    def setUp(self):
+        db.session.remove()
+        User.query.delete()
+        Message.query.delete()
+        current_user.cache.clear()
+        fragments.cache.clear()
+
+        self.client = app.test_client()
+
+        self.u1 = User.signup("apiuser1", "api1@test.com", "password", None)
+        self.u2 = User.signup("apiuser2", "api2@test.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = self.u1.id
+        self.u2_id = self.u2.id
+
+        messages = [Message(text=f"warble {i}", user_id=self.u2_id) for i in range(5)]
+        db.session.add_all(messages)
+        db.session.commit()
+        self.message_ids = [msg.id for msg in messages]
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_user(self):
+        resp = self.client.get(f"/api/v1/users/{self.u2_id}")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json["username"], "apiuser2")
+        self.assertEqual(resp.json["messages_count"], 0)
+        self.assertNotIn("password", resp.json)
+        self.assertNotIn("email", resp.json)
+
+    def test_user_fields(self):
+        resp = self.client.get(f"/api/v1/users/{self.u2_id}?fields=id,username")
+        self.assertEqual(resp.json, {"id": self.u2_id, "username": "apiuser2"})
+
+        resp = self.client.get(f"/api/v1/users/{self.u2_id}?fields=password")
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn("password", resp.json["error"])
+
+    def test_missing_user(self):
+        resp = self.client.get("/api/v1/users/999999")
+
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.json, {"error": "No such user."})
+
+        resp = self.client.get("/api/v1/users/999999/messages")
+        self.assertEqual(resp.status_code, 404)
+
+    def test_user_messages_pages(self):
+        url = f"/api/v1/users/{self.u2_id}/messages?limit=2"
+        resp = self.client.get(url)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            [item["id"] for item in resp.json["items"]], self.message_ids[:-3:-1]
+        )
+        self.assertEqual(resp.json["items"][0]["user"]["username"], "apiuser2")
+        self.assertIs(resp.json["items"][0]["liked"], False)
+
+        seen = [item["id"] for item in resp.json["items"]]
+        while resp.json["next_cursor"]:
+            resp = self.client.get(f"{url}&before={resp.json['next_cursor']}")
+            seen += [item["id"] for item in resp.json["items"]]
+
+        self.assertEqual(seen, self.message_ids[::-1])
+
+    def test_message_fields_skip_columns(self):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        self.addCleanup(event.remove, db.engine, "before_cursor_execute", record)
+
+        resp = self.client.get(
+            f"/api/v1/users/{self.u2_id}/messages?fields=id,likes_count"
+        )
+
+        self.assertEqual(set(resp.json["items"][0]), {"id", "likes_count"})
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn("messages.text", statements[0])
+        self.assertNotIn("users.username", statements[0])
+
+    def test_bad_cursor(self):
+        resp = self.client.get(f"/api/v1/users/{self.u2_id}/messages?before=nope")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_timeline_requires_login(self):
+        resp = self.client.get("/api/v1/timeline")
+        self.assertEqual(resp.status_code, 401)
+
+    def test_follow_and_timeline(self):
+        self.login(self.u1_id)
+        url = f"/api/v1/users/{self.u2_id}/follow"
+
+        for _ in range(2):
+            resp = self.client.put(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                resp.json,
+                {"user_id": self.u2_id, "following": True, "followers_count": 1},
+            )
+
+        self.assertEqual(Follows.query.count(), 1)
+
+        resp = self.client.get("/api/v1/timeline?fields=id,text")
+        self.assertEqual(
+            [item["id"] for item in resp.json["items"]], self.message_ids[::-1]
+        )
+
+        for _ in range(2):
+            resp = self.client.delete(url)
+            self.assertEqual(resp.json["followers_count"], 0)
+
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(User.query.get(self.u1_id).following_count, 0)
+
+    def test_deleted_author(self):
+        """Are a deleted account's messages left out before its purge?"""
+
+        self.login(self.u1_id)
+        self.client.put(f"/api/v1/users/{self.u2_id}/follow")
+
+        User.query.get(self.u2_id).deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        for fields in ["", "?fields=id"]:
+            resp = self.client.get(f"/api/v1/timeline{fields}")
+            self.assertEqual(resp.json["items"], [])
+
+            resp = self.client.get(f"/api/v1/users/{self.u2_id}/messages{fields}")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_follow_self(self):
+        self.login(self.u1_id)
+        resp = self.client.put(f"/api/v1/users/{self.u1_id}/follow")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_like(self):
+        self.login(self.u1_id)
+        message_id = self.message_ids[0]
+        url = f"/api/v1/messages/{message_id}/like"
+
+        for _ in range(2):
+            resp = self.client.put(url)
+            self.assertEqual(
+                resp.json,
+                {"message_id": message_id, "liked": True, "likes_count": 1},
+            )
+
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertTrue(resp.cache_control.no_store)
+
+        resp = self.client.get(f"/api/v1/users/{self.u2_id}/messages?fields=id,liked")
+        liked = {item["id"]: item["liked"] for item in resp.json["items"]}
+        self.assertTrue(liked[message_id])
+        self.assertFalse(liked[self.message_ids[1]])
+
+        for _ in range(2):
+            resp = self.client.delete(url)
+            self.assertEqual(resp.json["likes_count"], 0)
+
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 0)
+
+    def test_like_own_message(self):
+        self.login(self.u2_id)
+        resp = self.client.put(f"/api/v1/messages/{self.message_ids[0]}/like")
+        self.assertEqual(resp.status_code, 403)
+
+    def test_like_deleted_author(self):
+        User.query.get(self.u2_id).deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        self.login(self.u1_id)
+        resp = self.client.put(f"/api/v1/messages/{self.message_ids[0]}/like")
+
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 0)
+
+    def test_follow_many(self):
+        self.login(self.u1_id)
+        u3 = User.signup("apiuser3", "api3@test.com", "password", None)
+        db.session.commit()
+        user_ids = [self.u2_id, u3.id, 999999, self.u1_id]
+
+        resp = self.client.put("/api/v1/following", json={"user_ids": user_ids})
+        self.assertEqual(
+            resp.json,
+            {
+                "following": True,
+                "changed": sorted([self.u2_id, u3.id]),
+                "following_count": 2,
+            },
+        )
+
+        resp = self.client.put("/api/v1/following", json={"user_ids": user_ids})
+        self.assertEqual(resp.json["changed"], [])
+        self.assertEqual(resp.json["following_count"], 2)
+
+        self.assertEqual(User.query.get(self.u2_id).followers_count, 1)
+        resp = self.client.get("/api/v1/timeline?fields=id")
+        self.assertEqual(len(resp.json["items"]), 5)
+
+        resp = self.client.delete("/api/v1/following", json={"user_ids": user_ids})
+        self.assertEqual(resp.json["changed"], sorted([self.u2_id, u3.id]))
+        self.assertEqual(resp.json["following_count"], 0)
+        self.assertEqual(Follows.query.count(), 0)
+
+        resp = self.client.get("/api/v1/timeline?fields=id")
+        self.assertEqual(resp.json["items"], [])
+
+    def test_follow_many_statements(self):
+        """Does a batch follow cost the same however many users it names?"""
+
+        self.login(self.u1_id)
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        self.addCleanup(event.remove, db.engine, "before_cursor_execute", record)
+
+        counts = []
+        for count in (2, 20):
+            users = [
+                User(
+                    username=f"batch{count}-{i}",
+                    email=f"batch{count}-{i}@test.com",
+                    password="HASHED",
+                )
+                for i in range(count)
+            ]
+            db.session.add_all(users)
+            db.session.commit()
+            user_ids = [user.id for user in users]
+            current_user.cache.clear()
+
+            del statements[:]
+            self.client.put("/api/v1/following", json={"user_ids": user_ids})
+            counts.append(len(statements))
+
+        self.assertEqual(counts[0], counts[1])
+
+    def test_follow_many_bad_body(self):
+        self.login(self.u1_id)
+
+        resp = self.client.put("/api/v1/following", json={"user_ids": ["1"]})
+        self.assertEqual(resp.status_code, 400)
+
+        resp = self.client.put("/api/v1/following", json=[1, 2])
+        self.assertEqual(resp.status_code, 400)
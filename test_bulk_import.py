@@ -0,0 +1,145 @@
+"""Bulk import tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_bulk_import.py
+
+import csv
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine, func, inspect, select
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import bulk_import
+
+db.create_all()
+
+TABLES = [User.__table__, Message.__table__, Follows.__table__]
+
+
+class BulkImportTestCase(TestCase):
+    """Test loading CSV files with bulk_import."""
+
+    def setUp(self):
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+        self.tmp = tempfile.TemporaryDirectory()
+
+        self.users = [
+            self.write_csv(
+                f"users-{shard}.csv",
+                ["id", "email", "username", "password", "bio"],
+                [
+                    [i, f"user{i}@example.com", f"user{i}", "hash", ""]
+                    for i in range(1 + shard * 5, 6 + shard * 5)
+                ],
+            )
+            for shard in range(2)
+        ]
+        self.messages = [
+            self.write_csv(
+                "messages.csv",
+                ["text", "timestamp", "user_id"],
+                [[f"warble {i}", "2020-01-01 00:00:00", i] for i in range(1, 11)],
+            )
+        ]
+        self.follows = [
+            self.write_csv(
+                "follows.csv",
+                ["user_being_followed_id", "user_following_id"],
+                [[1, i] for i in range(2, 11)],
+            )
+        ]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        db.session.rollback()
+
+    def write_csv(self, name, header, rows):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(header)
+            writer.writerows(rows)
+        return path
+
+    def load_all(self, engine, **kwargs):
+        with bulk_import.deferred_indexes(engine, TABLES):
+            stats = [
+                bulk_import.load_csv(engine, table, paths, batch_size=3, **kwargs)
+                for table, paths in zip(
+                    TABLES, [self.users, self.messages, self.follows]
+                )
+            ]
+        bulk_import.reset_sequences(engine, TABLES)
+        return stats
+
+    def test_load_with_copy(self):
+        """Are sharded CSVs loaded in batches, with indexes rebuilt after?"""
+
+        before = inspect(db.engine).get_indexes("messages")
+        stats = self.load_all(db.engine)
+
+        self.assertEqual([s.rows for s in stats], [10, 10, 9])
+        self.assertEqual(
+            db.session.scalar(select(func.count()).select_from(Follows)), 9
+        )
+        self.assertIsNone(db.session.get(User, 1).bio)
+        self.assertEqual(inspect(db.engine).get_indexes("messages"), before)
+        self.assertEqual(len(inspect(db.engine).get_foreign_keys("follows")), 2)
+
+        # The id sequence continues after the loaded ids
+        user = User.signup("new", "new@example.com", "password", None)
+        db.session.commit()
+        self.assertEqual(user.id, 11)
+
+    def test_load_with_executemany(self):
+        """Does the INSERT fallback load the same rows?"""
+
+        stats = self.load_all(db.engine, use_copy=False)
+
+        self.assertEqual([s.rows for s in stats], [10, 10, 9])
+        self.assertEqual(db.session.get(Message, 3).user_id, 3)
+
+    def test_load_sqlite(self):
+        """Does a load into SQLite work and keep the search index in sync?"""
+
+        engine = create_engine("sqlite://")
+        db.metadata.create_all(engine)
+        self.load_all(engine)
+
+        with engine.connect() as conn:
+            self.assertEqual(
+                conn.exec_driver_sql(
+                    "SELECT rowid FROM messages_fts WHERE messages_fts MATCH 'warble'"
+                ).scalars().all(),
+                list(range(1, 11)),
+            )
+            self.assertIn(
+                "ix_messages_user_id_timestamp_id",
+                [index["name"] for index in inspect(conn).get_indexes("messages")],
+            )
+
+    def test_mismatched_headers(self):
+        """Are shards with different columns refused?"""
+
+        other = self.write_csv("users-x.csv", ["id", "username"], [[99, "x"]])
+
+        with self.assertRaises(ValueError):
+            list(bulk_import.read_batches(self.users + [other]))
@@ -0,0 +1,211 @@
+"""Cache tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_cache.py
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from cache import LRUCache
+import current_user
+import fragments
+from test_query_counts import count_queries
+
+db.create_all()
+
+app.config["WTF_CSRF_ENABLED"] = False
+
+
+class LRUCacheTestCase(TestCase):
+    """Test the in-process LRU cache."""
+
+    def test_eviction(self):
+        """Is the least recently used entry evicted first?"""
+
+        cache = LRUCache("test", max_size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_ttl(self):
+        """Do expired entries miss?"""
+
+        cache = LRUCache("test", ttl=0)
+        cache.set("a", 1)
+        self.assertIsNone(cache.get("a"))
+
+    def test_hit_rate(self):
+        """Are hits and misses counted?"""
+
+        cache = LRUCache("test")
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("b")
+
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.hit_rate(), 0.5)
+
+
+class CurrentUserCacheTestCase(TestCase):
+    """Test the cached logged-in user."""
+
+    def setUp(self):
+        """Create a logged-in user."""
+
+        db.drop_all()
+        db.create_all()
+        current_user.cache.clear()
+        fragments.cache.clear()
+
+        self.client = app.test_client()
+
+        self.user = User(
+            id=1, username="cached", email="cached@email.com", password="HASHED"
+        )
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        """Roll back anything left in the session."""
+
+        db.session.rollback()
+
+    def test_navbar_only_page_skips_database(self):
+        """Does a page that only needs the navbar avoid SQL once cached?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user.id
+
+            c.get("/messages/new")
+
+            with count_queries() as statements:
+                resp = c.get("/messages/new")
+
+            self.assertIn("cached", resp.get_data(as_text=True))
+            self.assertEqual(statements, [])
+
+    def test_invalidate(self):
+        """Does invalidate drop the cached profile?"""
+
+        current_user.load(self.user.id)
+        current_user.invalidate(self.user.id)
+        self.assertIsNone(current_user.cache.get(current_user.cache_key(1)))
+
+    def test_missing_user(self):
+        """Is a session pointing at a deleted user treated as logged out?"""
+
+        self.assertIsNone(current_user.load(999))
+
+    def test_write_skips_stale_profile(self):
+        """Is an account deleted elsewhere, but cached here, kept from posting?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user.id
+
+            c.get("/messages/new")
+
+            # As another process would: no invalidate() reaches this cache
+            self.user.deleted_at = datetime.utcnow()
+            db.session.commit()
+
+            resp = c.post("/messages/new", data={"text": "from beyond"})
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(Message.query.count(), 0)
+
+
+class FragmentCacheTestCase(TestCase):
+    """Test cached message cards."""
+
+    def setUp(self):
+        """Create an author with a message, and a logged-in follower."""
+
+        db.drop_all()
+        db.create_all()
+        current_user.cache.clear()
+        fragments.cache.clear()
+
+        self.client = app.test_client()
+
+        author = User(id=1, username="author", email="a@email.com", password="HASHED")
+        reader = User(id=2, username="reader", email="r@email.com", password="HASHED")
+        db.session.add_all([author, reader])
+        db.session.commit()
+
+        db.session.add(Message(id=10, text="cached warble", user_id=1))
+        db.session.add(Follows(user_being_followed_id=1, user_following_id=2))
+        db.session.commit()
+
+    def tearDown(self):
+        """Roll back anything left in the session."""
+
+        db.session.rollback()
+
+    def get_profile(self, viewer_id):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = viewer_id
+            return c.get("/users/1").get_data(as_text=True)
+
+    def test_cards_are_reused(self):
+        """Is a card rendered once and then served from the cache?"""
+
+        self.get_profile(2)
+        misses = fragments.cache.misses
+
+        html = self.get_profile(2)
+
+        self.assertIn("cached warble", html)
+        self.assertEqual(fragments.cache.misses, misses)
+        self.assertGreater(fragments.cache.hits, 0)
+
+    def test_like_button_is_per_viewer(self):
+        """Is the like button left out of the shared card?"""
+
+        self.assertIn("like-form", self.get_profile(2))
+        self.assertNotIn("like-form", self.get_profile(1))
+
+    def test_profile_edit_refreshes_cards(self):
+        """Do cards show the author's new username after a profile edit?"""
+
+        self.get_profile(2)
+
+        author = db.session.get(User, 1)
+        author.username = "renamed"
+        author.profile_version = User.profile_version + 1
+        db.session.commit()
+
+        self.assertIn("@renamed", self.get_profile(2))
+
+    def test_invalidate(self):
+        """Does invalidate drop a message's card?"""
+
+        self.get_profile(2)
+        message = db.session.get(Message, 10)
+        key = fragments.cache_key(10, message.user.profile_version)
+
+        self.assertIsNotNone(fragments.cache.get(key))
+        fragments.invalidate(message)
+        self.assertIsNone(fragments.cache.get(key))
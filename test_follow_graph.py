@@ -0,0 +1,209 @@
+"""In-memory follow graph tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_follow_graph.py
+
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import insert
+
+from models import db, FollowChange, Memberships, Message, User
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from follow_graph import FollowGraph, FollowIndex
+import current_user
+import follow_graph
+import fragments
+import social
+from test_query_counts import count_queries
+
+db.create_all()
+
+app.config["WTF_CSRF_ENABLED"] = False
+
+
+class FollowGraphTestCase(TestCase):
+    """Test the CSR arrays."""
+
+    def test_has_edge(self):
+        graph = FollowGraph.from_edges([1, 1, 3], [3, 2, 1])
+
+        self.assertTrue(graph.has_edge(1, 2))
+        self.assertTrue(graph.has_edge(3, 1))
+        self.assertFalse(graph.has_edge(2, 1))
+        self.assertFalse(graph.has_edge(1, 4))
+        self.assertFalse(graph.has_edge(99, 1))
+
+    def test_transpose(self):
+        followers = FollowGraph.from_edges([1, 1, 3], [3, 2, 1]).transpose()
+
+        self.assertEqual(followers.following(1).tolist(), [3])
+        self.assertEqual(followers.following(2).tolist(), [1])
+        self.assertEqual(followers.following(3).tolist(), [1])
+
+
+class FollowIndexTestCase(TestCase):
+    """Test snapshots and replaying the change log over them."""
+
+    def setUp(self):
+        db.session.remove()
+        User.query.delete()
+        Message.query.delete()
+        FollowChange.query.delete()
+        current_user.cache.clear()
+        fragments.cache.clear()
+
+        self.client = app.test_client()
+
+        users = [
+            User.signup(f"graph{i}", f"graph{i}@test.com", "password", None)
+            for i in range(4)
+        ]
+        db.session.commit()
+        self.ids = a, b, c, d = [user.id for user in users]
+
+        social.follow_many(a, [b, c])
+        social.follow(b, a)
+        db.session.commit()
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "follows.graph")
+
+        self.assertEqual(follow_graph.write_snapshot(self.path), 3)
+        self.index = FollowIndex(self.path)
+
+    def tearDown(self):
+        Memberships.graph = None
+        db.session.rollback()
+
+    def test_snapshot(self):
+        a, b, c, d = self.ids
+
+        self.assertEqual(self.index.following_ids(a).tolist(), [b, c])
+        self.assertEqual(self.index.follower_ids(a).tolist(), [b])
+        self.assertEqual(self.index.following_ids(d).tolist(), [])
+        self.assertTrue(self.index.is_following(b, a))
+        self.assertFalse(self.index.is_following(a, d))
+
+    def test_refresh(self):
+        """Are follows made after the snapshot replayed from the log?"""
+
+        a, b, c, d = self.ids
+
+        social.follow(a, d)
+        social.unfollow(a, b)
+        social.follow(d, a)
+        db.session.commit()
+
+        self.index.refresh(force=True)
+
+        self.assertEqual(self.index.following_ids(a).tolist(), [c, d])
+        self.assertEqual(self.index.follower_ids(a).tolist(), [b, d])
+        self.assertEqual(self.index.follower_ids(b).tolist(), [])
+        self.assertTrue(self.index.is_following(a, d))
+        self.assertFalse(self.index.is_following(a, b))
+
+        # Replaying the same entries again changes nothing
+        self.index.refresh(force=True)
+        self.assertEqual(self.index.following_ids(a).tolist(), [c, d])
+
+    def test_late_commit(self):
+        """Is a change committed after ones with higher ids still replayed?"""
+
+        a, b, c, d = self.ids
+
+        with db.engine.connect() as other:
+            other.execute(
+                insert(FollowChange).values(
+                    follower_id=c, followed_id=d, following=True
+                )
+            )
+
+            # Plenty of later changes commit first
+            for _ in range(150):
+                social.follow(a, d)
+                social.unfollow(a, d)
+            db.session.commit()
+
+            self.index.refresh(force=True)
+            self.assertFalse(self.index.is_following(c, d))
+
+            other.commit()
+
+        self.index.refresh(force=True)
+        self.assertTrue(self.index.is_following(c, d))
+
+    def test_changes_compacted(self):
+        """Is an edge changed back to its snapshot state forgotten?"""
+
+        a, b, c, d = self.ids
+
+        social.follow(a, d)
+        social.unfollow(a, b)
+        db.session.commit()
+        self.index.refresh(force=True)
+
+        social.unfollow(a, d)
+        social.follow(a, b)
+        db.session.commit()
+        self.index.refresh(force=True)
+
+        self.assertEqual(self.index._changes, {})
+        self.assertEqual(self.index.following_ids(a).tolist(), [b, c])
+
+    def test_new_snapshot(self):
+        """Does a refresh pick up a newer snapshot file?"""
+
+        a, b, c, d = self.ids
+
+        social.unfollow(a, c)
+        db.session.commit()
+        follow_graph.write_snapshot(self.path)
+        os.utime(self.path, ns=(0, 0))
+
+        self.index.refresh(force=True)
+
+        self.assertEqual(self.index.following.following(a).tolist(), [b])
+        self.assertEqual(self.index.following_ids(a).tolist(), [b])
+
+    def test_refresh_interval(self):
+        a, b, c, d = self.ids
+        self.index.refresh_interval = 3600
+
+        social.follow(a, d)
+        db.session.commit()
+
+        self.index.refresh()
+        self.assertFalse(self.index.is_following(a, d))
+
+    def test_pages_skip_follow_queries(self):
+        """With an index loaded, do follow buttons need no follows query?"""
+
+        a, b, c, d = self.ids
+        Memberships.graph = self.index
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = a
+
+            with count_queries() as statements:
+                resp = client.get("/users")
+
+        html = resp.get_data(as_text=True)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(f'action="/users/stop-following/{b}"', html)
+        self.assertIn(f'action="/users/follow/{d}"', html)
+        self.assertFalse([s for s in statements if "FROM follows" in s])
+
+    def test_bad_snapshot(self):
+        with open(self.path, "wb") as f:
+            f.write(b"not a graph")
+
+        with self.assertRaises(ValueError):
+            FollowIndex(self.path)
@@ -0,0 +1,201 @@
+"""HTTP caching tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_http_cache.py
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from flask import template_rendered
+
+from models import db, Message, User, Likes
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import current_user
+import fragments
+import http_cache
+
+db.create_all()
+
+app.config["WTF_CSRF_ENABLED"] = False
+
+
+class HTTPCacheTestCase(TestCase):
+    """Test ETags and Cache-Control headers."""
+
+    def setUp(self):
+        db.session.remove()
+        User.query.delete()
+        Message.query.delete()
+        current_user.cache.clear()
+        fragments.cache.clear()
+
+        self.client = app.test_client()
+
+        self.author = User.signup("author", "author@test.com", "password", None)
+        self.reader = User.signup("reader", "reader@test.com", "password", None)
+        db.session.commit()
+
+        self.msg = Message(text="Cache me", user_id=self.author.id)
+        db.session.add(self.msg)
+        db.session.commit()
+
+        self.author_id = self.author.id
+        self.reader_id = self.reader.id
+        self.msg_id = self.msg.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def count_renders(self):
+        rendered = []
+
+        def record(sender, template, context, **extra):
+            rendered.append(template.name)
+
+        template_rendered.connect(record, app)
+        self.addCleanup(template_rendered.disconnect, record, app)
+        return rendered
+
+    def test_anonymous_message_is_public(self):
+        resp = self.client.get(f"/messages/{self.msg_id}")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.cache_control.public)
+        self.assertEqual(resp.cache_control.max_age, 300)
+        self.assertIn("Cookie", resp.vary)
+
+        etag, weak = resp.get_etag()
+        self.assertTrue(weak)
+
+        rendered = self.count_renders()
+        resp = self.client.get(
+            f"/messages/{self.msg_id}", headers={"If-None-Match": f'W/"{etag}"'}
+        )
+
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b"")
+        self.assertEqual(rendered, [])
+
+    def test_missing_message(self):
+        resp = self.client.get("/messages/999999")
+
+        self.assertEqual(resp.status_code, 404)
+        self.assertTrue(resp.cache_control.no_store)
+
+    def test_profile_edit_changes_etag(self):
+        before = self.client.get(f"/messages/{self.msg_id}").get_etag()
+
+        User.query.filter_by(id=self.author_id).update(
+            {User.profile_version: User.profile_version + 1}
+        )
+        db.session.commit()
+
+        after = self.client.get(f"/messages/{self.msg_id}").get_etag()
+        self.assertNotEqual(before, after)
+
+    def test_like_changes_profile_etag(self):
+        url = f"/users/{self.author_id}"
+        before, _ = self.client.get(url).get_etag()
+
+        Likes.add(self.reader_id, self.msg_id)
+        Message.bump_counters(self.msg_id, likes_count=1)
+        db.session.commit()
+
+        resp = self.client.get(url, headers={"If-None-Match": f'W/"{before}"'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.get_etag()[0], before)
+
+    def test_anonymous_home(self):
+        resp = self.client.get("/")
+        self.assertTrue(resp.cache_control.public)
+
+        resp = self.client.get("/", headers={"If-None-Match": resp.headers["ETag"]})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_logged_in_pages_are_private(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+
+        resp = self.client.get(f"/users/{self.author_id}")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.cache_control.private)
+        self.assertTrue(resp.cache_control.no_cache)
+        self.assertFalse(resp.cache_control.public)
+
+        # Tagged with a hash of the body, so an unchanged page isn't resent.
+        resp = self.client.get(
+            f"/users/{self.author_id}",
+            headers={"If-None-Match": resp.headers["ETag"]},
+        )
+        self.assertEqual(resp.status_code, 304)
+
+    def test_flash_is_not_short_circuited(self):
+        resp = self.client.get("/")
+        etag = resp.headers["ETag"]
+
+        # Redirects home with a flash message
+        self.client.get(f"/users/{self.author_id}/following")
+        resp = self.client.get("/", headers={"If-None-Match": etag})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"Access unauthorized", resp.data)
+        self.assertFalse(resp.cache_control.public)
+
+    def test_forms_and_redirects_are_not_stored(self):
+        self.assertTrue(self.client.get("/login").cache_control.no_store)
+
+        resp = self.client.post(f"/users/follow/{self.author_id}")
+        self.assertEqual(resp.status_code, 302)
+        self.assertTrue(resp.cache_control.no_store)
+
+    def test_static_fingerprints(self):
+        with app.test_request_context():
+            url = http_cache.static_url("stylesheets/style.css")
+
+        self.assertRegex(url, r"^/static/stylesheets/style\.css\?v=[0-9a-f]{12}$")
+
+        resp = self.client.get(url)
+        self.assertTrue(resp.cache_control.immutable)
+        self.assertEqual(resp.cache_control.max_age, http_cache.STATIC_MAX_AGE)
+        resp.close()
+
+        resp = self.client.get("/static/stylesheets/style.css")
+        self.assertFalse(resp.cache_control.immutable)
+        resp.close()
+
+        resp = self.client.get("/login")
+        self.assertIn(url.encode(), resp.data)
+
+    def test_build_version_ignores_working_directory(self):
+        """Do ETags stay the same when the process runs from another directory?"""
+
+        with app.test_request_context():
+            tag = http_cache.etag("page")
+
+        http_cache.build_version.cache_clear()
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tempfile.gettempdir())
+
+        with app.test_request_context():
+            self.assertEqual(http_cache.etag("page"), tag)
+
+    def test_build_version_ignores_checkout_path(self):
+        with tempfile.TemporaryDirectory() as directory:
+            copy = os.path.join(directory, "templates")
+            shutil.copytree(os.path.join(app.root_path, "templates"), copy)
+
+            self.assertEqual(
+                http_cache.build_version(copy),
+                http_cache.build_version(os.path.join(app.root_path, "templates")),
+            )
+
+    def test_build_version_missing_folder(self):
+        with self.assertRaises(FileNotFoundError):
+            http_cache.build_version("no-such-templates")
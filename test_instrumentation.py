@@ -0,0 +1,146 @@
+"""Instrumentation tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_instrumentation.py
+
+import json
+import os
+from unittest import TestCase
+
+from sqlalchemy.exc import DBAPIError
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import current_user
+import fragments
+from instrumentation import normalize_sql
+
+db.create_all()
+
+
+class InstrumentationTestCase(TestCase):
+    """Test request logging and the metrics endpoint."""
+
+    def setUp(self):
+        """Create test client and an admin user."""
+
+        db.drop_all()
+        db.create_all()
+        current_user.cache.clear()
+        fragments.cache.clear()
+
+        self.client = app.test_client()
+
+        self.admin = User(
+            id=1, username="admin", email="admin@email.com", password="HASHED"
+        )
+        db.session.add(self.admin)
+        db.session.commit()
+
+        app.config["ADMIN_USERNAMES"] = {"admin"}
+        app.config["METRICS_TOKEN"] = "scrape-token"
+
+    def tearDown(self):
+        """Restore config changed by the tests."""
+
+        app.config["ADMIN_USERNAMES"] = set()
+        app.config["METRICS_TOKEN"] = None
+        app.config["SLOW_QUERY_THRESHOLD_MS"] = 100
+        db.session.rollback()
+
+    def test_normalize_sql(self):
+        """Are literals and parameter lists reduced to placeholders?"""
+
+        self.assertEqual(
+            normalize_sql(
+                "SELECT *\n  FROM users WHERE id IN (%(id_1)s, %(id_2)s) "
+                "AND username = 'bob' LIMIT 100"
+            ),
+            "SELECT * FROM users WHERE id IN (?) AND username = ? LIMIT ?",
+        )
+
+    def test_request_log_line(self):
+        """Does each request log its endpoint and query count?"""
+
+        with self.assertLogs("warbler.requests", level="INFO") as logs:
+            self.client.get("/users")
+
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(line["endpoint"], "list_users")
+        self.assertEqual(line["status"], 200)
+        self.assertGreaterEqual(line["queries"], 1)
+        self.assertIn("render_ms", line)
+
+    def test_slow_query_log(self):
+        """Are statements over the threshold logged with normalized SQL?"""
+
+        app.config["SLOW_QUERY_THRESHOLD_MS"] = 0
+
+        with self.assertLogs("warbler.slow_queries", level="WARNING") as logs:
+            self.client.get("/users")
+
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line["endpoint"], "list_users")
+        self.assertIn("FROM users", line["sql"])
+
+    def test_failed_statement_leaves_nothing_behind(self):
+        """Do statements that raise leave the pooled connection as it was?"""
+
+        with db.engine.connect() as conn:
+            info = repr(conn.info)
+
+            for _ in range(3):
+                with self.assertRaises(DBAPIError):
+                    conn.exec_driver_sql("SELECT * FROM no_such_table")
+                conn.rollback()
+
+            conn.exec_driver_sql("SELECT 1")
+            self.assertEqual(repr(conn.info), info)
+
+    def test_metrics_forbidden(self):
+        """Is /_metrics hidden from anonymous and non-admin users?"""
+
+        self.assertEqual(self.client.get("/_metrics").status_code, 403)
+
+        self.admin.username = "not_admin"
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.admin.id
+            self.assertEqual(c.get("/_metrics").status_code, 403)
+
+    def test_metrics_for_admin(self):
+        """Can an admin read per-endpoint histograms?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.admin.id
+
+            c.get("/users")
+            resp = c.get("/_metrics")
+            body = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("# TYPE warbler_request_duration_seconds histogram", body)
+            self.assertIn('warbler_request_queries_count{endpoint="list_users"}', body)
+
+    def test_metrics_with_token(self):
+        """Can a scraper read metrics with the bearer token?"""
+
+        resp = self.client.get(
+            "/_metrics", headers={"Authorization": "Bearer scrape-token"}
+        )
+        self.assertEqual(resp.status_code, 200)
@@ -0,0 +1,326 @@
+"""Background job queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import select, text
+
+from models import db, Follows, Job, Likes, Message, TimelineEntry, User
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import current_user
+import fragments
+import jobs
+import social
+
+db.create_all()
+
+app.config["WTF_CSRF_ENABLED"] = False
+
+calls = []
+
+
+@jobs.handler("test.record")
+def record(**payload):
+    calls.append(payload)
+
+
+@jobs.handler("test.fail", max_attempts=2)
+def fail():
+    calls.append("fail")
+    raise RuntimeError("boom")
+
+
+@jobs.handler("test.countdown")
+def countdown(name):
+    calls.append(name)
+    return calls.count(name) < 3
+
+
+@jobs.handler("test.bad_commit", max_attempts=2)
+def bad_commit():
+    calls.append("bad_commit")
+    db.session.add(Likes(user_id=-1, message_id=-1))
+
+
+@jobs.handler("test.peek")
+def peek():
+    calls.append(sorted(db.session.scalars(select(Job.status))))
+
+
+@jobs.handler("test.limited", concurrency=1)
+def limited():
+    calls.append("limited")
+
+
+class JobQueueTestCase(TestCase):
+    """Test claiming, running and retrying jobs."""
+
+    def setUp(self):
+        db.session.remove()
+        Job.query.delete()
+        db.session.commit()
+        calls.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def enqueue(self, kind, **payload):
+        job = jobs.enqueue(kind, **payload)
+        db.session.commit()
+        return job.id
+
+    def test_run(self):
+        self.enqueue("test.record", user_id=1, note="hi")
+
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(calls, [dict(user_id=1, note="hi")])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_unknown_kind(self):
+        with self.assertRaises(ValueError):
+            jobs.enqueue("test.nope")
+
+    def test_delay(self):
+        self.enqueue("test.record", delay=timedelta(hours=1))
+
+        self.assertEqual(jobs.run_pending(), 0)
+        self.assertEqual(calls, [])
+
+    def test_again(self):
+        """Is a job that returns True run again until it is done?"""
+
+        self.enqueue("test.countdown", name="a")
+
+        self.assertEqual(jobs.run_pending(), 3)
+        self.assertEqual(calls, ["a", "a", "a"])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_retry_then_fail(self):
+        """Is a failing job retried later, then left failed?"""
+
+        job_id = self.enqueue("test.fail")
+
+        self.assertEqual(jobs.run_pending(), 1)
+        job = db.session.get(Job, job_id)
+        self.assertEqual(job.status, "queued")
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(job.last_error, "RuntimeError: boom")
+        self.assertGreater(job.run_at, datetime.utcnow())
+
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+
+        self.assertEqual(jobs.run_pending(), 1)
+        job = db.session.get(Job, job_id)
+        self.assertEqual(job.status, "failed")
+        self.assertEqual(calls, ["fail", "fail"])
+
+    def test_commit_fails(self):
+        """Is a job whose transaction fails to commit retried, not lost?"""
+
+        job_id = self.enqueue("test.bad_commit")
+
+        self.assertEqual(jobs.run_pending(), 1)
+        job = db.session.get(Job, job_id)
+        self.assertEqual(job.status, "queued")
+        self.assertEqual(job.attempts, 1)
+        self.assertTrue(job.last_error.startswith("IntegrityError"))
+        self.assertEqual(Likes.query.count(), 0)
+
+    def test_claim_one_at_a_time(self):
+        """Are jobs left queued until the worker is ready to run them?"""
+
+        self.enqueue("test.peek")
+        self.enqueue("test.peek")
+
+        self.assertEqual(jobs.run_pending(), 2)
+        self.assertEqual(calls, [["queued", "running"], ["running"]])
+
+    def test_skip_locked(self):
+        """Does a worker skip jobs another worker has locked?"""
+
+        job_id = self.enqueue("test.record")
+
+        with db.engine.connect() as other:
+            other.execute(
+                text("SELECT id FROM jobs WHERE id = :id FOR UPDATE"), {"id": job_id}
+            )
+            self.assertEqual(jobs.claim(), [])
+            other.rollback()
+
+        self.assertEqual([job.id for job in jobs.claim()], [job_id])
+
+    def test_concurrency(self):
+        """Is a kind's concurrency limit respected?"""
+
+        self.enqueue("test.limited")
+        self.enqueue("test.limited")
+
+        self.assertEqual(len(jobs.claim()), 1)
+        self.assertEqual(jobs.claim(), [])
+
+    def test_abandoned(self):
+        """Is a job whose worker died run again after its lease?"""
+
+        job_id = self.enqueue("test.record")
+        self.assertEqual(len(jobs.claim()), 1)
+        self.assertEqual(jobs.claim(), [])
+
+        db.session.get(Job, job_id).locked_at -= jobs.LEASE
+        db.session.commit()
+
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(calls, [{}])
+
+
+class BackgroundWorkTestCase(TestCase):
+    """Test the jobs that account deletion and fan-out queue."""
+
+    def setUp(self):
+        db.session.remove()
+        User.query.delete()
+        Message.query.delete()
+        Job.query.delete()
+        current_user.cache.clear()
+        fragments.cache.clear()
+
+        self.client = app.test_client()
+
+        users = [
+            User.signup(f"jobs{i}", f"jobs{i}@test.com", "password", None)
+            for i in range(3)
+        ]
+        db.session.commit()
+        self.ids = doomed, fan, friend = [user.id for user in users]
+
+        messages = [Message(text=f"warble {i}", user_id=doomed) for i in range(5)]
+        messages.append(Message(text="friend's warble", user_id=friend))
+        db.session.add_all(messages)
+        db.session.commit()
+        self.message_ids = [msg.id for msg in messages]
+
+        social.follow(fan, doomed)
+        social.follow(doomed, friend)
+        social.follow(friend, doomed)
+        for message_id in self.message_ids[:3]:
+            social.like(fan, message_id)
+        social.like(doomed, self.message_ids[-1])
+        db.session.commit()
+
+    def tearDown(self):
+        app.config["TIMELINE_INLINE_FAN_OUT"] = 1000
+        db.session.rollback()
+
+    def test_delete_user(self):
+        """Does deleting an account return at once and purge it in a job?"""
+
+        doomed, fan, friend = self.ids
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = doomed
+
+            resp = c.post("/users/delete")
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertIsNotNone(db.session.get(User, doomed))
+        self.assertEqual(Job.query.one().kind, "purge_user")
+
+        # Hidden straight away, before the purge runs
+        self.assertEqual(self.client.get(f"/users/{doomed}").status_code, 404)
+        self.assertFalse(User.authenticate("jobs0", "password"))
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = friend
+
+            home = c.get("/").get_data(as_text=True)
+            users = c.get("/users").get_data(as_text=True)
+
+        self.assertNotIn("warble 0", home)
+        self.assertNotIn("@jobs0", users)
+
+        jobs.run_pending()
+
+        db.session.expire_all()
+        self.assertIsNone(db.session.get(User, doomed))
+        self.assertEqual(Job.query.count(), 0)
+        self.assertEqual(Message.query.filter_by(user_id=doomed).count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+
+        fan_user, friend_user = db.session.get(User, fan), db.session.get(User, friend)
+        self.assertEqual((fan_user.following_count, fan_user.likes_count), (0, 0))
+        self.assertEqual(
+            (friend_user.following_count, friend_user.followers_count), (0, 0)
+        )
+        self.assertEqual(db.session.get(Message, self.message_ids[-1]).likes_count, 0)
+
+    def test_signup_after_delete(self):
+        """Are a deleted account's username and email free before the purge?"""
+
+        doomed, fan, friend = self.ids
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = doomed
+
+            c.post("/users/delete")
+            resp = c.post(
+                "/signup",
+                data={
+                    "username": "jobs0",
+                    "email": "jobs0@test.com",
+                    "password": "password",
+                },
+            )
+
+        self.assertEqual(resp.status_code, 302)
+        user = User.query.filter_by(username="jobs0").one()
+        self.assertNotEqual(user.id, doomed)
+        self.assertEqual(User.authenticate("jobs0", "password"), user)
+
+    def test_purge_in_chunks(self):
+        doomed, fan, friend = self.ids
+
+        jobs.enqueue("purge_user", user_id=doomed, chunk_size=2)
+        db.session.commit()
+
+        # 3 chunks of messages, then likes, following, followers, timeline,
+        # and a last run to delete the user
+        self.assertEqual(jobs.run_pending(), 8)
+        self.assertIsNone(db.session.get(User, doomed))
+
+    def test_queued_fan_out(self):
+        """Are messages by authors with many followers fanned out by a job?"""
+
+        doomed, fan, friend = self.ids
+        app.config["TIMELINE_INLINE_FAN_OUT"] = 0
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = doomed
+
+            c.post("/messages/new", data={"text": "queued warble"})
+
+        message_id = db.session.scalar(
+            select(Message.id).where(Message.text == "queued warble")
+        )
+        delivered = select(TimelineEntry.user_id).where(
+            TimelineEntry.message_id == message_id
+        )
+
+        self.assertEqual(db.session.scalars(delivered).all(), [doomed])
+
+        jobs.run_pending()
+        self.assertEqual(
+            sorted(db.session.scalars(delivered)), sorted([doomed, fan, friend])
+        )
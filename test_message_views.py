@@ -9,7 +9,9 @@ from datetime import datetime
 import os
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from sqlalchemy import event
+
+from models import db, connect_db, Message, User, Follows, Likes, TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -22,6 +24,13 @@ os.environ["DATABASE_URL"] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+import current_user
+import fragments
+import search
+import social
+import timeline
+from pagination import decode_rank_cursor
+from test_query_counts import count_queries
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -42,6 +51,8 @@ class MessageViewTestCase(TestCase):
 
         User.query.delete()
         Message.query.delete()
+        current_user.cache.clear()
+        fragments.cache.clear()
 
         self.client = app.test_client()
 
@@ -84,6 +95,126 @@ class MessageViewTestCase(TestCase):
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
 
+    def test_add_message_fans_out(self):
+        """Is a new message delivered to the timelines of the author's followers?"""
+
+        follower = User.signup(
+            username="follower",
+            email="follower@email.com",
+            password="test_password",
+            image_url=None,
+        )
+        db.session.flush()
+        db.session.add(
+            Follows(
+                user_being_followed_id=self.testuser.id, user_following_id=follower.id
+            )
+        )
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Hello"})
+
+            msg = Message.query.one()
+            owners = {
+                entry.user_id
+                for entry in TimelineEntry.query.filter_by(message_id=msg.id)
+            }
+            self.assertEqual(owners, {self.testuser.id, follower.id})
+
+            c.post(f"/messages/{msg.id}/delete")
+            self.assertEqual(TimelineEntry.query.count(), 0)
+
+    def test_rebuild_timelines_in_place(self):
+        """Does a rebuild replace each batch's rows without emptying timelines?"""
+
+        follower = User.signup("follower", "follower@email.com", "password", None)
+        db.session.commit()
+        db.session.add_all(
+            [
+                Message(text="kept", user_id=self.testuser.id),
+                Follows(
+                    user_being_followed_id=self.testuser.id,
+                    user_following_id=follower.id,
+                ),
+            ]
+        )
+        db.session.commit()
+
+        # A row the rebuild should drop: the follower's own message, delivered
+        # to the test user, who doesn't follow them
+        stray = Message(text="stray", user_id=follower.id)
+        db.session.add(stray)
+        db.session.flush()
+        db.session.add(
+            TimelineEntry(
+                user_id=self.testuser.id,
+                message_id=stray.id,
+                author_id=follower.id,
+                timestamp=stray.timestamp,
+            )
+        )
+        db.session.commit()
+
+        steps = []
+
+        def record(conn, cursor, statement, *args):
+            if "timelines" in statement:
+                steps.append(statement.split()[0])
+
+        def record_commit(conn):
+            steps.append("COMMIT")
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        event.listen(db.engine, "commit", record_commit)
+        self.addCleanup(event.remove, db.engine, "before_cursor_execute", record)
+        self.addCleanup(event.remove, db.engine, "commit", record_commit)
+
+        timeline.rebuild(batch_size=100)
+
+        # No batch commits between deleting its rows and writing them again
+        self.assertIn("DELETE", steps)
+        self.assertNotIn("DELETE COMMIT", " ".join(steps))
+
+        entries = {(e.user_id, e.message_id) for e in TimelineEntry.query}
+        kept = Message.query.filter_by(text="kept").one()
+        self.assertEqual(
+            entries,
+            {
+                (self.testuser.id, kept.id),
+                (follower.id, kept.id),
+                (follower.id, stray.id),
+            },
+        )
+
+    def test_rebuild_backfill_limit(self):
+        """Does a rebuild keep only each author's newest messages, own included?"""
+
+        follower = User.signup("follower", "follower@email.com", "password", None)
+        db.session.commit()
+        db.session.add_all(
+            [
+                Message(text="old", timestamp=datetime(2020, 1, 1), user_id=111),
+                Message(text="new", timestamp=datetime(2021, 1, 1), user_id=111),
+                Follows(user_being_followed_id=111, user_following_id=follower.id),
+            ]
+        )
+        db.session.commit()
+
+        limit = app.config.get("TIMELINE_BACKFILL_LIMIT")
+        app.config["TIMELINE_BACKFILL_LIMIT"] = 1
+        try:
+            timeline.rebuild()
+        finally:
+            app.config["TIMELINE_BACKFILL_LIMIT"] = limit
+
+        new = Message.query.filter_by(text="new").one()
+        entries = {(e.user_id, e.message_id) for e in TimelineEntry.query}
+        self.assertEqual(entries, {(111, new.id), (follower.id, new.id)})
+
     def test_view_message(self):
         """Can user view messages while logged in?"""
 
@@ -106,6 +237,60 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("test message", html)
 
+    def test_search_messages(self):
+        """Does message search find words in warbles, and forget deleted ones?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Spotted two herons today"})
+            c.post("/messages/new", data={"text": "Nothing to report"})
+
+            resp = c.get("/messages/search?q=heron")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Spotted two herons today", html)
+            self.assertNotIn("Nothing to report", html)
+
+            # Results are rendered from the shared card fragments
+            msg = Message.query.filter_by(text="Spotted two herons today").one()
+            key = fragments.cache_key(msg.id, msg.user.profile_version)
+            self.assertEqual(fragments.cache.get(key), fragments.message_card(msg))
+
+            c.post(f"/messages/{msg.id}/delete")
+
+            resp = c.get("/messages/search?q=heron")
+            self.assertNotIn("Spotted two herons today", resp.get_data(as_text=True))
+
+    def test_search_messages_pages(self):
+        """Do later pages rank the first page's candidates, and no older ones?"""
+
+        for i in range(4):
+            db.session.add(Message(text=f"Heron number {i}", user_id=self.testuser.id))
+        db.session.commit()
+
+        saved = search.MESSAGE_SCAN_WINDOW, search.MAX_MESSAGE_SCAN_WINDOWS
+        search.MESSAGE_SCAN_WINDOW, search.MAX_MESSAGE_SCAN_WINDOWS = 3, 1
+        try:
+            with app.test_request_context():
+                first = search.search_messages("heron", limit=2)
+
+                db.session.add(Message(text="Heron, late", user_id=self.testuser.id))
+                db.session.commit()
+
+                rest = search.search_messages(
+                    "heron", after=decode_rank_cursor(first.next_cursor)
+                )
+        finally:
+            search.MESSAGE_SCAN_WINDOW, search.MAX_MESSAGE_SCAN_WINDOWS = saved
+
+        # Only the newest 3 messages were ranked, and the late one never is
+        texts = {m.text for m in first.items + rest.items}
+        self.assertEqual(texts, {f"Heron number {i}" for i in (1, 2, 3)})
+        self.assertIsNone(rest.next_cursor)
+
     def test_delete_message(self):
         """Can user delete own message while logged in?"""
 
@@ -128,6 +313,29 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn("test message", html)
 
+    def test_delete_message_counters(self):
+        """Are the author's and likers' counters bumped, without recounting?"""
+
+        liker = User.signup("liker", "liker@test.com", "password", None)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Like me"})
+            msg = Message.query.one()
+            social.like(liker.id, msg.id)
+            db.session.commit()
+
+            with count_queries() as statements:
+                c.post(f"/messages/{msg.id}/delete")
+
+        self.assertFalse([s for s in statements if "count(*)" in s])
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(User.query.get(liker.id).likes_count, 0)
+        self.assertEqual(User.query.get(self.testuser.id).messages_count, 0)
+
     def test_add_message_no_sess(self):
         """Is user prohibited from adding messages while not logged in?"""
 
@@ -182,6 +390,36 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("Access unauthorized", str(resp.data))
 
+    def test_delete_message_of_another_user(self):
+        """Is a logged-in user prohibited from deleting someone else's message?"""
+
+        other = User.signup("other", "other@email.com", "password", None)
+        db.session.add(Message(id=111, text="test message", user_id=self.testuser.id))
+        db.session.commit()
+        count = self.testuser.messages_count
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other.id
+
+            resp = c.post("/messages/111/delete", follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Access unauthorized", str(resp.data))
+
+        self.assertIsNotNone(db.session.get(Message, 111))
+        db.session.expire_all()
+        self.assertEqual(db.session.get(User, 111).messages_count, count)
+
+    def test_delete_missing_message(self):
+        """Is deleting a message that doesn't exist a 404?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post("/messages/999/delete")
+            self.assertEqual(resp.status_code, 404)
+
             
 
             
@@ -0,0 +1,227 @@
+"""Query-count regression tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_query_counts.py
+
+from contextlib import contextmanager
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Follows, Likes, Message
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import current_user
+import fragments
+import timeline
+
+db.create_all()
+
+app.config["WTF_CSRF_ENABLED"] = False
+
+# Most SQL statements any feed page may run, however long the feed.
+FEED_QUERY_BUDGET = 5
+
+
+@contextmanager
+def count_queries():
+    """Count the SQL statements run inside the block.
+
+    Yields a list that collects each statement; check its length afterwards.
+    """
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+
+
+class QueryCountTestCase(TestCase):
+    """Shared setup for counting the queries a page issues."""
+
+    def setUp(self):
+        """Create a viewer and a helper to add followed users."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        self.viewer = User(
+            id=1, username="viewer", email="viewer@email.com", password="HASHED"
+        )
+        db.session.add(self.viewer)
+        db.session.commit()
+
+        self.next_id = 2
+
+    def tearDown(self):
+        """Roll back anything left in the session."""
+
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def add_users(self, count):
+        """Add `count` users, each following and followed by the viewer."""
+
+        for _ in range(count):
+            user = User(
+                id=self.next_id,
+                username=f"user{self.next_id}",
+                email=f"user{self.next_id}@email.com",
+                password="HASHED",
+            )
+            db.session.add(user)
+            db.session.flush()
+            db.session.add_all(
+                [
+                    Follows(user_being_followed_id=user.id, user_following_id=1),
+                    Follows(user_being_followed_id=1, user_following_id=user.id),
+                ]
+            )
+            self.next_id += 1
+
+        db.session.commit()
+
+    def queries_for(self, url):
+        """Number of SQL statements run to serve `url` to the viewer.
+
+        The viewer's cached profile is dropped first so every measurement
+        starts from the same state.
+        """
+
+        current_user.cache.clear()
+        fragments.cache.clear()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer.id
+
+            with count_queries() as statements:
+                resp = c.get(url)
+
+            self.assertEqual(resp.status_code, 200)
+            return len(statements)
+
+    def assert_constant_queries(self, url):
+        """Serve `url` with 3 and then 30 users; query counts must match."""
+
+        self.add_users(3)
+        small = self.queries_for(url)
+
+        self.add_users(27)
+        large = self.queries_for(url)
+
+        self.assertEqual(small, large)
+
+
+class ListPageQueryTestCase(QueryCountTestCase):
+    """Do list pages issue a constant number of queries?"""
+
+    def test_users_index(self):
+        """Is /users independent of the number of users listed?"""
+
+        self.assert_constant_queries("/users")
+
+    def test_following_page(self):
+        """Is the following page independent of the number followed?"""
+
+        self.assert_constant_queries("/users/1/following")
+
+    def test_followers_page(self):
+        """Is the followers page independent of the number of followers?"""
+
+        self.assert_constant_queries("/users/1/followers")
+
+    def test_cards_skip_unused_columns(self):
+        """Do user cards load only the columns they show?"""
+
+        self.add_users(3)
+
+        for url in ["/users", "/users/1/following", "/users/1/followers"]:
+            current_user.cache.clear()
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.viewer.id
+
+                with count_queries() as statements:
+                    c.get(url)
+
+            cards = [s for s in statements if "users.header_image_url" in s]
+            self.assertTrue(cards, url)
+            for statement in cards:
+                if "follows" in statement or url == "/users":
+                    self.assertNotIn("users.password", statement)
+
+
+class FeedQueryBudgetTestCase(QueryCountTestCase):
+    """Do feed pages stay within FEED_QUERY_BUDGET?"""
+
+    def add_users(self, count):
+        """Add followed users, each with a message the viewer has liked."""
+
+        first_id = self.next_id
+        super().add_users(count)
+
+        for user_id in range(first_id, self.next_id):
+            msg = Message(text=f"warble by {user_id}", user_id=user_id)
+            db.session.add(msg)
+            db.session.flush()
+            db.session.add(Likes(user_id=1, message_id=msg.id))
+
+        db.session.commit()
+        timeline.rebuild()
+
+    def assert_within_budget(self, url):
+        """Serve `url` with a short and a long feed; both must fit the budget."""
+
+        self.add_users(3)
+        small = self.queries_for(url)
+
+        self.add_users(27)
+        large = self.queries_for(url)
+
+        self.assertEqual(small, large)
+        self.assertLessEqual(large, FEED_QUERY_BUDGET)
+
+    def test_home_feed(self):
+        """Does the home feed load message authors with the messages?"""
+
+        self.assert_within_budget("/")
+
+    def test_likes_feed(self):
+        """Does the likes page load message authors with the messages?"""
+
+        self.assert_within_budget("/users/likes/1")
+
+    def test_profile_feed(self):
+        """Does a profile page look up the viewer's likes in one batch?"""
+
+        self.assert_within_budget("/users/2")
+
+    def test_show_message(self):
+        """Does a single message page fit the budget?"""
+
+        self.add_users(1)
+        self.assertLessEqual(self.queries_for("/messages/1"), FEED_QUERY_BUDGET)
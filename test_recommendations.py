@@ -0,0 +1,191 @@
+"""Who-to-follow suggestion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommendations.py
+
+import os
+from datetime import timedelta
+from unittest import TestCase
+
+import numpy as np
+
+from follow_graph import FollowGraph
+from models import db, Message, StaleSuggestions, Suggestion, User
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import current_user
+import fragments
+import recommendations
+import social
+
+db.create_all()
+
+app.config["WTF_CSRF_ENABLED"] = False
+
+
+class FollowGraphTestCase(TestCase):
+    """Test suggestion scoring on an in-memory graph."""
+
+    def setUp(self):
+        # 1 follows 2 and 3; 2 follows 4 and 5; 3 follows 1 and 4.
+        self.graph = FollowGraph.from_edges([1, 1, 2, 2, 3, 3], [3, 2, 5, 4, 4, 1])
+        self.activity = np.zeros(self.graph.size, dtype=np.int64)
+
+    def test_rows(self):
+        self.assertEqual(self.graph.following(1).tolist(), [2, 3])
+        self.assertEqual(self.graph.following(4).tolist(), [])
+        self.assertEqual(self.graph.following(99).tolist(), [])
+        self.assertEqual(
+            self.graph.following_of_all([3, 4, 2]).tolist(), [1, 4, 4, 5]
+        )
+
+    def test_suggest(self):
+        """Are friends of friends ranked by mutuals, skipping self and follows?"""
+
+        ids, mutuals, scores = recommendations.suggest(self.graph, self.activity, 1)
+
+        self.assertEqual(ids.tolist(), [4, 5])
+        self.assertEqual(mutuals.tolist(), [2, 1])
+
+    def test_activity_breaks_ties(self):
+        # 1 follows 2 and 3, who follow 4 and 5 respectively.
+        graph = FollowGraph.from_edges([1, 1, 2, 3], [2, 3, 4, 5])
+        activity = np.zeros(graph.size, dtype=np.int64)
+
+        ids, _, _ = recommendations.suggest(graph, activity, 1)
+        self.assertEqual(ids.tolist(), [4, 5])
+
+        activity[5] = 3
+        ids, mutuals, scores = recommendations.suggest(graph, activity, 1)
+        self.assertEqual(ids.tolist(), [5, 4])
+        self.assertEqual(mutuals.tolist(), [1, 1])
+        self.assertGreater(scores[0], scores[1])
+
+    def test_limit(self):
+        ids, _, _ = recommendations.suggest(self.graph, self.activity, 1, limit=1)
+        self.assertEqual(ids.tolist(), [4])
+
+
+class SuggestionsTestCase(TestCase):
+    """Test stored suggestions, their page and incremental updates."""
+
+    def setUp(self):
+        db.session.remove()
+        User.query.delete()
+        Message.query.delete()
+        current_user.cache.clear()
+        fragments.cache.clear()
+
+        self.client = app.test_client()
+
+        users = [
+            User.signup(f"suggest{i}", f"suggest{i}@test.com", "password", None)
+            for i in range(5)
+        ]
+        db.session.commit()
+        self.ids = a, b, c, d, e = [user.id for user in users]
+
+        for follower, followed in [(a, b), (a, c), (b, d), (b, e), (c, d), (c, a)]:
+            social.follow(follower, followed)
+        db.session.add(Message(text="active", user_id=e))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def stored(self, user_id):
+        return db.session.execute(
+            db.select(Suggestion.suggested_id, Suggestion.mutuals)
+            .where(Suggestion.user_id == user_id)
+            .order_by(Suggestion.rank)
+        ).all()
+
+    def test_rebuild(self):
+        a, b, c, d, e = self.ids
+
+        self.assertEqual(recommendations.rebuild(batch_size=2), 5)
+
+        self.assertEqual(self.stored(a), [(d, 2), (e, 1)])
+        self.assertEqual(self.stored(c), [(b, 1)])
+        self.assertEqual(db.session.query(StaleSuggestions).count(), 0)
+
+    def test_page(self):
+        a, b, c, d, e = self.ids
+        recommendations.rebuild()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = a
+
+            resp = c.get("/users/suggestions")
+            html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Who to follow", html)
+        self.assertLess(html.index("@suggest3"), html.index("@suggest4"))
+        self.assertIn("Followed by 2 you follow", html)
+
+    def test_page_requires_login(self):
+        resp = self.client.get("/users/suggestions")
+        self.assertEqual(resp.status_code, 302)
+
+    def test_follow_updates_suggestions(self):
+        """Does following a suggestion drop it, and a refresh redo the rest?"""
+
+        a, b, c, d, e = self.ids
+        recommendations.rebuild()
+
+        social.follow(a, d)
+        db.session.commit()
+        self.assertEqual(self.stored(a), [(e, 1)])
+        self.assertEqual(
+            db.session.scalars(db.select(StaleSuggestions.user_id)).all(), [a]
+        )
+
+        social.unfollow(a, b)
+        db.session.commit()
+        self.assertEqual(recommendations.refresh_stale(), 1)
+
+        # Only c is followed now: c follows a (self) and d (followed).
+        self.assertEqual(self.stored(a), [])
+        self.assertEqual(db.session.query(StaleSuggestions).count(), 0)
+
+    def test_change_renews_mark(self):
+        """Does a second change move the stale mark forward?"""
+
+        a, b, c, d, e = self.ids
+
+        social.follow(a, d)
+        db.session.commit()
+
+        # The mark a refresh in progress read, and will clear if unchanged
+        mark = db.session.get(StaleSuggestions, a)
+        mark.marked_at -= timedelta(minutes=1)
+        seen = mark.marked_at
+        db.session.commit()
+
+        social.follow(a, e)
+        db.session.commit()
+        db.session.expire_all()
+
+        self.assertGreater(db.session.get(StaleSuggestions, a).marked_at, seen)
+
+    def test_refresh_matches_rebuild(self):
+        """Do the SQL and graph paths agree?"""
+
+        a, b, c, d, e = self.ids
+        recommendations.rebuild()
+        expected = {user_id: self.stored(user_id) for user_id in self.ids}
+
+        db.session.query(Suggestion).delete()
+        for user_id in self.ids:
+            recommendations.follows_changed(user_id, unfollowed_ids=[0])
+        db.session.commit()
+
+        self.assertEqual(recommendations.refresh_stale(), 5)
+        self.assertEqual(
+            {user_id: self.stored(user_id) for user_id in self.ids}, expected
+        )
@@ -6,9 +6,12 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, User, Message, Follows
+from hashing import hasher
+from models import db, User, Message, Follows, Likes
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,6 +24,7 @@ os.environ["DATABASE_URL"] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app
+from test_query_counts import count_queries
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -103,6 +107,81 @@ class UserModelTestCase(TestCase):
         self.assertTrue(self.user1.is_following(self.user2))
         self.assertFalse(self.user2.is_following(self.user1))
 
+    def test_cached_memberships(self):
+        """Do cached membership checks agree with the database?"""
+
+        self.user1.following.append(self.user2)
+        db.session.commit()
+
+        self.user1.cache_memberships()
+        self.user2.cache_memberships()
+
+        self.assertTrue(self.user1.is_following(self.user2))
+        self.assertFalse(self.user1.is_followed_by(self.user2))
+        self.assertTrue(self.user2.is_followed_by(self.user1))
+        self.assertEqual(self.user1.memberships.following_ids, {self.user2.id})
+
+    def test_reconcile_counters(self):
+        """Does reconcile_counters repair counts that have drifted?"""
+
+        db.session.add(
+            Follows(
+                user_being_followed_id=self.user2.id, user_following_id=self.user1.id
+            )
+        )
+        db.session.add(Message(text="uncounted", user_id=self.user1.id))
+        db.session.commit()
+
+        self.assertEqual(self.user1.following_count, 0)
+
+        fixed = User.reconcile_counters()
+        db.session.commit()
+        db.session.refresh(self.user1)
+        db.session.refresh(self.user2)
+
+        self.assertEqual(fixed, 3)
+        self.assertEqual(self.user1.following_count, 1)
+        self.assertEqual(self.user1.messages_count, 1)
+        self.assertEqual(self.user2.followers_count, 1)
+        self.assertEqual(User.reconcile_counters(), 0)
+
+    def test_load_likes(self):
+        """Are a page's likes looked up without loading every like?"""
+
+        messages = [
+            Message(text=f"warble {i}", user_id=self.user2.id) for i in range(3)
+        ]
+        db.session.add_all(messages)
+        db.session.flush()
+        db.session.add(Likes(user_id=self.user1.id, message_id=messages[0].id))
+        db.session.commit()
+
+        self.user1.cache_memberships()
+        self.user1.memberships.load_likes(m.id for m in messages[:2])
+
+        self.assertTrue(self.user1.has_liked(messages[0]))
+        self.assertFalse(self.user1.has_liked(messages[1]))
+        self.assertIsNone(self.user1.memberships._liked_ids)
+
+        # Messages outside the batch fall back to the full set
+        self.assertFalse(self.user1.has_liked(messages[2]))
+
+    def test_message_like_counts(self):
+        """Are message like counts maintained and reconciled?"""
+
+        msg = Message(text="popular", user_id=self.user2.id)
+        db.session.add(msg)
+        db.session.flush()
+
+        self.assertEqual(Message.bump_counters(msg.id, likes_count=2), (2,))
+        db.session.add(Likes(user_id=self.user1.id, message_id=msg.id))
+        db.session.commit()
+
+        self.assertEqual(Message.reconcile_counters(), 1)
+        db.session.commit()
+        db.session.refresh(msg)
+        self.assertEqual(msg.likes_count, 1)
+
     def test_signup(self):
         """Does signup method work?"""
 
@@ -140,3 +219,53 @@ class UserModelTestCase(TestCase):
         user1_account = User.authenticate("testname1", "test_password2")
 
         self.assertNotEqual(user1, user1_account)
+
+    def test_authenticate_rehashes_old_cost(self):
+        """Is a password hashed at an old cost rehashed on login?"""
+
+        user1 = User.signup("testname1", "testname1@email.com", "test_password", None)
+        db.session.commit()
+
+        with patch.object(hasher, "rounds", 4):
+            self.assertTrue(hasher.needs_rehash(user1.password))
+            self.assertEqual(User.authenticate("testname1", "test_password"), user1)
+
+        self.assertTrue(user1.password.startswith("$2b$04$"))
+        self.assertFalse(User.authenticate("testname1", "test_password2"))
+
+    def test_authenticate_deleted(self):
+        """Does authentication fail for a deleted account?"""
+
+        user1 = User.signup("testname1", "testname1@email.com", "test_password", None)
+        user1.deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        self.assertFalse(User.authenticate("testname1", "test_password"))
+
+    def test_delete_leaves_rows_to_database(self):
+        """Does deleting a User leave its rows to ON DELETE CASCADE?"""
+
+        msg = Message(text="gone", user_id=self.user1.id)
+        db.session.add(msg)
+        db.session.flush()
+        u1, u2 = self.user1.id, self.user2.id
+        db.session.add_all(
+            [
+                Follows(user_being_followed_id=u2, user_following_id=u1),
+                Follows(user_being_followed_id=u1, user_following_id=u2),
+                Likes(user_id=u2, message_id=msg.id),
+            ]
+        )
+        db.session.commit()
+
+        with count_queries() as statements:
+            db.session.delete(self.user1)
+            db.session.commit()
+
+        self.assertEqual(
+            [s.split()[0] for s in statements if not s.startswith("SELECT users.")],
+            ["DELETE"],
+        )
+        self.assertEqual(Message.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
@@ -4,12 +4,16 @@
 #
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import os
+import re
+import threading
+import time
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, connect_db, Message, User, Follows, Likes
+from models import db, connect_db, Message, User, Follows, Likes, TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -22,6 +26,9 @@ os.environ["DATABASE_URL"] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from hashing import HasherBusy, hasher
+import current_user
+import fragments
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -40,8 +47,13 @@ class UserViewTestCase(TestCase):
     def setUp(self):
         """Create test clients and messages, add sample data."""
 
+        # Start from an empty session: objects from the previous test share
+        # ids with the ones created below.
+        db.session.remove()
         db.drop_all()
         db.create_all()
+        current_user.cache.clear()
+        fragments.cache.clear()
 
         self.client = app.test_client()
 
@@ -153,6 +165,87 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("Welcome back.", html)
 
+    def test_login_when_hasher_saturated(self):
+        """Is a login refused with 503 when the hashing queue is full?"""
+
+        with patch.object(hasher, "_run", side_effect=HasherBusy):
+            resp = self.client.post(
+                "/login",
+                data={"username": "test_name", "password": "test_password"},
+            )
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers["Retry-After"], "1")
+
+    def test_login_beyond_max_pending(self):
+        """Does a hash past max_pending fail fast while another is running?"""
+
+        hasher.configure(rounds=hasher.rounds, workers=0, max_pending=1)
+        self.addCleanup(hasher.init_app, app)
+
+        started, release = threading.Event(), threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(10)
+
+        pending = threading.Thread(target=hasher._run, args=(slow,))
+        pending.start()
+        self.addCleanup(pending.join)
+        self.addCleanup(release.set)
+        self.assertTrue(started.wait(10))
+
+        with self.assertRaises(HasherBusy):
+            hasher.hash("password")
+
+        resp = self.client.post(
+            "/login", data={"username": "test_name", "password": "test_password"}
+        )
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers["Retry-After"], "1")
+
+        # The slot is free again once the slow hash finishes
+        release.set()
+        pending.join()
+        resp = self.client.post(
+            "/login", data={"username": "test_name", "password": "test_password"}
+        )
+        self.assertEqual(resp.status_code, 302)
+
+    def test_hash_timeout(self):
+        """Is a hash that outlasts the timeout reported as HasherBusy?"""
+
+        hasher.configure(rounds=hasher.rounds, workers=2, max_pending=1, timeout=0.1)
+        self.addCleanup(hasher.init_app, app)
+
+        with self.assertRaises(HasherBusy):
+            hasher._run(time.sleep, 1)
+
+        # The pool has room, but the timed-out hash keeps its slot until done
+        with self.assertRaises(HasherBusy):
+            hasher._run(time.sleep, 0)
+
+        self.assertTrue(hasher._slots.acquire(timeout=10))
+        hasher._slots.release()
+        hasher._run(time.sleep, 0)
+
+    def test_login_rehashes_old_cost(self):
+        """Does logging in store a fresh hash for a password at an old cost?"""
+
+        user_id = self.testuser.id
+
+        with patch.object(hasher, "rounds", 4):
+            resp = self.client.post(
+                "/login", data={"username": "test_name", "password": "test_password"}
+            )
+
+        self.assertEqual(resp.status_code, 302)
+
+        db.session.remove()
+        password = User.query.get(user_id).password
+        self.assertTrue(password.startswith("$2b$04$"))
+        self.assertTrue(hasher.check(password, "test_password"))
+
     def test_home(self):
         """Does home page displays correct information when logged in?"""
 
@@ -166,6 +259,59 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(f"{self.testuser.username}", html)
 
+    def test_home_shows_followed_messages(self):
+        """Does following a user deliver their messages to the home timeline?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get("/")
+            self.assertNotIn("test message2", resp.get_data(as_text=True))
+
+            c.post(f"/users/follow/{self.user2.id}")
+            resp = c.get("/")
+            self.assertIn("test message2", resp.get_data(as_text=True))
+
+            c.post(f"/users/stop-following/{self.user2.id}")
+            resp = c.get("/")
+            self.assertNotIn("test message2", resp.get_data(as_text=True))
+
+    def test_home_merges_celebrity_messages(self):
+        """Are messages from celebrity accounts read into the home timeline?"""
+
+        app.config["TIMELINE_CELEBRITY_THRESHOLD"] = 0
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                c.post(f"/users/follow/{self.user2.id}")
+                resp = c.get("/")
+                self.assertIn("test message2", resp.get_data(as_text=True))
+                self.assertEqual(
+                    TimelineEntry.query.filter_by(author_id=self.user2.id).count(), 0
+                )
+        finally:
+            app.config["TIMELINE_CELEBRITY_THRESHOLD"] = 10000
+
+    def test_follow_updates_counters(self):
+        """Do follow and unfollow keep the stats counters in step?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post(f"/users/follow/{self.user2.id}")
+            self.assertEqual(User.query.get(self.testuser.id).following_count, 1)
+            self.assertEqual(User.query.get(self.user2.id).followers_count, 1)
+
+            c.post(f"/users/stop-following/{self.user2.id}")
+            db.session.expire_all()
+            self.assertEqual(User.query.get(self.testuser.id).following_count, 0)
+            self.assertEqual(User.query.get(self.user2.id).followers_count, 0)
+
     def test_users_index(self):
         """Does users index displays correct information?"""
 
@@ -189,6 +335,45 @@ class UserViewTestCase(TestCase):
             self.assertIn("test message1", html)
             self.assertNotIn("test message2", html)
 
+    def test_user_profile_pagination(self):
+        """Can older messages on a profile be reached with a cursor?"""
+
+        start = datetime(2020, 1, 1)
+        db.session.add_all(
+            [
+                Message(
+                    text=f"paged message {i:03}",
+                    timestamp=start + timedelta(minutes=i),
+                    user_id=self.user3.id,
+                )
+                for i in range(105)
+            ]
+        )
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get(f"/users/{self.user3.id}")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("paged message 104", html)
+            self.assertNotIn("paged message 004", html)
+            self.assertIn("Older warbles", html)
+
+            cursor = re.search(r"before=([\w-]+)", html).group(1)
+            resp = c.get(f"/users/{self.user3.id}?before={cursor}")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("paged message 004", html)
+            self.assertNotIn("paged message 005", html)
+            self.assertNotIn("Older warbles", html)
+
+    def test_user_profile_bad_cursor(self):
+        """Is a malformed cursor rejected?"""
+
+        with self.client as c:
+            resp = c.get(f"/users/{self.user3.id}?before=garbage")
+            self.assertEqual(resp.status_code, 400)
+
     def test_users_search(self):
         """Does user search work?"""
 
@@ -203,6 +388,38 @@ class UserViewTestCase(TestCase):
             self.assertIn("user4", html)
             self.assertNotIn("test message1", html)
 
+    def test_users_search_bio(self):
+        """Does search match bios, ignoring case?"""
+
+        self.user3.bio = "Birdwatcher from Lisbon"
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/users?q=BIRDWATCH")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("user3", html)
+            self.assertNotIn("user2", html)
+
+    def test_users_listing_is_capped(self):
+        """Is the unfiltered listing paged rather than returning everyone?"""
+
+        with self.client as c:
+            with patch("search.USER_LIST_LIMIT", 2):
+                resp = c.get("/users")
+                html = resp.get_data(as_text=True)
+
+            self.assertIn("test_name", html)
+            self.assertIn("user2", html)
+            self.assertNotIn("user3", html)
+            self.assertIn("More users", html)
+
+            resp = c.get(f"/users?after={self.user2.id}")
+            html = resp.get_data(as_text=True)
+            self.assertIn("user3", html)
+            self.assertNotIn("test_name", html)
+
     def test_new_messages(self):
         """Can logged in user view page to create new message?"""
 
@@ -256,6 +473,42 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("user2", html)
 
+    def test_following_pages(self):
+        """Is the following list paginated, newest follow first?"""
+
+        start = datetime(2024, 1, 1)
+        db.session.add_all(
+            [
+                Follows(
+                    user_being_followed_id=followed_id,
+                    user_following_id=self.testuser.id,
+                    created_at=start + timedelta(days=day),
+                )
+                for day, followed_id in enumerate([222, 333, 444])
+            ]
+        )
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            with patch("app.FOLLOW_PAGE_SIZE", 2):
+                resp = c.get(f"/users/{self.testuser.id}/following")
+                html = resp.get_data(as_text=True)
+
+                self.assertLess(html.index("@user4"), html.index("@user3"))
+                self.assertNotIn("@user2", html)
+                self.assertIn("More users", html)
+
+                cursor = re.search(r"before=([\w-]+)", html).group(1)
+                resp = c.get(f"/users/{self.testuser.id}/following?before={cursor}")
+                html = resp.get_data(as_text=True)
+
+                self.assertIn("@user2", html)
+                self.assertNotIn("@user3", html)
+                self.assertNotIn("More users", html)
+
     def test_unauthorized_followers_page(self):
         """Can user view followers if not logged in?"""
 
@@ -281,6 +534,92 @@ class UserViewTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertIn("test message1", html)
+            self.assertIn('<span class="like-count">0</span>', html)
+
+    def test_like_toggle(self):
+        """Does liking twice like then unlike, keeping the counter in step?"""
+
+        self.setup_likes()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user2.id
+
+            resp = c.post("/users/add_like/1234")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(User.query.get(self.user2.id).likes_count, 1)
+
+            # Several users may like the same message
+            self.assertEqual(Likes.query.filter_by(message_id=1234).count(), 2)
+
+            c.post("/users/add_like/1234")
+            self.assertEqual(User.query.get(self.user2.id).likes_count, 0)
+            self.assertIsNone(
+                Likes.query.filter_by(user_id=self.user2.id, message_id=1234).first()
+            )
+
+    def test_like_json(self):
+        """Does the like endpoint answer AJAX requests with JSON?"""
+
+        self.setup_likes()
+        headers = {"Accept": "application/json"}
+
+        with self.client as c:
+            resp = c.post("/users/add_like/1234", headers=headers)
+            self.assertEqual(resp.status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user2.id
+
+            resp = c.post("/users/add_like/1234", headers=headers)
+            self.assertEqual(
+                resp.json, {"message_id": 1234, "liked": True, "likes_count": 1}
+            )
+
+            resp = c.post("/users/add_like/1234", headers=headers)
+            self.assertEqual(
+                resp.json, {"message_id": 1234, "liked": False, "likes_count": 0}
+            )
+
+            self.assertEqual(c.post("/users/add_like/99999").status_code, 404)
+
+    def test_like_own_message(self):
+        """Are users kept from liking their own messages?"""
+
+        self.setup_likes()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post("/users/add_like/1234")
+            self.assertEqual(resp.status_code, 403)
+
+    def test_like_deleted_author(self):
+        """Are messages by a deleted account awaiting its purge unlikeable?"""
+
+        self.setup_likes()
+        self.testuser.deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user2.id
+
+            resp = c.post("/users/add_like/1234")
+            self.assertEqual(resp.status_code, 404)
+
+        self.assertIsNone(Likes.query.filter_by(user_id=self.user2.id).first())
+        self.assertEqual(User.query.get(self.user2.id).likes_count, 0)
+
+    def test_likes_add_is_idempotent(self):
+        """Does adding an existing like leave a single row?"""
+
+        self.setup_likes()
+
+        self.assertFalse(Likes.add(self.testuser.id, 1234))
+        self.assertTrue(Likes.remove(self.testuser.id, 1234))
+        self.assertFalse(Likes.remove(self.testuser.id, 1234))
 
     def test_edit_profile(self):
         """Can a logged in user edit their own user profile?"""
@@ -0,0 +1,355 @@
+"""Materialized home timelines for Warbler.
+
+Rather than rebuilding the home feed from `follows` on every request, each
+new message is copied ("fanned out") into the `timelines` rows of the
+author's followers when it is posted, so reading a timeline is a single
+indexed range scan.
+
+Accounts with very many followers ("celebrities") are the exception: fanning
+their messages out would mean thousands of writes per post, so their
+messages are left out of timelines and merged in when the timeline is read.
+Between the two, messages by authors with more than TIMELINE_INLINE_FAN_OUT
+followers are fanned out by a background job (see jobs.py), so posting
+stays quick; the author sees their own message at once either way.
+
+The `timelines` table is plain SQL, so the same code runs against Postgres in
+production and SQLite locally.
+"""
+
+from flask import current_app
+from sqlalchemy import Column, DateTime, Integer, MetaData, Table
+from sqlalchemy import delete, func, insert, literal, select
+
+from models import db, feed_query, Follows, Message, TimelineEntry, User
+from pagination import make_page, older_than
+import jobs
+
+DEFAULT_CELEBRITY_THRESHOLD = 10000
+DEFAULT_BACKFILL_LIMIT = 100
+DEFAULT_INLINE_FAN_OUT = 1000
+
+# Scratch table for `rebuild()`: each author's newest messages, ranked once.
+recent_messages = Table(
+    "rebuild_recent_messages",
+    MetaData(),
+    Column("id", Integer),
+    Column("user_id", Integer, index=True),
+    Column("timestamp", DateTime),
+    prefixes=["TEMPORARY"],
+)
+
+
+def celebrity_threshold():
+    """Follower count above which an account is read on demand, not fanned out."""
+
+    return current_app.config.get(
+        "TIMELINE_CELEBRITY_THRESHOLD", DEFAULT_CELEBRITY_THRESHOLD
+    )
+
+
+def backfill_limit():
+    """How many of an account's recent messages a new follower receives."""
+
+    return current_app.config.get("TIMELINE_BACKFILL_LIMIT", DEFAULT_BACKFILL_LIMIT)
+
+
+def celebrity_ids():
+    """SQL query selecting the ids of all celebrity accounts."""
+
+    return select(User.id).where(User.followers_count > celebrity_threshold())
+
+
+def inline_fan_out_limit():
+    """Follower count above which fan-out is left to a background job."""
+
+    return current_app.config.get("TIMELINE_INLINE_FAN_OUT", DEFAULT_INLINE_FAN_OUT)
+
+
+def followers_count(user_id):
+    return (
+        db.session.scalar(select(User.followers_count).where(User.id == user_id))
+        or 0
+    )
+
+
+def is_celebrity(user_id):
+    """Is `user_id` followed by too many users to fan out their messages?"""
+
+    return followers_count(user_id) > celebrity_threshold()
+
+
+def fan_out(message):
+    """Deliver a newly posted (and flushed) `message` to timelines.
+
+    The author always receives their own message at once. Followers receive
+    it unless the author is a celebrity: in this transaction if there are
+    few of them, otherwise from a queued `fan_out` job.
+    """
+
+    deliver(
+        select(
+            literal(message.user_id),
+            literal(message.id),
+            literal(message.user_id),
+            literal(message.timestamp),
+        )
+    )
+
+    followers = followers_count(message.user_id)
+
+    if followers > celebrity_threshold():
+        return
+
+    if followers > inline_fan_out_limit():
+        jobs.enqueue("fan_out", message_id=message.id)
+    else:
+        fan_out_to_followers(message)
+
+
+@jobs.handler("fan_out")
+def fan_out_job(message_id):
+    message = db.session.get(Message, message_id)
+    if message is not None:
+        fan_out_to_followers(message)
+
+
+def fan_out_to_followers(message):
+    """Deliver `message` to every follower of its author who lacks it."""
+
+    # A follow made after posting may have delivered it already (see
+    # `add_follows()`) by the time a queued fan-out runs.
+    delivered = select(TimelineEntry.user_id).where(
+        TimelineEntry.message_id == message.id
+    )
+
+    deliver(
+        select(
+            Follows.user_following_id,
+            literal(message.id),
+            literal(message.user_id),
+            literal(message.timestamp),
+        )
+        .where(Follows.user_being_followed_id == message.user_id)
+        .where(Follows.user_following_id != message.user_id)
+        .where(Follows.user_following_id.not_in(delivered))
+    )
+
+
+def deliver(rows):
+    """Insert timeline rows selected as (user, message, author, timestamp)."""
+
+    db.session.execute(
+        insert(TimelineEntry).from_select(
+            ["user_id", "message_id", "author_id", "timestamp"], rows
+        )
+    )
+
+
+def add_follows(follower_id, followed_ids):
+    """Copy recent messages of newly followed users into the follower's timeline.
+
+    One statement for any number of `followed_ids`, copying up to the
+    backfill limit per user; celebrities are skipped.
+    """
+
+    if not followed_ids:
+        return
+
+    already_delivered = (
+        select(TimelineEntry.message_id)
+        .where(TimelineEntry.user_id == follower_id)
+        .where(TimelineEntry.author_id.in_(followed_ids))
+    )
+
+    newest_first = func.row_number().over(
+        partition_by=Message.user_id,
+        order_by=(Message.timestamp.desc(), Message.id.desc()),
+    )
+
+    ranked = (
+        select(Message.id, Message.user_id, Message.timestamp, newest_first.label("n"))
+        .where(Message.user_id.in_(followed_ids))
+        .where(Message.user_id.not_in(celebrity_ids()))
+        .where(Message.id.not_in(already_delivered))
+        .subquery()
+    )
+
+    recent = select(
+        literal(follower_id), ranked.c.id, ranked.c.user_id, ranked.c.timestamp
+    ).where(ranked.c.n <= backfill_limit())
+
+    db.session.execute(
+        insert(TimelineEntry).from_select(
+            ["user_id", "message_id", "author_id", "timestamp"], recent
+        )
+    )
+
+
+def remove_follows(follower_id, followed_ids):
+    """Drop messages by any of `followed_ids` from the follower's timeline."""
+
+    db.session.execute(
+        delete(TimelineEntry)
+        .where(TimelineEntry.user_id == follower_id)
+        .where(TimelineEntry.author_id.in_(followed_ids))
+    )
+
+
+def remove_message(message_id):
+    """Drop a deleted message from every timeline it was delivered to."""
+
+    db.session.execute(
+        delete(TimelineEntry).where(TimelineEntry.message_id == message_id)
+    )
+
+
+def home_timeline(user_id, before=None, limit=100, query=None):
+    """Return a Page of the messages on `user_id`'s home timeline.
+
+    Fanned-out messages come from the user's timeline rows; messages by
+    followed celebrities are read directly and merged in. `before` is a
+    decoded pagination cursor. `query` selects the messages (by default
+    `feed_query()`, with their authors); it must load `id` and `timestamp`.
+    """
+
+    if query is None:
+        query = feed_query()
+
+    delivered = query.join(
+        TimelineEntry, TimelineEntry.message_id == Message.id
+    ).filter(TimelineEntry.user_id == user_id)
+
+    if before is not None:
+        delivered = delivered.filter(
+            older_than(TimelineEntry.timestamp, TimelineEntry.message_id, before)
+        )
+
+    messages = (
+        delivered.order_by(
+            TimelineEntry.timestamp.desc(), TimelineEntry.message_id.desc()
+        )
+        .limit(limit + 1)
+        .all()
+    )
+
+    followed_celebrities = (
+        select(Follows.user_being_followed_id)
+        .where(Follows.user_following_id == user_id)
+        .where(Follows.user_being_followed_id.in_(celebrity_ids()))
+    )
+
+    from_celebrities = query.filter(
+        Message.user_id.in_(followed_celebrities)
+    )
+
+    if before is not None:
+        from_celebrities = from_celebrities.filter(
+            older_than(Message.timestamp, Message.id, before)
+        )
+
+    celebrity_messages = (
+        from_celebrities.order_by(Message.timestamp.desc(), Message.id.desc())
+        .limit(limit + 1)
+        .all()
+    )
+
+    if celebrity_messages:
+        merged = {msg.id: msg for msg in messages + celebrity_messages}
+        messages = sorted(
+            merged.values(), key=lambda msg: (msg.timestamp, msg.id), reverse=True
+        )
+
+    return make_page(messages[: limit + 1], limit)
+
+
+def rebuild(batch_size=1000):
+    """Rebuild every timeline from the existing `follows` and `messages` rows.
+
+    Celebrity status is read from `User.followers_count`, so reconcile the
+    counters first if they may have drifted.
+
+    Each author's newest messages, up to the backfill limit, are ranked
+    once into a temporary table; every timeline, the owner's own messages
+    included, is rebuilt from those. Work is committed in batches of
+    `batch_size` timeline owners so that a large backfill never holds one
+    giant transaction. Each batch deletes and rewrites its owners' rows in
+    one transaction, so readers see the old timeline until the new one is
+    in place. Returns the number of timeline rows written.
+    """
+
+    ranked = select(
+        Message.id,
+        Message.user_id,
+        Message.timestamp,
+        func.row_number()
+        .over(
+            partition_by=Message.user_id,
+            order_by=(Message.timestamp.desc(), Message.id.desc()),
+        )
+        .label("position"),
+    ).subquery()
+
+    written = 0
+
+    # One connection throughout, as the temporary table lives on it
+    with db.engine.connect() as conn:
+        recent_messages.create(conn)
+
+        try:
+            conn.execute(
+                insert(recent_messages).from_select(
+                    ["id", "user_id", "timestamp"],
+                    select(ranked.c.id, ranked.c.user_id, ranked.c.timestamp).where(
+                        ranked.c.position <= backfill_limit()
+                    ),
+                )
+            )
+            conn.commit()
+
+            max_id = conn.scalar(select(func.max(User.id))) or 0
+
+            for low in range(0, max_id + 1, batch_size):
+                written += _rebuild_batch(conn, low, low + batch_size)
+                conn.commit()
+
+        finally:
+            conn.rollback()
+            recent_messages.drop(conn)
+            conn.commit()
+
+    return written
+
+
+def _rebuild_batch(conn, low, high):
+    """Rewrite the timelines of owners [low, high) from `recent_messages`."""
+
+    recent = recent_messages.c
+
+    conn.execute(
+        delete(TimelineEntry).where(
+            TimelineEntry.user_id >= low, TimelineEntry.user_id < high
+        )
+    )
+
+    own = select(recent.user_id, recent.id, recent.user_id, recent.timestamp).where(
+        recent.user_id >= low, recent.user_id < high
+    )
+
+    followed = (
+        select(Follows.user_following_id, recent.id, recent.user_id, recent.timestamp)
+        .join(recent_messages, recent.user_id == Follows.user_being_followed_id)
+        .where(Follows.user_following_id >= low, Follows.user_following_id < high)
+        .where(Follows.user_following_id != Follows.user_being_followed_id)
+        .where(Follows.user_being_followed_id.not_in(celebrity_ids()))
+    )
+
+    written = 0
+    for rows in (own, followed):
+        result = conn.execute(
+            insert(TimelineEntry).from_select(
+                ["user_id", "message_id", "author_id", "timestamp"], rows
+            )
+        )
+        written += result.rowcount
+
+    return written